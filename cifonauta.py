@@ -15,26 +15,29 @@ Centro de Biologia Marinha da Universidade de São Paulo.
 '''
 
 import getopt
+import json
 import logging
 import os
 import pickle
 import sys
-import subprocess
 import time
 
 from datetime import datetime
-from iptcinfo import IPTCInfo
-from shutil import copy
 
 import linking
-from itis import Itis
+from itis import resolve_taxa, update_taxa
 from media_utils import *
+from sidecar import read_sidecar
 
 # Django environment setup.
 import django
 django.setup()
 from meta.models import *
+from meta.ingest import (LOOKUP_MODELS, BadData, LookupCache, MediaIndex,
+                         apply_m2m, write_batches)
+from meta.signals import defer_counts, flush_counts
 from django.conf import settings
+from django.db import transaction
 
 __author__ = 'Bruno Vellutini'
 __copyright__ = 'Copyright 2010-2011, CEBIMar-USP'
@@ -49,51 +52,12 @@ __status__ = 'Development'
 class Database:
     '''Define objeto que interage com o banco de dados.'''
     def __init__(self):
-        pass
-
-    def search_db(self, media):
-        '''Busca o registro no banco de dados pelo nome do arquivo.
-
-        Se encontrar, compara a data de modificação do arquivo e do registro.
-        Se as datas forem iguais pula para próximo arquivo, se forem diferentes
-        atualiza o registro.
-        '''
-        print
-        logger.info('Procurando %s (%s) no banco de dados...',
-                media.filename, media.source_filepath)
-        photopath = 'photos/'
-        videopath = 'videos/'
-
-        try:
-            if media.type == "photo":
-                # Busca pelo nome exato do arquivo, para evitar confusão.
-                record = Image.objects.get(web_filepath=photopath + media.filename)
-            elif media.type == "video":
-                try:
-                    record = Video.objects.get(webm_filepath=videopath + media.filename.split('.')[0] + '.webm')
-                except:
-                    try:
-                        record = Video.objects.get(mp4_filepath=videopath + media.filename.split('.')[0] + '.mp4')
-                    except:
-                        try:
-                            record = Video.objects.get(ogg_filepath=videopath + media.filename.split('.')[0] + '.ogv')
-                        except:
-                            logger.debug('%s não está no banco de dados.',
-                                    media.filename)
-                            return False
-            logger.debug('Bingo! Registro de %s encontrado.', media.filename)
-            logger.info('Comparando timestamp do arquivo com o registro...')
-            # XXX Dirty hack to make naive timestamp.
-            record.timestamp = record.timestamp.replace(tzinfo=None)
-            if record.timestamp != media.timestamp:
-                logger.debug('Arquivo mudou! Retorna 1')
-                return 1
-            else:
-                logger.debug('Arquivo não mudou! Retorna 2')
-                return 2
-        except Image.DoesNotExist:
-            logger.debug('Registro não encontrado (Image.DoesNotExist).')
-            return False
+        # Instâncias dos metadados que já estão no banco.
+        self.cache = LookupCache()
+        # Correções conhecidas de metadados mal escritos.
+        self.bad_data = BadData()
+        # Nomes dos táxons criados nesta execução, esperando o ITIS.
+        self.new_taxa = set()
 
     def update_db(self, media, update=False):
         '''Cria ou atualiza registro no banco de dados.'''
@@ -127,6 +91,10 @@ class Database:
             media_meta['is_public'] = False
         else:
             media_meta['is_public'] = True
+        # Vídeo novo só é publicado quando a conversão terminar.
+        queued = getattr(media, 'queued', False)
+        if queued and not update:
+            media_meta['is_public'] = False
         # Deleta para inserir autores separadamente.
         del media_meta['author']
 
@@ -147,8 +115,6 @@ class Database:
                 entry = Image(**media_meta)
             elif media.type == 'video':
                 entry = Video(**media_meta)
-            # Tem que salvar para criar id, usado na hora de salvar as tags
-            entry.save()
         else:
             if media.type == 'photo':
                 entry = Image.objects.get(web_filepath__icontains=media.filename)
@@ -157,6 +123,9 @@ class Database:
             for k, v in media_meta.iteritems():
                 setattr(entry, k, v)
 
+        # Salva uma vez só, antes das relações (precisam do id se for novo).
+        entry.save()
+
         # Atualiza autores
         entry = self.update_sets(entry, 'author', authors)
 
@@ -172,8 +141,10 @@ class Database:
         # Atualiza referências
         entry = self.update_sets(entry, 'reference', refs)
 
-        # Salvando modificações
-        entry.save()
+        # Coloca a conversão do vídeo na fila.
+        if queued:
+            TranscodeJob.enqueue(entry)
+            logger.info('Conversão de %s na fila.', entry.source_filepath)
 
         logger.info('Registro no banco de dados atualizado!')
 
@@ -181,56 +152,37 @@ class Database:
         '''Retorna o id a partir do nome.'''
         # TODO Create hook to avoid badly formatted characters to be saved.
         # Any new tag should be manually confirmed and corrected.
-        #model, new = eval('%s.objects.get_or_create(name="%s")' % (table.capitalize(), value))
 
         print('\nGET table: %s, value: %s' % (table, value))
 
         # Needs a default in case objects exists.
         new = False
 
-        # Try to get object. If it doesn't exist, confirm to avoid bad metadata.
-        try:
-            model = eval('%s.objects.get(name="%s")' % (table.capitalize(), value))
-        except:
-            # Load bad data dictionary.
-            bad_data_file = open('bad_data.pkl', 'rb')
-            bad_data = pickle.load(bad_data_file)
-            bad_data_file.close()
-            try:
-                fixed_value = bad_data[value]
-                print('"%s" automatically fixed to "%s"' % (value, bad_data[value]))
-            except:
-                fixed_value = raw_input('\nNovo metadado. Digite para confirmar: ')
+        # Try cached object. If it doesn't exist, confirm to avoid bad metadata.
+        model = self.cache.get(table, value)
+        if model is None:
+            fixed_value = self.bad_data.get(value)
+            if fixed_value:
+                print('"%s" automatically fixed to "%s"' % (value, fixed_value))
+            else:
+                fixed_value = raw_input('\nNovo metadado. Digite para confirmar: ').decode('utf-8')
             try:
-                model, new = eval('%s.objects.get_or_create(name="%s")' % (table.capitalize(), fixed_value))
+                model, new = LOOKUP_MODELS[table].objects.get_or_create(name=fixed_value)
                 if new:
-                    print('Novo metadado %s criado!' % fixed_value)
+                    print(u'Novo metadado %s criado!' % fixed_value)
                 else:
-                    print('Metadado %s já existia!' % fixed_value)
+                    print(u'Metadado %s já existia!' % fixed_value)
                     # Add to bad data dictionary.
-                    bad_data[value] = fixed_value
-                    bad_data_file = open('bad_data.pkl', 'wb')
-                    pickle.dump(bad_data, bad_data_file)
-                    bad_data_file.close()
+                    self.bad_data.add(value, fixed_value)
+                # Guarda a instância para o resto da execução.
+                self.cache.add(table, model, value)
                 # TODO Fix metadata field on original image!!!
             except:
-                print('Objeto %s não foi encontrado! Abortando...' % fixed_value)
+                print(u'Objeto %s não foi encontrado! Abortando...' % fixed_value)
 
-        # Consulta ITIS para extrair táxons.
+        # Táxons novos são buscados no ITIS de uma vez (resolve_new_taxa).
         if table == 'taxon' and new:
-            taxon = self.get_itis(value)
-            # Reforça, caso a conexão falhe.
-            if not taxon:
-                taxon = self.get_itis(value)
-                if not taxon:
-                    logger.debug('Nova tentativa em 5s...')
-                    time.sleep(5)
-                    taxon = self.get_itis(value)
-            try:
-                # Por fim, atualizar o modelo.
-                model = taxon.update_model(model)
-            except:
-                logger.warning('Não rolou pegar hierarquia...')
+            self.new_taxa.add(model.name)
         return model
 
     def update_sets(self, entry, field, meta):
@@ -242,27 +194,28 @@ class Database:
         logger.debug('META (%s): %s', field, meta)
         meta_instances = [self.get_instance(field, value) for value in meta if value.strip()]
         logger.debug('INSTANCES FOUND: %s', meta_instances)
-        eval('entry.%s_set.clear()' % field)
-        [eval('entry.%s_set.add(value)' % field) for value in meta_instances if meta_instances]
+        apply_m2m(entry, field, meta_instances)
         return entry
 
-    def get_itis(self, name):
-        '''Consulta banco de dados do ITIS.
+    def resolve_new_taxa(self):
+        '''Busca a hierarquia dos táxons criados durante a execução.
 
-        Extrai o táxon pai e o ranking. Valores são guardados em:
-
-        taxon.name
-        taxon.rank
-        taxon.tsn
-        taxon.parents
-        taxon.parent['name']
-        taxon.parent['tsn']
+        Todos os nomes são buscados no ITIS ao mesmo tempo e depois gravados
+        do topo da hierarquia para baixo.
         '''
-        try:
-            taxon = Itis(name)
-        except:
-            return None
-        return taxon
+        # Táxons criados por arquivos desfeitos (rollback) não foram gravados.
+        names = set(Taxon.objects.filter(name__in=self.new_taxa).values_list(
+            'name', flat=True))
+        self.new_taxa = set()
+        if not names:
+            return []
+        logger.info('Buscando %d táxons novos no ITIS...', len(names))
+        resolved = resolve_taxa(names)
+        with transaction.atomic():
+            updated = update_taxa(resolved)
+        logger.info('%d de %d táxons atualizados pelo ITIS.', len(updated),
+                len(names))
+        return updated
 
 
 class Movie:
@@ -330,21 +283,18 @@ class Movie:
         try:
             linked_to = os.readlink(self.source_filepath)
             txt_path = linked_to.split('.')[0] + '.txt'
-            meta_text = open(txt_path, 'rb')
+            meta_text = os.path.isfile(txt_path)
+            meta_dic = read_sidecar(txt_path)
             logger.debug('Arquivo acessório %s existe!', txt_path)
-        except:
+        except (OSError, IOError):
             logger.debug('Arquivo acessório de %s não existe!',
                     self.source_filepath)
-            meta_text = ''
-
-        if meta_text:
-            try:
-                meta_dic = pickle.load(meta_text)
-                # Atualiza meta com valores do arquivo acessório.
-                self.meta.update(meta_dic)
-                meta_text.close()
-            except:
-                logger.warning('Pickle está corrompido: %s', meta_text)
+            meta_text, meta_dic = False, {}
+        except ValueError as e:
+            logger.warning('Arquivo acessório corrompido: %s', e)
+            meta_dic = {}
+        # Atualiza meta com valores do arquivo acessório.
+        self.meta.update(meta_dic)
 
         # Inicia processo de renomear arquivo.
         if new:
@@ -371,199 +321,26 @@ class Movie:
 
         # Inclui duração, dimensões e codec do vídeo.
         infos = get_info(self.meta['source_filepath'])
-        self.meta.update(infos)
-
-        # Processa o vídeo.
-        web_paths, thumb_filepath, large_thumb = self.process_video()
         # Caso arquivo esteja corrompido.
-        if not web_paths:
+        if not infos:
             return None
+        self.meta.update(infos)
 
         # Prepara alguns campos para banco de dados.
         self.meta = prepare_meta(self.meta)
 
-        # Insere paths sem o folder site_media
-        for k, v in web_paths.iteritems():
-            self.meta[k] = v.strip('site_media/')
-        self.meta['thumb_filepath'] = thumb_filepath.strip('site_media/')
-        self.meta['large_thumb'] = large_thumb.strip('site_media/')
+        # A conversão fica na fila (manage.py transcode); os caminhos das
+        # versões web já são conhecidos. Se só os metadados mudaram, as
+        # versões atuais continuam valendo.
+        for k, v in video_paths(self.filename).iteritems():
+            # Playlist HLS só entra depois de criada (pelo transcode).
+            if k == 'manifest_filepath' and not os.path.isfile(v):
+                continue
+            self.meta[k] = site_relative(v)
+        self.queued = not video_rendered(self.source_filepath)
 
         return self.meta
 
-    def build_call(self, filepath):
-        '''Constrói o subprocesso para converter o vídeo com o FFmpeg.
-        #webm HD
-        ffmpeg -y -i hd.m2ts -i marca.png -metadata title="A WEBM HD" -metadata author="AN AUTHOR"
-        -b:v 600k -threads 0 -acodec libvorbis -b:a 128k -ac 2 -ar 44100 -vcodec libvpx
-        -filter_complex "scale=512x288,overlay=0:main_h-overlay_h-0" hd.webm
-
-        #webm DV
-        ffmpeg -y -i dv.avi -i marca.png -metadata title="A WEBM DV" -metadata author="AN AUTHOR"
-        -b:v 600k -threads 0 -acodec libvorbis -b:a 128k -ac 2 -ar 44100 -vcodec libvpx
-        -filter_complex "scale=512x384,overlay=0:main_h-overlay_h-0" dv.webm
-
-        #ogg HD
-        ffmpeg -y -i hd.m2ts -i marca.png -metadata title="AN OGG HD" -metadata author="AN AUTHOR"
-        -b:v 600k -threads 0 -acodec libvorbis -b:a 128k -ac 2 -ar 44100 -vcodec libtheora
-        -filter_complex "scale=512x288,overlay=0:main_h-overlay_h-0" hd.ogv
-
-        #ogg DV
-        ffmpeg -y -i dv.avi -i marca.png -metadata title="AN OGG DV" -metadata author="AN AUTHOR"
-        -b:v 600k -threads 0 -acodec libvorbis -b:a 128k -ac 2 -ar 44100 -vcodec libtheora
-        -filter_complex "scale=512x384,overlay=0:main_h-overlay_h-0" dv.ogv
-
-        #mp4 HD
-        ffmpeg -y -i hd.m2ts -i marca.png -metadata title="A MP4 HD" -metadata author="AN AUTHOR"
-        -b:v 600k -threads 0 -acodec libfaac -b:a 128k -ac 2 -ar 44100 -vcodec libx264
-        -filter_complex "scale=512x288,overlay=0:main_h-overlay_h-0" hd.mp4
-
-        #mp4 DV
-        ffmpeg -y -i dv.avi -i marca.png -metadata title="A MP4 DV" -metadata author="AN AUTHOR"
-        -b:v 600k -threads 0 -acodec libfaac -b:a 128k -ac 2 -ar 44100 -vcodec libx264
-        -filter_complex "scale=512x384,overlay=0:main_h-overlay_h-0" dv.mp4
-        '''
-        # Base
-        call = [
-                'ffmpeg', '-y', '-i', self.source_filepath, '-i', 'marca.png',
-                '-metadata', 'title="%s"' % self.meta['title'],
-                '-metadata', 'author="%s"' % self.meta['author'],
-                '-b:v', '600k', '-threads', '0',
-                ]
-        #TODO Achar um jeito mais confiável de saber se é HD...
-        # Comando cria objeto da marca d'água e redimensiona para 100px de
-        # largura, redimensiona o vídeo para o tamanho certo de acordo com seu
-        # tipo e insere a marca no canto esquerdo embaixo.
-        if self.source_filepath.endswith('m2ts'):
-            call.extend([
-                '-filter_complex', 'scale=512x288,overlay=0:main_h-overlay_h-0',
-                '-aspect', '16:9',
-                ])
-        else:
-            call.extend([
-                '-filter_complex', 'scale=512x384,overlay=0:main_h-overlay_h-0',
-                '-aspect', '4:3',
-                ])
-        # Audio codecs
-        # Exemplo para habilitar som no vídeo: filepath_comsom_.avi
-        if 'comsom' in self.source_filepath.split('_'):
-            if filepath.endswith('mp4'):
-                call.extend(['-acodec', 'libfaac', '-b:a', '128k',
-                    '-ac', '2', '-ar', '44100'])
-            else:
-                call.extend(['-acodec', 'libvorbis', '-b:a', '128k',
-                    '-ac', '2', '-ar', '44100'])
-        else:
-            call.append('-an')
-
-        # Video codec
-        if filepath.endswith('webm'):
-            call.extend(['-vcodec', 'libvpx'])
-        elif filepath.endswith('mp4'):
-            call.extend(['-vcodec', 'libx264'])
-        if filepath.endswith('ogv'):
-            call.extend(['-vcodec', 'libtheora'])
-
-        # Finaliza com nome do arquivo
-        call.append(filepath)
-        return call
-
-    def process_video(self):
-        '''Redimensiona o vídeo, inclui marca d'água e comprime.'''
-        #FIXME O que fazer quando vídeos forem menores que isso?
-        logger.info('Processando o vídeo %s', self.source_filepath)
-        web_paths = {}
-        try:
-            #TODO Repensar essa função no módulo media_utils.
-            # WebM
-            webm_name = self.filename.split('.')[0] + '.webm'
-            webm_filepath = os.path.join(self.local_dir, webm_name)
-            webm_call = self.build_call(webm_filepath)
-            # MP4
-            mp4_name = self.filename.split('.')[0] + '.mp4'
-            mp4_filepath = os.path.join(self.local_dir, mp4_name)
-            mp4_call = self.build_call(mp4_filepath)
-            # OGG
-            ogg_name = self.filename.split('.')[0] + '.ogv'
-            ogg_filepath = os.path.join(self.local_dir, ogg_name)
-            ogg_call = self.build_call(ogg_filepath)
-            try:
-                # WebM
-                subprocess.call(webm_call)
-                try:
-                    # Copia vídeo para pasta web
-                    webm_site_filepath = os.path.join(self.site_dir, webm_name)
-                    copy(webm_filepath, webm_site_filepath)
-                except:
-                    logger.warning('Erro ao copiar %s para o site.',
-                            webm_filepath)
-                web_paths['webm_filepath'] = webm_site_filepath
-            except:
-                logger.warning('Processamento do WebM (%s) não funcionou!',
-                        webm_filepath)
-            try:
-                # MP4
-                subprocess.call(mp4_call)
-                try:
-                    # Copia vídeo para pasta web
-                    mp4_site_filepath = os.path.join(self.site_dir, mp4_name)
-                    copy(mp4_filepath, mp4_site_filepath)
-                    try:
-                        subprocess.call(['qt-faststart', mp4_site_filepath,
-                            mp4_site_filepath])
-                    except:
-                        logger.debug('qt-faststart não funcionou para %s',
-                                mp4_filepath)
-                except:
-                    logger.warning('Erro ao copiar %s para o site.',
-                            mp4_filepath)
-                web_paths['mp4_filepath'] = mp4_site_filepath
-            except:
-                logger.warning('Processamento do x264 (%s) não funcionou!',
-                        mp4_filepath)
-            try:
-                # OGG
-                subprocess.call(ogg_call)
-                try:
-                    # Copia vídeo para pasta web
-                    ogg_site_filepath = os.path.join(self.site_dir, ogg_name)
-                    copy(ogg_filepath, ogg_site_filepath)
-                except:
-                    logger.warning('Erro ao copiar %s para o site.',
-                            ogg_filepath)
-                web_paths['ogg_filepath'] = ogg_site_filepath
-            except:
-                logger.warning('Processamento do OGG (%s) não funcionou!',
-                        ogg_filepath)
-        except IOError:
-            logger.warning('Erro na conversão de %s.')
-            return None, None, None
-        else:
-            logger.info('%s convertido com sucesso!', self.source_filepath)
-            thumb_localpath, still_localpath = create_still(
-                    self.source_filepath, self.local_thumb_dir)
-
-            # Copia thumb e still da pasta local para site_media.
-            try:
-                copy(thumb_localpath, self.site_thumb_dir)
-                logger.debug('Thumb copiado para %s', self.site_thumb_dir)
-                copy(still_localpath, self.site_thumb_dir)
-                logger.debug('Still copiado para %s', self.site_thumb_dir)
-            except IOError:
-                logger.warning('Não conseguiu copiar thumb ou still em %s',
-                        self.site_thumb_dir)
-
-            # Define caminho para o thumb e still do site.
-            thumb_sitepath = os.path.join(
-                    self.site_thumb_dir,
-                    os.path.basename(thumb_localpath)
-                    )
-            still_sitepath = os.path.join(
-                    self.site_thumb_dir,
-                    os.path.basename(still_localpath)
-                    )
-
-            return web_paths, thumb_sitepath, still_sitepath
-
 
 class Photo:
     '''Define objeto para instâncias das fotos.'''
@@ -589,39 +366,40 @@ class Photo:
 
         # Verifica existência dos diretórios.
         dir_ready(self.site_dir, self.site_thumb_dir,
-                self.local_dir, self.local_thumb_dir)
+                self.local_dir, self.local_thumb_dir, PHOTO_SIZES_DIR)
 
     def create_meta(self, charset='utf-8', new=False):
         '''Define as variáveis extraídas dos metadados da imagem.
 
-        Usa a biblioteca do arquivo iptcinfo.py para padrão IPTC e pyexiv2 para EXIF.
+        IPTC e EXIF são lidos juntos, abrindo o arquivo uma vez só (ver
+        read_photo_meta).
         '''
         logger.info('Lendo metadados de %s e criando objetos.',
                 self.filename)
 
         # Criar objeto com metadados.
-        info = IPTCInfo(self.source_filepath, True, charset)
+        info, date, gps = read_photo_meta(self.source_filepath, charset)
         # Checando se o arquivo tem dados IPTC.
-        if len(info.data) < 4:
+        if len(info) < 4:
             logger.warning('%s não tem dados IPTC!', self.filename)
 
         # Limpa metadados pra não misturar com o anterior.
         self.meta = {}
         self.meta = {
                 'source_filepath': os.path.abspath(self.source_filepath),
-                'title': info.data['object name'],                      #5
-                'tags': info.data['keywords'],                          #25
-                'author': info.data['by-line'],                         #80
-                'city': info.data['city'],                              #90
-                'sublocation': info.data['sub-location'],               #92
-                'state': info.data['province/state'],                   #95
-                'country': info.data['country/primary location name'],  #101
-                'taxon': info.data['headline'],                         #105
-                'rights': info.data['copyright notice'],                #116
-                'caption': info.data['caption/abstract'],               #120
-                'size': info.data['special instructions'],              #40
-                'source': info.data['source'],                          #115
-                'references': info.data['credit'],                      #110
+                'title': info['object name'],                           #5
+                'tags': info['keywords'],                               #25
+                'author': info['by-line'],                              #80
+                'city': info['city'],                                   #90
+                'sublocation': info['sub-location'],                    #92
+                'state': info['province/state'],                        #95
+                'country': info['country/primary location name'],       #101
+                'taxon': info['headline'],                              #105
+                'rights': info['copyright notice'],                     #116
+                'caption': info['caption/abstract'],                    #120
+                'size': info['special instructions'],                   #40
+                'source': info['source'],                               #115
+                'references': info['credit'],                           #110
                 'timestamp': self.timestamp,
                 'notes': u'',
                 }
@@ -643,21 +421,20 @@ class Photo:
         # Prepara alguns campos para banco de dados.
         self.meta = prepare_meta(self.meta)
 
-        # Extraindo metadados do EXIF.
-        exif = get_exif(self.source_filepath)
-        # Extraindo data.
-        self.meta['date'] = get_date(exif)
-        # Extraindo a geolocalização.
-        gps = get_gps(exif)
+        # Data e geolocalização extraídas do EXIF.
+        self.meta['date'] = date
         self.meta.update(gps)
 
         # Processar imagem.
-        web_filepath, thumb_filepath = self.process_photo()
+        web_filepath, thumb_filepath, derivatives = self.process_photo()
         # Caso arquivo esteja corrompido, interromper.
         if not web_filepath:
             return None
         self.meta['web_filepath'] = web_filepath.strip('site_media/')
         self.meta['thumb_filepath'] = thumb_filepath.strip('site_media/')
+        self.meta['derivatives'] = json.dumps([
+                dict(derivative, path=site_relative(derivative['path']))
+                for derivative in derivatives])
 
         print
         print u'\tVariável\tMetadado'
@@ -687,42 +464,52 @@ class Photo:
         return self.meta
 
     def process_photo(self):
-        '''Redimensiona a imagem e inclui marca d'água.'''
+        '''Redimensiona a imagem e inclui marca d'água.
+
+        Retorna os caminhos no site da versão web e do thumbnail e a lista
+        das versões responsivas (ver photo_derivatives). Pula a conversão se
+        as versões já foram geradas a partir dos mesmos pixels e parâmetros
+        (editar só o IPTC não muda nada).
+        '''
         logger.info('Processando %s...', self.source_filepath)
         photo_localpath = os.path.join(self.local_dir, self.filename)
+        thumb_localpath = os.path.join(self.local_thumb_dir,
+                self.filename.split('.')[0] + '.jpg')
+        # Define caminhos no site.
+        photo_sitepath = os.path.join(self.site_dir, self.filename)
+        thumb_sitepath = os.path.join(
+                self.site_thumb_dir,
+                os.path.basename(thumb_localpath)
+                )
         try:
-            # Converte o arquivo para a web.
-            converted = convert_to_web(self.source_filepath, photo_localpath)
-            # Insere marca d'água.
-            watermark = watermarker(photo_localpath)
-            # Define caminho para arquivo web.
-            photo_sitepath = os.path.join(self.site_dir, self.filename)
-            # Copia foto para pasta site_media se .
-            copy(photo_localpath, photo_sitepath)
-        except IOError:
-            logger.warning('Erro na conversão de %s, verifique o ImageMagick.',
-                    self.source_filepath)
+            # Só lê o cabeçalho para saber as dimensões.
+            derivatives = photo_derivatives(self.filename,
+                    PILImage.open(self.source_filepath).size)
+            site_outputs = [photo_sitepath, thumb_sitepath] + [
+                    derivative['path'] for derivative in derivatives]
+            outputs = [photo_localpath, thumb_localpath] + site_outputs
+            key = photo_render_key(self.source_filepath)
+            if is_rendered(key, outputs):
+                logger.info('Versões de %s em dia.', self.source_filepath)
+                return photo_sitepath, thumb_sitepath, derivatives
+            # Cria todas as versões direto no site, de uma vez e sem
+            # arquivos pela metade; a pasta local recebe hardlinks.
+            with atomic_outputs(site_outputs) as temps:
+                process_image(self.source_filepath, temps[photo_sitepath],
+                        temps[thumb_sitepath],
+                        [dict(derivative, path=temps[derivative['path']])
+                            for derivative in derivatives])
+                temps.finish(site_outputs)
+            link_or_copy(photo_sitepath, photo_localpath)
+            link_or_copy(thumb_sitepath, thumb_localpath)
+        except (IOError, OSError):
+            logger.warning('Erro na conversão de %s.', self.source_filepath)
             # Evita que o loop seja interrompido.
-            return None, None
+            return None, None, None
         else:
             logger.info('%s convertida com sucesso!', self.source_filepath)
-            thumb_localpath = create_thumb(self.source_filepath,
-                    self.local_thumb_dir)
-
-            # Copia thumb da pasta local para site_media.
-            try:
-                copy(thumb_localpath, self.site_thumb_dir)
-                logger.debug('Thumb copiado para %s', self.site_thumb_dir)
-            except:
-                logger.warning('Erro ao copiar thumb para %s', self.site_thumb_dir)
-
-            # Define caminho para o thumb do site.
-            thumb_sitepath = os.path.join(
-                    self.site_thumb_dir,
-                    os.path.basename(thumb_localpath)
-                    )
-
-            return photo_sitepath, thumb_sitepath
+            mark_rendered(key, outputs)
+            return photo_sitepath, thumb_sitepath, derivatives
 
 
 class Folder:
@@ -861,7 +648,8 @@ def usage():
     print
     print '  -f, --force-update'
     print '\tAtualiza banco de dados e refaz thumbnails de todas as entradas, '
-    print '\tinclusive as que não foram modificadas.'
+    print '\tinclusive as que não foram modificadas. Também verifica todos os'
+    print '\tlinks em vez de só as pastas alteradas.'
     print
     print '  -v, --only-videos'
     print '\tAtualiza apenas arquivos de vídeo.'
@@ -869,6 +657,10 @@ def usage():
     print '  -p, --only-photos'
     print '\tAtualiza apenas arquivos de fotos.'
     print
+    print '  -b {n}, --batch-size {n} (padrão=1)'
+    print '\tNúmero de arquivos gravados por transação no banco de dados. Um'
+    print '\tarquivo com erro é desfeito sozinho, sem perder o resto do lote.'
+    print
     print 'Exemplo:'
     print '  python cifonauta.py -fp -n 15'
     print '\tFaz a atualização forçada dos primeiros 15 fotos que o programa'
@@ -892,15 +684,17 @@ def main(argv):
     single_img = False
     only_videos = False
     only_photos = False
+    batch_size = 1
 
     # Verifica se argumentos foram passados com a execução do programa
     try:
-        opts, args = getopt.getopt(argv, 'hfvpn:', [
+        opts, args = getopt.getopt(argv, 'hfvpn:b:', [
             'help',
             'force-update',
             'only-videos',
             'only-photos',
-            'n='])
+            'n=',
+            'batch-size='])
     except getopt.GetoptError:
         usage()
         logger.critical('Algo errado nos argumentos "%s". Abortando...',
@@ -920,13 +714,16 @@ def main(argv):
             only_videos = True
         elif opt in ('-p', '--only-photos'):
             only_photos = True
+        elif opt in ('-b', '--batch-size'):
+            batch_size = int(arg)
 
     # Imprime resumo do que o programa vai fazer
-    logger.debug('Argumentos: n=%d, force_update=%s, only_photos=%s, only_videos=%s.',
-            n_max, force_update, only_photos, only_videos)
+    logger.debug('Argumentos: n=%d, force_update=%s, only_photos=%s, only_videos=%s, batch_size=%d.',
+            n_max, force_update, only_photos, only_videos, batch_size)
 
-    # Verifica e atualiza links entre pasta "oficial" e "source_media".
-    linking.main(settings.STORAGE_FOLDER)
+    # Verifica e atualiza links entre pasta "oficial" e "source_media". Só
+    # olha o que mudou desde a última vez, exceto na atualização forçada.
+    linking.main(settings.STORAGE_FOLDER, full=force_update)
 
     # Cria instância do bd
     cbm = Database()
@@ -939,6 +736,7 @@ def main(argv):
         filepaths = folder.get_files(type='video')
     else:
         filepaths = folder.get_files()
+    medias = []
     for path in filepaths:
         # Reconhece se é foto ou vídeo
         if path[1] == 'photo':
@@ -948,31 +746,47 @@ def main(argv):
         # Skip path if it is a broken link.
         if media.type == 'broken':
             continue
-        # Busca nome do arquivo no banco de dados
-        query = cbm.search_db(media)
-        if not query:
+        medias.append(media)
+
+    # Compara todos os arquivos com os registros do banco de uma vez só.
+    index = MediaIndex(by='web_filepath')
+    new, changed, unchanged = index.classify(medias)
+    if force_update:
+        logger.info('%d REGISTROS ATUALIZADOS, MAS SOB FORCE_UPDATE.',
+                len(unchanged))
+        changed.extend(unchanged)
+    else:
+        logger.info('%d REGISTROS ATUALIZADOS NO SITE.', len(unchanged))
+
+    def prepare():
+        '''Lê os metadados antes de abrir a transação do lote.'''
+        for media in new:
             # Se mídia for nova
             logger.info('ARQUIVO NOVO: %s. CRIANDO ENTRADA NO BANCO DE DADOS...', media.filename)
             # Caso o arquivo esteja corrompido, pular
             if not media.create_meta(new=True):
                 logger.warning('Erro grave, pulando %s', media.source_filepath)
                 continue
-            cbm.update_db(media)
-            n_new += 1
-        else:
-            if not force_update and query == 2:
-                # Se registro existir e timestamp for igual
-                logger.info('REGISTRO ATUALIZADO NO SITE! PRÓXIMO...')
-                pass
-            else:
-                # Se arquivo do site não estiver atualizada
-                if force_update:
-                    logger.info('REGISTRO ATUALIZADO, MAS SOB FORCE_UPDATE.')
-                else:
-                    logger.info('REGISTRO NÃO ESTÁ ATUALIZADO. ATUALIZANDO...')
-                media.create_meta()
-                cbm.update_db(media, update=True)
-                n_up += 1
+            yield media, False
+        for media in changed:
+            # Se arquivo do site não estiver atualizado
+            logger.info('REGISTRO NÃO ESTÁ ATUALIZADO. ATUALIZANDO %s...',
+                    media.filename)
+            media.create_meta()
+            yield media, True
+
+    # Grava batch_size arquivos por transação. Contadores são recalculados de
+    # uma vez no final.
+    defer_counts()
+    try:
+        written, failed = write_batches(prepare(),
+                lambda item: cbm.update_db(*item), batch_size, cbm.cache)
+        # Táxons criados acima ganham hierarquia antes da recontagem.
+        cbm.resolve_new_taxa()
+    finally:
+        flush_counts()
+    n_new = len([item for item in written if not item[1]])
+    n_up = len(written) - n_new
     n = len(filepaths)
 
     # Create file for Veliger autocomplete.
@@ -982,6 +796,8 @@ def main(argv):
     print '\n%d ARQUIVOS ANALISADOS' % n
     print '%d novos' % n_new
     print '%d atualizados' % n_up
+    if failed:
+        print '%d com erro' % len(failed)
     t = int(time.time() - t0)
     if t > 60:
         print '\nTempo de execução:', t / 60, 'min', t % 60, 's'
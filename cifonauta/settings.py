@@ -233,6 +233,10 @@ logging.getLogger('sorl.thumbnail').addHandler(handler)
 # Storage folder.
 STORAGE_FOLDER = '/home/nelas/storage/oficial'
 
+# On-disk cache of ITIS responses (expire after 30 days).
+ITIS_CACHE_DIR = os.path.join(BASE_DIR, 'cache/itis')
+ITIS_CACHE_TTL = 30 * 24 * 60 * 60
+
 # Import server settings.
 hostname = socket.gethostname()
 if hostname == 'cifonauta' or hostname == 'cebimar-002':
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Small file-backed stores shared by the Cifonauta scripts.
+
+Journal is an append-only file of JSON records that several processes can
+write to at the same time without clobbering each other. FileCache is a
+directory of pickled values with expiry, shared the same way.
+'''
+
+import cPickle as pickle
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+# Instancia logger.
+logger = logging.getLogger('cifonauta.filestore')
+
+
+class Journal:
+    '''Append-only file of JSON records, one per line.
+
+    Every record is written with a single O_APPEND write while holding an
+    exclusive lock, so concurrent writers never lose each other's records.
+    Readers replay the file once and then only read what was appended since.
+    '''
+    def __init__(self, path):
+        self.path = path
+        # Bytes already consumed by read().
+        self.offset = 0
+
+    def read(self):
+        '''Return records appended since the last read.'''
+        try:
+            journal = open(self.path, 'rb')
+        except IOError:
+            return []
+        try:
+            fcntl.flock(journal, fcntl.LOCK_SH)
+            journal.seek(self.offset)
+            data = journal.read()
+        finally:
+            fcntl.flock(journal, fcntl.LOCK_UN)
+            journal.close()
+
+        # Ignore a trailing partial line, it will be read next time.
+        end = data.rfind('\n') + 1
+        self.offset += end
+        records = []
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning('Ignoring corrupted line in %s: %r', self.path,
+                               line)
+        return records
+
+    @contextmanager
+    def locked(self):
+        '''Keep other locked() blocks out while this one runs.
+
+        Use it to read what others appended and append a record that depends
+        on it, with nobody appending a conflicting record in between. The
+        lock is taken on a separate file, so read() and append() still work
+        inside the block.
+        '''
+        fd = os.open(self.path + '.lock', os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield self
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def append(self, record):
+        '''Append one record to the journal.'''
+        line = json.dumps(record) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def create(self, records):
+        '''Write a new journal with records, replacing any previous one.
+
+        The records go to a temporary file renamed into place, so an
+        interrupted write leaves no journal instead of a partial one.
+        '''
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.',
+                                    suffix='.tmp')
+        try:
+            journal = os.fdopen(fd, 'wb')
+            try:
+                for record in records:
+                    journal.write(json.dumps(record) + '\n')
+            finally:
+                journal.close()
+            os.chmod(temp, 0644)
+            os.rename(temp, self.path)
+        except:
+            os.remove(temp)
+            raise
+        self.offset = 0
+
+
+class FileCache:
+    '''Directory of pickled values, one file per key.
+
+    Keys are any value with a stable repr (e.g. tuples of strings and ints).
+    Values are written to a temporary file and renamed into place, so readers
+    in other processes never see half written entries. Entries older than ttl
+    seconds are treated as missing; None means they never expire.
+    '''
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Created by another process in the meantime.
+                if not os.path.isdir(path):
+                    raise
+
+    def filename(self, key):
+        '''Return the file storing key.'''
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.path, digest + '.pkl')
+
+    def expired(self, filename):
+        '''Tell if the entry in filename is older than the TTL.'''
+        if self.ttl is None:
+            return False
+        return time.time() - os.path.getmtime(filename) > self.ttl
+
+    def get(self, key, default=None):
+        '''Return the value cached for key, or default.'''
+        filename = self.filename(key)
+        try:
+            if self.expired(filename):
+                self.delete(key)
+                return default
+            entry = open(filename, 'rb')
+            try:
+                stored_key, value = pickle.load(entry)
+            finally:
+                entry.close()
+        except (IOError, OSError):
+            return default
+        except Exception:
+            logger.warning('Ignoring corrupted cache entry %s', filename)
+            return default
+        # Guard against (unlikely) digest collisions.
+        if stored_key != key:
+            return default
+        return value
+
+    def set(self, key, value):
+        '''Store value under key.'''
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            entry = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump((key, value), entry, pickle.HIGHEST_PROTOCOL)
+            finally:
+                entry.close()
+            os.rename(temp, self.filename(key))
+        except:
+            os.remove(temp)
+            raise
+
+    def delete(self, key):
+        '''Remove key from the cache, if present.'''
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    def purge(self):
+        '''Remove expired entries and return how many were removed.'''
+        removed = 0
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            try:
+                if self.expired(filename):
+                    os.remove(filename)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
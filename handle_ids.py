@@ -4,26 +4,25 @@
 # Script looks into linked_media (folder with symbolic links) and identifies
 # new files, which are copied to the site_media folder with unique names and
 # converted to lightweight web formats.
+#
+# The work is done in stages: scan the links, classify them (new or
+# modified), rename the new ones and convert them. Renames run one at a time
+# in this process; conversions can run in parallel (see main and usage).
 
+import getopt
 import os
-import pickle
-import subprocess
+import sys
 from datetime import datetime
+from multiprocessing import Pool
 from shutil import copy2
-from media_utils import read_iptc, rename_file, convert_to_web, watermarker, build_call, grab_still
+from media_utils import (read_iptc, rename_file, process_image, probe,
+                         transcode, atomic_outputs, get_id_allocator)
+from sidecar import read_sidecar
 
 # Directory with symbolic links files.
 BASEPATH = os.path.abspath('linked_media/oficial')
 # Directory with symbolic links files.
 BASESITE = os.path.abspath('site_media')
-# Get list of file names in site_media.
-site_filenames = []
-for root, dirs, files in os.walk(BASESITE):
-    for filename in files:
-        site_filenames.append(filename)
-# Pickled file with unique names dumped from database.
-db_filenames = pickle.load(open('unique_names.pkl'))
-UNIQUE_NAMES = site_filenames + db_filenames
 # File extensions.
 PHOTO_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif',)
 VIDEO_EXTENSIONS = ('avi', 'mov', 'mp4', 'ogg', 'ogv', 'dv', 'mpg', 'mpeg',
@@ -35,18 +34,22 @@ class File:
         self.root = root
         self.filename = filename
         self.define_paths(self.root, self.filename)
-        self.authors = self.get_authors()
-        if not self.check_name():
-            self.get_unique_name()
-            self.rename_new()
-            self.define_paths(self.root, self.filename)
-            self.new = True
-        else:
-            self.new = False
+        # New files have no ID yet, see rename().
+        self.new = not self.check_name()
         self.filetype = self.get_filetype()
         self.sitepath = self.prepare_sitepath()
         self.modified = self.check_timestamp()
 
+    def rename(self):
+        '''Give a new file its unique name.'''
+        # Only needed for the new name, spare reading the file otherwise.
+        self.authors = self.get_authors()
+        self.get_unique_name()
+        self.rename_new()
+        self.define_paths(self.root, self.filename)
+        self.sitepath = self.prepare_sitepath()
+        self.modified = self.check_timestamp()
+
     def define_paths(self, root, filename):
         '''Define and redefine filepaths.'''
         self.filepath = os.path.join(root.decode('utf-8'), filename.decode('utf-8'))
@@ -125,24 +128,18 @@ class File:
             return info_iptc.data['by-line']
         else:
             if self.txt_abspath:
-                info_mov = pickle.load(open(self.txt_abspath))
-                return info_mov['author']
+                info_mov = read_sidecar(self.txt_abspath, ['author'])
+                return info_mov.get('author', '')
             else:
                 return ''
 
     def check_name(self):
         '''Verifies if file name is an ID.'''
-        if os.path.splitext(self.filename)[0] + '.jpg' in UNIQUE_NAMES:
-            return True
-        else:
-            return False
+        return get_id_allocator().taken(self.filename)
 
     def get_unique_name(self):
-        '''Get a new unique name.'''
-        unique_name = rename_file(self.filename, self.authors)
-        self.filename = unique_name
-        if self.check_name():
-            self.get_unique_name()
+        '''Get a new unique name, reserved for this file only.'''
+        self.filename = rename_file(self.filename, self.authors)
 
     def rename_new(self):
         '''Rename link with unique name.'''
@@ -159,51 +156,182 @@ class File:
                                         self.renamed_txt_abspath))
 
     def process_for_web(self):
-        '''Resize and add watermark for web.'''
+        '''Resize and add watermark for web.
+
+        Returns False if a photo could not be converted; errors converting
+        videos (e.g. IOError when ffmpeg fails) are raised, after the
+        partial files are removed.
+        '''
         print(u'Processing %s...' % self.filename)
         if self.filetype == 'photo':
             try:
-                # Convert file to web format.
-                convert_to_web(self.abspath, self.sitepath)
-                # Insert watermark.
-                watermarker(self.sitepath)
-            except IOError:
-                print(u'Conversion error for %s, check ImageMagick.' %
-                      self.sitepath)
+                # Convert file to web format with watermark, in place of
+                # the old version only when complete.
+                with atomic_outputs([self.sitepath]) as temps:
+                    process_image(self.abspath, temps[self.sitepath])
+                    temps.finish([self.sitepath])
+            except (IOError, OSError):
+                print(u'Conversion error for %s.' % self.sitepath)
+                return False
             else:
                 print(u'%s converted successfully!' % self.sitepath)
         elif self.filetype == 'video':
-            ffmpeg_call = build_call(self.abspath)
-            webm_path = os.path.splitext(self.sitepath)[0] + '.webm'
-            mp4_path = os.path.splitext(self.sitepath)[0] + '.mp4'
-            ogv_path = os.path.splitext(self.sitepath)[0] + '.ogv'
-            # webm
-            ffmpeg_call.append(webm_path)
-            subprocess.call(ffmpeg_call)
-            ffmpeg_call.pop()
-            # mp4
-            ffmpeg_call.append(mp4_path)
-            subprocess.call(ffmpeg_call)
-            ffmpeg_call.pop()
-            # ogv
-            ffmpeg_call.append(ogv_path)
-            subprocess.call(ffmpeg_call)
-            ffmpeg_call.pop()
-            # Create still image.
-            grab_still(mp4_path)
+            stem = os.path.splitext(self.sitepath)[0]
+            # If ratio is larger, HD dimensions.
+            info = probe(self.abspath)
+            widescreen = float(info['width']) / float(info['height']) > 1.4
+            # Decode once for all formats and the still image, written to
+            # temporary files that replace the old ones when ready.
+            outputs = [stem + '.webm', stem + '.mp4', stem + '.ogv']
+            with atomic_outputs(outputs + [stem + '.jpg']) as temps:
+                timings = transcode(self.abspath,
+                                    [temps[path] for path in outputs],
+                                    stillpath=temps[stem + '.jpg'],
+                                    widescreen=widescreen)
+                temps.finish([path for path, temp in temps.iteritems()
+                              if temp in timings])
+            # The still is the sitepath of the video.
+            if temps[stem + '.jpg'] not in timings:
+                print(u'No still for %s.' % self.sitepath)
+                return False
             # Finally, remove original source file to save space.
             #os.remove(self.sitepath)
         else:
             pass
+        return True
+
+
+def scan(folder=BASEPATH):
+    '''Yield (root, filename) of the media links in folder.
+
+    Sidecars are left out, they are handled with their media.
+    '''
+    for root, dirs, files in os.walk(folder):
+        for filename in files:
+            if not filename.endswith('.txt'):
+                yield root, filename
 
-# Search all links in linked_media.
-for root, dirs, files in os.walk(BASEPATH):
-    for filename in files:
-        if not filename.endswith('.txt'):
-            # Create instance and rename if necessary.
+
+def classify(links):
+    '''Return the Files that are new or modified since their conversion.'''
+    files = []
+    for root, filename in links:
+        try:
             one_file = File(root, filename)
-            if one_file.new or one_file.modified:
-                one_file.copy_to_site()
-                one_file.process_for_web()
-            else:
+        except (IOError, OSError) as e:
+            print(u'Could not read %s: %s' % (os.path.join(root, filename), e))
+            continue
+        if one_file.new or one_file.modified:
+            files.append(one_file)
+    return files
+
+
+def rename(files):
+    '''Rename the new files, one at a time, and return those ready.'''
+    ready = []
+    for one_file in files:
+        if one_file.new:
+            try:
+                one_file.rename()
+            except (IOError, OSError) as e:
+                print(u'Could not rename %s: %s' % (one_file.abspath, e))
                 continue
+        ready.append(one_file)
+    return ready
+
+
+def convert_file(one_file):
+    '''Copy the sidecar and convert one file, raising on errors.'''
+    one_file.copy_to_site()
+    if not one_file.process_for_web():
+        raise IOError('conversion failed')
+
+
+def convert_safely(one_file):
+    '''Convert one file; returns (filename, error message or None).
+
+    Runs inside the worker processes, so errors are returned, not raised.
+    '''
+    try:
+        convert_file(one_file)
+    except Exception as e:
+        return one_file.filename, unicode(e)
+    return one_file.filename, None
+
+
+def convert(files, jobs=1):
+    '''Convert the files, in jobs processes. Returns the names that failed.'''
+    if jobs < 2 or len(files) < 2:
+        results = [convert_safely(one_file) for one_file in files]
+    else:
+        pool = Pool(jobs)
+        try:
+            results = list(pool.imap_unordered(convert_safely, files))
+        finally:
+            pool.close()
+            pool.join()
+    failed = []
+    for filename, error in results:
+        if error:
+            print(u'Could not convert %s: %s' % (filename, error))
+            failed.append(filename)
+    return failed
+
+
+def handle_link(root, filename, videos=True):
+    '''Rename a link if needed and convert new or modified files.
+
+    With videos=False, videos are only renamed and their conversion is left
+    to the caller (see convert_file). Returns the File instance, or None for
+    sidecars (handled with their media). Errors are raised.
+    '''
+    if filename.endswith('.txt'):
+        return None
+    one_file = File(root, filename)
+    if one_file.new:
+        one_file.rename()
+    if one_file.filetype == 'video' and not videos:
+        return one_file
+    if one_file.new or one_file.modified:
+        convert_file(one_file)
+    return one_file
+
+
+def main(folder=BASEPATH, jobs=1):
+    '''Scan, classify, rename and convert the links in folder.
+
+    Returns the Files processed and the names that failed to convert.
+    '''
+    files = rename(classify(scan(folder)))
+    print(u'%d files to convert.' % len(files))
+    failed = convert(files, jobs)
+    return files, failed
+
+
+def usage():
+    '''Print the command line help.'''
+    print 'Usage: python handle_ids.py [-h] [-j jobs] [folder]'
+    print
+    print 'Rename new links in folder (default linked_media/oficial) with'
+    print 'unique IDs and convert new or modified files to site_media.'
+    print
+    print '  -j {n}, --jobs {n} (default=1)'
+    print '\tNumber of files converted at the same time.'
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hj:', ['help', 'jobs='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    jobs = 1
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+    files, failed = main(args and os.path.abspath(args[0]) or BASEPATH, jobs)
+    if failed:
+        sys.exit(1)
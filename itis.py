@@ -17,22 +17,92 @@ Algoritmo:
     - Achado o táxon é necessário traduzir (translate) e salvar no objeto
 '''
 
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
 from django.conf import settings
 from suds.client import Client
+from suds.sudsobject import Object
+from filestore import FileCache
 from meta.models import Taxon
 
+WSDL_URL = 'http://www.itis.gov/ITISWebService/services/ITISService?wsdl'
 
-class Itis:
-    '''Interação com o ITIS'''
-    def __init__(self, query):
-        print('Iniciando contato com ITIS.')
+# Número de buscas simultâneas no ITIS.
+ITIS_WORKERS = 4
 
-        self.url = 'http://www.itis.gov/ITISWebService/services/ITISService?wsdl'
-        try:
-            self.client = Client(self.url)
-        except:
-            print('Não conseguiu conectar o cliente!')
+# Cliente e cache compartilhados por todas as buscas do processo.
+_client = None
+_cache = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class ItisError(Exception):
+    '''Falha de comunicação com o ITIS.'''
+    pass
+
+
+def get_client():
+    '''Retorna cliente SOAP do ITIS, lendo o WSDL só na primeira vez.
+
+    Clientes do suds não podem ser usados por várias threads ao mesmo tempo,
+    então cada thread recebe uma cópia do cliente compartilhado.
+    '''
+    global _client
+    client = getattr(_local, 'client', None)
+    if client is None:
+        with _lock:
+            if _client is None:
+                print('Iniciando contato com ITIS.')
+                _client = Client(WSDL_URL)
+        client = _local.client = _client.clone()
+    return client
+
+
+def get_cache():
+    '''Retorna cache em disco das respostas do ITIS.'''
+    global _cache
+    if _cache is None:
+        _cache = FileCache(
+            getattr(settings, 'ITIS_CACHE_DIR', 'cache/itis'),
+            getattr(settings, 'ITIS_CACHE_TTL', 30 * 24 * 60 * 60))
+    return _cache
+
+
+class Record:
+    '''Cópia de uma resposta do suds que pode ser guardada em cache.
+
+    Como nos objetos do suds, campos ausentes valem None.
+    '''
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
 
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+
+def to_record(value):
+    '''Converte resposta do suds em Records, listas e unicode.'''
+    if isinstance(value, Object):
+        return Record(**dict((str(k), to_record(v)) for k, v in value))
+    elif isinstance(value, list):
+        return [to_record(v) for v in value]
+    elif isinstance(value, basestring):
+        return unicode(value)
+    return value
+
+
+class Itis:
+    '''Interação com o ITIS'''
+    def __init__(self, query, client=None, cache=None):
+        self.url = WSDL_URL
+        self._client = client
+        self.cache = cache or get_cache()
         self.query = query
         self.name = u''
         self.tsn = None
@@ -76,6 +146,23 @@ class Itis:
                             taxon.parentName = unicode(taxon.parentName)
                             taxon.parentTsn = int(taxon.parentTsn)
 
+    @property
+    def client(self):
+        '''Cliente compartilhado, criado só quando for preciso.'''
+        return self._client or get_client()
+
+    def call(self, method, arg):
+        '''Chama método do ITIS, usando a resposta em cache se houver.
+
+        Erros de conexão não são guardados e sobem para quem chamou.
+        '''
+        key = (method, unicode(arg))
+        response = self.cache.get(key)
+        if response is None:
+            response = to_record(getattr(self.client.service, method)(arg))
+            self.cache.set(key, response)
+        return response
+
     def translate(self, rank):
         '''Traduz nome do ranking pra português.'''
 
@@ -174,7 +261,7 @@ class Itis:
         else:
             return rank
 
-    def search_by_scientific_name(self, query, attempt=0):
+    def search_by_scientific_name(self, query):
         '''Busca nome científico no ITIS.
 
         Função é um wrapper para searchByScientificName method:
@@ -217,17 +304,11 @@ class Itis:
         '''
         print('Procurando TSN de %s...' % query)
 
-        # Tenta executar a busca usando o query. Caso a conexão falhe, tenta
-        # novamente.
+        # Novas tentativas ficam a cargo de quem chamou (ver resolve).
         try:
-            results = self.client.service.searchByScientificName(query)
-        except:
-            while attempt < 3:
-                print('Não conseguiu conectar... tentativa=%d' % attempt)
-                attempt += 1
-                self.search_by_scientific_name(query, attempt)
-            print('Terminando conexão. Não está rolando.')
-            results = None
+            results = self.call('searchByScientificName', query)
+        except Exception as e:
+            raise ItisError('Busca por %s falhou: %s' % (query, e))
         return results
 
     def parse_results(self, query):
@@ -256,7 +337,7 @@ class Itis:
                     data['name'] = self.fix(taxon.combinedName)
                     data['tsn'] = taxon.tsn
                     data['valid'] = self.is_valid(taxon.tsn)
-                    print('Táxon com nome exato encontrado: %s' % data['name'])
+                    print(u'Táxon com nome exato encontrado: %s' % data['name'])
                 elif len(theone) > 1:
                     # Checa qual destes táxons é válido.
                     for entry in theone:
@@ -266,14 +347,14 @@ class Itis:
                             data['name'] = self.fix(entry.combinedName)
                             data['tsn'] = entry.tsn
                             data['valid'] = True
-                            print('Táxon válido encontrado: %s' % data['name'])
+                            print(u'Táxon válido encontrado: %s' % data['name'])
                             # Assume que só existe 1 táxon oficialmente aceito.
                             #TODO Verificar isso...
                             break
                     else:
-                        print('Nenhum táxon com nome %s é válido.' % query)
+                        print(u'Nenhum táxon com nome %s é válido.' % query)
                 else:
-                    print('Nenhum táxon com o nome exato %s foi encontrado.' % query)
+                    print(u'Nenhum táxon com o nome exato %s foi encontrado.' % query)
                     #TODO busca pelo gênero.
             else:
                 taxon = results.scientificNames[0]
@@ -281,7 +362,7 @@ class Itis:
                 data['tsn'] = taxon.tsn
                 data['valid'] = self.is_valid(taxon.tsn)
         else:
-            print('Nenhum táxon com o nome de %s foi encontrado.' % query)
+            print(u'Nenhum táxon com o nome de %s foi encontrado.' % query)
             #TODO busca pelo gênero.
         return data
 
@@ -303,10 +384,10 @@ class Itis:
     def get_accepted_names_from_tsn(self, tsn):
         '''Entre táxons com mesmo nome confere qual TSNs é válido.'''
         try:
-            response = self.client.service.getAcceptedNamesFromTSN(tsn)
-        except:
-            print('Problema na conexão para checar a validade de %d' % tsn)
-            response = None
+            response = self.call('getAcceptedNamesFromTSN', tsn)
+        except Exception as e:
+            raise ItisError('Problema na conexão para checar a validade de '
+                            '%s: %s' % (tsn, e))
         return response
 
     def get_full_hierarchy(self, tsn):
@@ -326,10 +407,10 @@ class Itis:
 
         # Tenta se conectar.
         try:
-            hierarchy = self.client.service.getFullHierarchyFromTSN(tsn)
-        except:
-            print('Erro ao puxar a hierarquia de %s, problema na conexão' % tsn)
-            hierarchy = None
+            hierarchy = self.call('getFullHierarchyFromTSN', tsn)
+        except Exception as e:
+            raise ItisError('Erro ao puxar a hierarquia de %s, problema na '
+                            'conexão: %s' % (tsn, e))
         return hierarchy
 
     def parse_hierarchy(self, tsn):
@@ -379,32 +460,121 @@ class Itis:
 
     def update_model(self, taxon):
         '''Update database table with newly fetched records.'''
-        if not self.name:
-            print('No taxon is defined! Aborting...')
-
-        #XXX Melhor se perguntar se o táxon é válido, ou não?
-
-        # Update parents.
-        if self.parents:
-            for parent in self.parents:
-                print('Atualizando %s...' % parent.taxonName)
-                above, new = Taxon.objects.get_or_create(name=parent.taxonName)
-                above.rank = parent.rankName
-                above.tsn = parent.tsn
-                if parent.parentName:
-                    above.parent = Taxon.objects.get(name=parent.parentName)
-                above.save()
-                print('%s salvo!' % above.name)
-
-        # Atualiza o táxon em questão.
-        print('Atualizando %s...' % self.name)
-        taxon.rank = self.rank
-        taxon.tsn = self.tsn
-        if self.parent:
-            taxon.parent = Taxon.objects.get(name=self.parent['name'])
-        taxon.save()
-        print('%s salvo!' % self.name)
-        return taxon
+        merge_hierarchies([(taxon, self)])
+        return Taxon.objects.get(pk=taxon.pk)
+
+
+def resolve(name, attempts=3, backoff=1.0, **kwargs):
+    '''Busca táxon no ITIS, tentando de novo com espera crescente.
+
+    Espera backoff, 2 * backoff, 4 * backoff... segundos entre tentativas que
+    falharam na conexão. Retorna instância de Itis ou None.
+    '''
+    for attempt in range(attempts):
+        try:
+            return Itis(name, **kwargs)
+        except ItisError as e:
+            if attempt + 1 == attempts:
+                print('Desistindo de %s: %s' % (name, e))
+                return None
+            delay = backoff * 2 ** attempt
+            print('%s Nova tentativa em %.1fs...' % (e, delay))
+            time.sleep(delay)
+        except Exception as e:
+            print('Erro ao processar %s: %s' % (name, e))
+            return None
+
+
+def resolve_taxa(names, workers=ITIS_WORKERS, **kwargs):
+    '''Busca vários táxons no ITIS ao mesmo tempo.
+
+    Usa no máximo workers threads; argumentos extras vão para resolve().
+    Retorna dicionário com nome e instância de Itis (ou None).
+    '''
+    names = sorted(set(names))
+    if not names:
+        return {}
+    pool = ThreadPool(min(workers, len(names)))
+    try:
+        results = pool.map(lambda name: resolve(name, **kwargs), names)
+    finally:
+        pool.close()
+        pool.join()
+    # Sem isso, respostas de nomes que não são buscados de novo ficariam para
+    # sempre no cache.
+    (kwargs.get('cache') or get_cache()).purge()
+    return dict(zip(names, results))
+
+
+def update_taxa(resolved):
+    '''Grava hierarquias buscadas por resolve_taxa no banco.
+
+    Retorna lista dos táxons atualizados.
+    '''
+    found = dict((name, itis) for name, itis in resolved.iteritems() if itis)
+    taxa = Taxon.objects.filter(name__in=found.keys())
+    lookups = [(taxon, found[taxon.name]) for taxon in taxa]
+    merge_hierarchies(lookups)
+    return list(Taxon.objects.filter(name__in=found.keys()))
+
+
+def merge_hierarchies(lookups):
+    '''Grava de uma vez as hierarquias de vários táxons.
+
+    Recebe pares (táxon, instância de Itis). Os táxons envolvidos (ancestrais
+    inclusos) são lidos numa só consulta e apenas os novos ou alterados são
+    salvos, dos mais altos para os mais baixos. A árvore do MPTT é
+    recalculada uma vez só no final.
+    '''
+    # Estado desejado: nome -> (rank, tsn, nome do pai).
+    wanted = {}
+    for taxon, itis in lookups:
+        if not itis.name:
+            print(u'Nenhum táxon definido para %s, pulando...' % taxon.name)
+            continue
+        for parent in itis.parents:
+            wanted[parent.taxonName] = (parent.rankName, parent.tsn,
+                                        parent.parentName or None)
+        wanted[taxon.name] = (itis.rank, itis.tsn, itis.parent.get('name'))
+    if not wanted:
+        return
+
+    names = set(wanted)
+    names.update([parent for rank, tsn, parent in wanted.values() if parent])
+    existing = dict((taxon.name, taxon) for taxon in
+                    Taxon.objects.filter(name__in=names))
+
+    def depth(name, seen=()):
+        '''Número de ancestrais de name conhecidos em wanted.'''
+        parent = wanted.get(name, (None, None, None))[2]
+        if not parent or parent in seen:
+            return 0
+        return depth(parent, seen + (name,)) + 1
+
+    with Taxon.objects.delay_mptt_updates():
+        for name in sorted(names, key=lambda name: (depth(name), name)):
+            if name not in wanted:
+                continue
+            rank, tsn, parent_name = wanted[name]
+            tsn = tsn and int(tsn) or None
+            taxon = existing.get(name)
+            if taxon is None:
+                taxon = Taxon(name=name)
+            parent_id = taxon.parent_id
+            if parent_name:
+                if parent_name in existing:
+                    parent_id = existing[parent_name].pk
+                else:
+                    print('Pai %s de %s não existe!' % (parent_name, name))
+            if (taxon.pk and taxon.rank == rank and taxon.tsn == tsn and
+                    taxon.parent_id == parent_id):
+                continue
+            print('Atualizando %s...' % name)
+            taxon.rank = rank
+            taxon.tsn = tsn
+            taxon.parent_id = parent_id
+            taxon.save()
+            existing[name] = taxon
 
 
 def main():
@@ -7,21 +7,162 @@
 # Cifonauta keeps a source directory with original image files. Files are
 # linked to the new folder where they will get their unique IDs.
 
+import getopt
+import hashlib
 import os
 import pickle
+import stat
+import sys
+import time
+
+from filestore import FileCache
 
 # List of accepted extensions.
 EXTENSIONS = ( 'jpg', 'jpeg', 'png', 'gif', 'avi', 'mov', 'mp4', 'ogg', 'ogv',
               'dv', 'mpg', 'mpeg', 'flv', 'm2ts', 'wmv', 'txt',)
 
+# Where the manifests of the last scan are kept.
+MANIFEST_DIR = 'cache/links'
+# Part of the manifest keys, changed when the entries change.
+MANIFEST_VERSION = 2
+
+# Bytes read at each end of a file for its digest.
+DIGEST_BLOCK = 65536
+
+# Directories modified less than this many seconds before the scan may still
+# change within the same mtime tick, so their listing is not trusted later.
+RACY_SECONDS = 2
+
+
+def scan(folder, previous=None, links=False, dirty=None):
+    '''Walk folder reusing what did not change since the previous scan.
+
+    The manifest maps each directory to (mtime, files, subdirs), where files
+    maps the names with accepted extensions to (inode, size, mtime, digest),
+    or to the link target if links is True. Adding, removing or renaming an entry
+    changes the mtime of its directory, so directories with the same mtime
+    as in previous are not listed again and their files are not stat'ed or
+    read; only the subdirectories are stat'ed to look for changes below.
+
+    When the caller knows what changed (e.g. from inotify), dirty is the set
+    of directories to look at: they are always listed again, since a file
+    edited in place does not change the mtime of its directory. The others
+    in previous are trusted without even a stat.
+    '''
+    previous = previous or {}
+    manifest = {}
+    now = time.time()
+    pending = [folder]
+    while pending:
+        dirpath = pending.pop()
+        if dirty is not None and dirpath not in dirty and dirpath in previous:
+            entry = previous[dirpath]
+            manifest[dirpath] = entry
+            pending.extend([os.path.join(dirpath, name) for name in entry[2]])
+            continue
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            continue
+        entry = previous.get(dirpath)
+        if (entry is None or entry[0] != mtime or
+                dirty is not None and dirpath in dirty):
+            entry = list_dir(dirpath, links, entry and entry[1])
+            if entry is None:
+                continue
+            if now - mtime < RACY_SECONDS:
+                # Force a new listing next time.
+                mtime = None
+            entry = (mtime,) + entry
+        manifest[dirpath] = entry
+        pending.extend([os.path.join(dirpath, name) for name in entry[2]])
+    return manifest
+
+
+def list_dir(dirpath, links=False, previous=None):
+    '''Return (files, subdirs) of a directory for the manifest.
+
+    Digests in previous (the files of the last listing) are reused for the
+    files that kept inode, size and mtime.
+    '''
+    previous = previous or {}
+    try:
+        names = os.listdir(dirpath)
+    except OSError:
+        return None
+    files, subdirs = {}, []
+    for name in names:
+        path = os.path.join(dirpath, name)
+        try:
+            info = os.lstat(path)
+            if stat.S_ISDIR(info.st_mode):
+                subdirs.append(name)
+                continue
+            if not name.lower().endswith(EXTENSIONS):
+                continue
+            if links:
+                if stat.S_ISLNK(info.st_mode):
+                    files[name] = os.readlink(path)
+                continue
+            if stat.S_ISLNK(info.st_mode):
+                info = os.stat(path)
+        except OSError:
+            # Gone in the meantime or a broken link among the originals.
+            continue
+        entry = (info.st_ino, info.st_size, info.st_mtime)
+        if previous.get(name, ())[:3] == entry:
+            files[name] = previous[name]
+        else:
+            files[name] = entry + (digest(path, info.st_size),)
+    return files, subdirs
+
+
+def digest(path, size):
+    '''Return a SHA-1 of the first and last blocks of a file, or None.
+
+    Reading the ends only keeps the scan fast on large videos; with the size
+    it is enough to tell apart different files that share a name.
+    '''
+    sha1 = hashlib.sha1()
+    try:
+        original = open(path, 'rb')
+        try:
+            sha1.update(original.read(DIGEST_BLOCK))
+            if size > DIGEST_BLOCK:
+                original.seek(max(DIGEST_BLOCK, size - DIGEST_BLOCK))
+                sha1.update(original.read(DIGEST_BLOCK))
+        finally:
+            original.close()
+    except IOError:
+        return None
+    return sha1.hexdigest()
+
+
+def manifest_files(manifest):
+    '''Return {path: entry} of all files in a manifest.'''
+    paths = {}
+    for dirpath, (mtime, files, subdirs) in manifest.iteritems():
+        for name, entry in files.iteritems():
+            paths[os.path.join(dirpath, name)] = entry
+    return paths
+
 
 class LinkManager:
-    '''Handles links and original files.'''
-    def __init__(self):
+    '''Handles links and original files.
+
+    Only files added, moved or removed since the last run are looked at, as
+    recorded by the manifests of both folders. With full=True the manifests
+    are ignored and every link is checked on disk, like the first run. dirty
+    restricts the scan to these source directories (see scan). When not
+    interactive, questions are skipped and left for a run by hand.
+    '''
+    def __init__(self, source=None, full=False, dirty=None, interactive=True):
         # Directory with original files and folder structure.
-        self.source_media = os.path.abspath('source_media/oficial')
+        self.source_media = os.path.abspath(source or 'source_media/oficial')
         # Directory containing links to original files.
         self.linked_media = os.path.abspath('linked_media/oficial')
+        self.full = full
+        self.interactive = interactive
 
         # Check if directories exist.
         if not os.path.isdir(self.linked_media):
@@ -32,41 +173,125 @@ class LinkManager:
         self.broken_links = {}
         self.tofix = {}
         self.lost = {}
-
-        # List with original files.
-        self.sources = self.get_paths(self.source_media)
-
-        # List of linked files.
-        self.linked_paths = self.get_paths(self.linked_media)
+        # Links created or fixed in this run.
+        self.changed = []
+
+        # Directories that may have changed, on both sides.
+        self.source_dirty = self.linked_dirty = None
+        if dirty is not None:
+            self.source_dirty = set([os.path.abspath(path) for path in dirty])
+            self.linked_dirty = set([self.mirror(path) for path in
+                                     self.source_dirty])
+
+        # Manifests of the last run.
+        self.cache = FileCache(MANIFEST_DIR)
+        self.source_key = ('sources', MANIFEST_VERSION, self.source_media)
+        self.linked_key = ('links', MANIFEST_VERSION, self.linked_media)
+        if full:
+            old_sources, old_links = {}, {}
+        else:
+            old_sources = self.cache.get(self.source_key, {})
+            old_links = self.cache.get(self.linked_key, {})
+
+        # Original files.
+        self.source_manifest = scan(self.source_media, old_sources,
+                                    dirty=self.source_dirty)
+        self.source_files = manifest_files(self.source_manifest)
+        self.sources = self.source_files.keys()
+        self.report(self.sources, self.source_media)
+
+        # Originals that changed folder keep their inode.
+        self.old_files = old_files = manifest_files(old_sources)
+        self.moved = self.get_moved(old_files, self.source_files)
+        # Originals by name and by content, to find moved ones at once.
+        self.by_name = {}
+        self.by_content = {}
+        for path, entry in self.source_files.iteritems():
+            self.by_name.setdefault(os.path.basename(path), []).append(path)
+            if entry[3]:
+                self.by_content.setdefault(entry[1:4:2], []).append(path)
+        # Originals edited in place, e.g. with new metadata.
+        self.modified = [path for path, entry in self.source_files.iteritems()
+                         if path in old_files and old_files[path] != entry]
+
+        # Linked files.
+        self.linked_manifest = scan(self.linked_media, old_links, links=True,
+                                    dirty=self.linked_dirty)
+        self.link_targets = manifest_files(self.linked_manifest)
+        self.linked_paths = self.link_targets.keys()
+        self.report(self.linked_paths, self.linked_media)
 
         # Distribute files and links to list variables.
         self.deal_links(self.linked_paths)
 
-    def get_paths(self, folder):
-        '''Recursively search files in the directory.'''
-        filepaths = []
-        for root, dirs, files in os.walk(folder):
-            for filename in files:
-                if filename.lower().endswith(EXTENSIONS):
-                    filepath = os.path.join(root, filename)
-                    filepaths.append(filepath)
-                else:
-                    continue
-            else:
-                continue
-        else:
-            print('%s files in folder %s.' % (len(filepaths), folder))
+    def report(self, filepaths, folder):
+        '''Print how many files were found in the folder.'''
+        print('%s files in folder %s.' % (len(filepaths), folder))
 
         # Is the folder empty?
         if not filepaths:
             print('Empty folder %s?' % folder)
-        return filepaths
+
+    def get_moved(self, old, new):
+        '''Return {old path: new path} of the originals that were moved.'''
+        added = dict((entry[:3], path) for path, entry in new.iteritems()
+                     if path not in old)
+        if old:
+            print('%d new and %d removed original files.' % (
+                len(added), len([path for path in old if path not in new])))
+        moved = {}
+        for path, entry in old.iteritems():
+            # Same inode, size and mtime: a rename, not a new file.
+            if path not in new and entry[:3] in added:
+                moved[path] = added[entry[:3]]
+        return moved
+
+    def update(self):
+        '''Bring the links up to date with the original files.
+
+        Call save() afterwards, once the links are final, to keep the
+        manifests for the next run.
+        '''
+        # Handle broken links.
+        self.handle_broken()
+        self.fixlinks()
+
+        # Handle lost links.
+        self.handle_lost()
+
+        # Add new links.
+        self.add_new()
+
+    def links_to(self, sourcepaths):
+        '''Return the links pointing to any of the original files.'''
+        sourcepaths = set(sourcepaths)
+        return [linkpath for linkpath, target in self.link_targets.iteritems()
+                if target in sourcepaths]
+
+    def mirror(self, dirpath):
+        '''Return the linked_media directory of a source directory.'''
+        relative = os.path.relpath(dirpath, self.source_media)
+        return os.path.normpath(os.path.join(self.linked_media, relative))
+
+    def save(self):
+        '''Store the manifests for the next run.'''
+        # Take in the links changed since the scan.
+        self.linked_manifest = scan(self.linked_media, self.linked_manifest,
+                                    links=True, dirty=self.linked_dirty)
+        self.cache.set(self.source_key, self.source_manifest)
+        self.cache.set(self.linked_key, self.linked_manifest)
 
     def deal_links(self, paths):
-        '''Verify broken links and adds to the right list.'''
+        '''Verify broken links and adds to the right list.
+
+        Links to a known original are healthy; only the others (or all of
+        them in a full run) are checked on disk.
+        '''
         for path in paths:
-            linkpath = os.readlink(path)
-            if self.check_link(linkpath):
+            linkpath = self.link_targets[path]
+            if not self.full and linkpath in self.source_files:
+                self.healthy_links.append(linkpath)
+            elif self.check_link(linkpath):
                 self.healthy_links.append(linkpath)
             else:
                 self.broken_links[path] = linkpath
@@ -80,6 +305,10 @@ class LinkManager:
             print('\nThere are broken links:')
             for k, v in self.broken_links.iteritems():
                 print('\nBROKEN %s -> %s' % (k, v))
+                if v in self.moved:
+                    print('AUTOFIX: Link %s will be fixed.' % self.moved[v])
+                    self.tofix[self.moved[v]] = k
+                    continue
                 matches = self.get_matches(v)
                 # No matches suggests file was deleted.
                 if not matches:
@@ -100,7 +329,10 @@ class LinkManager:
                             self.tofix[match] = k
                             link_found = True
                             break
-                    if not link_found:
+                    if not link_found and not self.interactive:
+                        print('\nSeveral candidates, run linking.py to '
+                              'choose: %s' % k)
+                    elif not link_found:
                         print('\nSelect the correct path:\n')
                         print('\t%s\n' % v)
                         for idx, val in enumerate(matches):
@@ -125,13 +357,19 @@ class LinkManager:
 
 
     def get_matches(self, link):
-        '''Compares broken link destination to the list of original files.'''
-        matches = []
-        for source in self.sources:
-            # Identical names suggest file changed folder.
-            if os.path.basename(link) == os.path.basename(source):
-                matches.append(source)
-        return matches
+        '''Compares broken link destination to the list of original files.
+
+        Identical names suggest file changed folder. If there are several,
+        those with the content the destination had in the last scan are
+        preferred.
+        '''
+        matches = self.by_name.get(os.path.basename(link), [])
+        entry = self.old_files.get(link)
+        if len(matches) > 1 and entry and entry[3]:
+            same = set(self.by_content.get(entry[1:4:2], []))
+            if same.intersection(matches):
+                matches = [match for match in matches if match in same]
+        return list(matches)
 
     def check_link(self, linkpath):
         '''Verifies if symbolic link is broken or not.'''
@@ -165,12 +403,13 @@ class LinkManager:
                 os.remove(final_link)
                 # Create updated symbolic link.
                 os.symlink(sourcepath, final_link)
+                self.changed.append(final_link)
 
-            if self.check_link(final_link):
-                # Needed for the comparison in the add_new function.
-                self.healthy_links.append(sourcepath)
-            else:
-                print('Problems in the new link: %s' % final_link)
+                if self.check_link(final_link):
+                    # Needed for the comparison in the add_new function.
+                    self.healthy_links.append(sourcepath)
+                else:
+                    print('Problems in the new link: %s' % final_link)
         else:
             print('\nNo link to fix...')
 
@@ -190,7 +429,10 @@ class LinkManager:
 
     def handle_lost(self):
         '''Handle lost files.'''
-        if self.lost:
+        if self.lost and not self.interactive:
+            print('\n%s lost files, run linking.py to erase them.' %
+                  len(self.lost))
+        elif self.lost:
             print('\n%s lost files' % len(self.lost))
             for k, v in self.lost.iteritems():
                 print('LOST %s -> %s' % (k, v))
@@ -251,29 +493,25 @@ class LinkManager:
                 try:
                     os.symlink(filepath, linkpath)
                     print('LINK %s -> %s' % (filepath, linkpath))
+                    self.changed.append(linkpath)
                 except:
                     print('Link could not be created: %s -> %s' %
                             (filepath, linkpath))
         else:
             print('\nNo new file.')
 
-def main():
+def main(source=None, full=False):
     print('\nChecking links...')
 
     # Instantiate manager.
-    manager = LinkManager()
-
-    # Handle broken links.
-    manager.handle_broken()
-    manager.fixlinks()
-
-    # Handle lost links.
-    manager.handle_lost()
-
-    # Add new links.
-    manager.add_new()
+    manager = LinkManager(source, full)
+    manager.update()
+    # Remember what was seen for the next run.
+    manager.save()
 
     print('')
 
 if __name__ == '__main__':
-    main()
+    # -f or --full ignores the manifests and rescans everything.
+    opts, args = getopt.getopt(sys.argv[1:], 'f', ['full'])
+    main(args and args[0] or None, bool(opts))
@@ -15,15 +15,24 @@ extrair duração, otimizar, etc.
 Centro de Biologia Marinha da Universidade de São Paulo.
 '''
 
+import hashlib
+import json
 import logging
 import os
+import pickle
 import pyexiv2
 import random
-import re
 import subprocess
+import tempfile
+import time
 
-from shutil import copy2, move
+from contextlib import contextmanager
+from shutil import copy2, move, rmtree
+from filestore import FileCache, Journal
 from iptcinfo import IPTCInfo
+from jpeg_metadata import read_jpeg
+from PIL import Image as PILImage
+from PIL import ImageOps
 
 # Instancia logger.
 logger = logging.getLogger('cifonauta.utils')
@@ -37,7 +46,6 @@ __maintainer__ = 'Bruno Vellutini'
 __email__ = 'organelas@gmail.com'
 __status__ = 'Development'
 
-# build_call
 # process_video
 # create_meta?
 # process image
@@ -51,10 +59,211 @@ __status__ = 'Development'
 #TODO Checar se o FFmpeg está instalado.
 
 
+# Guarda hashes de conteúdo e as chaves com que cada derivado foi gerado.
+RENDER_CACHE_DIR = u'cache/renders'
+_render_cache = None
+
+# Parâmetros das versões web das fotos.
+PHOTO_RENDER = {'size': 800, 'thumb_size': (120, 90), 'quality': 70,
+                # Versões responsivas: larguras e formatos (ver
+                # photo_derivatives).
+                'widths': (320, 510, 800, 1280),
+                # AVIF precisa de um Pillow com o codificador (o 2.7.0 fixado
+                # em requirements.txt não tem).
+                'formats': ('jpeg', 'webp')}
+
+# Reservas de identificadores feitas por rename_file (ver IdAllocator).
+ID_JOURNAL = u'unique_ids.journal'
+_id_allocator = None
+
+# Pasta e extensões das versões responsivas.
+PHOTO_SIZES_DIR = u'site_media/photos/sizes'
+IMAGE_EXTENSIONS = {'jpeg': '.jpg', 'webp': '.webp', 'avif': '.avif'}
+
+# Formatos que o Pillow não salva, já avisados.
+_unsaveable = set()
+
+
+def get_render_cache():
+    '''Retorna o cache dos derivados, criando na primeira vez.'''
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = FileCache(RENDER_CACHE_DIR)
+    return _render_cache
+
+
+def content_hash(filepath):
+    '''SHA-1 dos pixels ou do stream do arquivo, ignorando metadados.
+
+    Em JPEGs os segmentos APPn (EXIF, IPTC, XMP) e COM ficam de fora, então
+    editar só os metadados não muda o hash. Outros formatos entram inteiros.
+    O resultado é memorizado por caminho, tamanho e data de modificação.
+    '''
+    stat = os.stat(filepath)
+    key = ('hash', os.path.abspath(filepath), stat.st_size, stat.st_mtime)
+    cache = get_render_cache()
+    digest = cache.get(key)
+    if digest:
+        return digest
+
+    sha = hashlib.sha1()
+    media = open(filepath, 'rb')
+    try:
+        if media.read(2) == '\xff\xd8':
+            sha.update('\xff\xd8')
+            hash_jpeg_segments(media, sha)
+        else:
+            media.seek(0)
+        # Dados restantes (ou arquivo inteiro se não for JPEG).
+        for block in iter(lambda: media.read(1 << 20), ''):
+            sha.update(block)
+    finally:
+        media.close()
+    digest = sha.hexdigest()
+    cache.set(key, digest)
+    return digest
+
+
+def hash_jpeg_segments(media, sha):
+    '''Passa os segmentos do cabeçalho JPEG para sha, menos APPn e COM.
+
+    Para no início dos dados comprimidos (SOS), que ficam para quem chamou.
+    '''
+    while True:
+        marker = media.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            # JPEG estranho; o resto do arquivo entra inteiro.
+            sha.update(marker)
+            return
+        code = ord(marker[1])
+        length_bytes = media.read(2)
+        if len(length_bytes) < 2:
+            sha.update(marker + length_bytes)
+            return
+        length = (ord(length_bytes[0]) << 8) + ord(length_bytes[1])
+        if 0xe0 <= code <= 0xef or code == 0xfe:
+            media.seek(length - 2, os.SEEK_CUR)
+            continue
+        sha.update(marker + length_bytes + media.read(length - 2))
+        if code == 0xda:
+            return
+
+
+def render_key(filepath, **params):
+    '''Chave de um derivado: conteúdo da fonte mais os parâmetros usados.'''
+    params = sorted(params.items())
+    return hashlib.sha1(content_hash(filepath) + repr(params)).hexdigest()
+
+
+def is_rendered(key, outputs):
+    '''Diz se todos os outputs existem e foram gerados com esta chave.'''
+    cache = get_render_cache()
+    for output in outputs:
+        if not os.path.isfile(output):
+            return False
+        if cache.get(('render', os.path.abspath(output))) != key:
+            return False
+    return True
+
+
+def mark_rendered(key, outputs):
+    '''Registra a chave com que os outputs foram gerados.'''
+    cache = get_render_cache()
+    for output in outputs:
+        cache.set(('render', os.path.abspath(output)), key)
+
+
+def photo_render_key(filepath, watermark=u'marca.png'):
+    '''Chave das versões web de uma foto.'''
+    return render_key(filepath, watermark=content_hash(watermark),
+                      **PHOTO_RENDER)
+
+
+def video_render_key(filepath, watermark=u'marca.png'):
+    '''Chave das versões web e still de um vídeo.'''
+    return render_key(filepath, watermark=content_hash(watermark),
+                      widescreen=filepath.endswith('m2ts'),
+                      audio='comsom' in filepath.split('_'),
+                      video_bitrate='600k', formats=sorted(VIDEO_CODECS),
+                      hls=(HLS_LADDER, HLS_SEGMENT))
+
+
+def video_rendered(filepath):
+    '''Diz se as versões web do vídeo estão em dia com a fonte.'''
+    return is_rendered(video_render_key(filepath),
+                       video_paths(os.path.basename(filepath)).values())
+
+
+class Outputs(dict):
+    '''Caminhos temporários de atomic_outputs, indexados pelo destino.'''
+    def __init__(self):
+        dict.__init__(self)
+        self.finished = set()
+
+    def finish(self, paths):
+        '''Confirma que os temporários destes destinos estão completos.'''
+        self.finished.update(paths)
+
+
+@contextmanager
+def atomic_outputs(paths):
+    '''Fornece caminhos temporários para gerar os arquivos de paths.
+
+    Os temporários ficam na mesma pasta e com a mesma extensão do destino.
+    Quem escreve confirma os que ficaram completos com temps.finish(paths);
+    na saída só esses (se não vazios) são renomeados por cima do destino,
+    então ninguém vê arquivo pela metade. Os outros são apagados, e todos
+    se houver exceção.
+    '''
+    temps = Outputs()
+    try:
+        for path in paths:
+            directory, name = os.path.split(path)
+            fd, temp = tempfile.mkstemp(dir=directory or '.',
+                                        prefix='.%s.' % name,
+                                        suffix=os.path.splitext(name)[1])
+            os.close(fd)
+            temps[path] = temp
+        yield temps
+        for path in temps.finished:
+            temp = temps[path]
+            if os.path.getsize(temp):
+                os.rename(temp, path)
+    finally:
+        for temp in temps.itervalues():
+            if os.path.exists(temp):
+                os.remove(temp)
+
+
+def link_or_copy(source, destination):
+    '''Cria hardlink de source em destination, copiando se não der.
+
+    O link é criado com outro nome e renomeado, substituindo destination de
+    forma atômica.
+    '''
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        # rename() entre links do mesmo arquivo não faz nada.
+        return
+    directory, name = os.path.split(destination)
+    temp = os.path.join(directory, '.%s.%d.link' % (name, os.getpid()))
+    try:
+        os.link(source, temp)
+    except OSError:
+        # Outro sistema de arquivos, por exemplo.
+        copy2(source, temp)
+    os.rename(temp, destination)
+
+
 def read_iptc(abspath, charset='utf-8', new=False):
-    '''Parses IPTC metadata from a photo with iptcinfo.py'''
+    '''Parses IPTC metadata from a photo.
 
-    info = IPTCInfo(abspath, True, charset)
+    JPEG files go through jpeg_metadata, others through iptcinfo.py. Both
+    return an object with the fields in .data.
+    '''
+    try:
+        info = read_jpeg(abspath, charset)
+    except ValueError:
+        info = IPTCInfo(abspath, True, charset)
     if len(info.data) < 4:
         print('IPTC is empty for %s' % abspath)
         return None
@@ -62,214 +271,459 @@ def read_iptc(abspath, charset='utf-8', new=False):
     return info
 
 
-def create_thumb(filepath, destination):
-    '''Cria thumbnail para foto.'''
-    # Confere argumentos.
-    if not os.path.isfile(filepath):
-        logger.critical('%s não é um arquivo válido.', filepath)
-    if not os.path.isdir(destination):
-        logger.critical('%s não é um destino válido.', destination)
+# Codecs por extensão do arquivo de saída.
+VIDEO_CODECS = {
+        '.webm': ['-vcodec', 'libvpx'],
+        '.mp4': ['-vcodec', 'libx264'],
+        '.ogv': ['-vcodec', 'libtheora'],
+        }
+AUDIO_CODECS = {
+        '.mp4': ['-acodec', 'libfaac'],
+        }
+DEFAULT_AUDIO_CODEC = ['-acodec', 'libvorbis']
 
-    # Define nome do thumbnail.
-    filename = os.path.basename(filepath)
 
-    # Checa se nome do arquivo tem pontos.
-    if filename.count('.') > 1:
-        logger.critical('Mais de um "." em %s', filename)
+def transcode(source, outputs, stillpath=None, widescreen=False, audio=True,
+              metadata=None, watermark='marca.png'):
+    '''Converte vídeo para vários formatos decodificando a fonte uma vez só.
+
+    Um único ffmpeg redimensiona o vídeo, insere a marca d'água e divide o
+    resultado (filtro split) entre os arquivos de outputs, com codecs
+    escolhidos pela extensão (.webm, .mp4 ou .ogv). Se stillpath for dado, o
+    primeiro quadro a partir de 1s é salvo como JPG, sem marca d'água.
+
+    Retorna dicionário com os arquivos criados e o tempo em segundos até cada
+    um ficar pronto (pela data de modificação). Levanta IOError se o ffmpeg
+    terminar com erro: os arquivos podem estar pela metade.
+    '''
+    outputs = list(outputs)
+    if widescreen:
+        size, aspect = '512:288', '16:9'
+    else:
+        size, aspect = '512:384', '4:3'
+
+    # Monta o grafo de filtros: scale -> [still] + overlay -> split.
+    n = len(outputs)
+    labels = ['[v%d]' % i for i in range(n)]
+    graph = '[0:v]scale=%s' % size
+    if stillpath:
+        graph += ',split=2[main][still];[main]'
     else:
-        filename = filename.split('.')[0] + '.jpg'
+        graph += '[main];[main]'
+    graph += '[1:v]overlay=0:main_h-overlay_h-0'
+    if n > 1:
+        graph += ',split=%d%s' % (n, ''.join(labels))
+    else:
+        graph += labels[0]
+    if stillpath:
+        graph += ";[still]select='gte(t,1)'[stillout]"
+
+    call = ['ffmpeg', '-y', '-i', source, '-i', watermark,
+            '-filter_complex', graph]
+    for label, output in zip(labels, outputs):
+        extension = os.path.splitext(output)[1]
+        call.extend(['-map', label, '-aspect', aspect, '-b:v', '600k',
+                     '-threads', '0'])
+        call.extend(VIDEO_CODECS[extension])
+        if audio:
+            call.extend(['-map', '0:a?'])
+            call.extend(AUDIO_CODECS.get(extension, DEFAULT_AUDIO_CODEC))
+            call.extend(['-b:a', '128k', '-ac', '2', '-ar', '44100'])
+        else:
+            call.append('-an')
+        if extension == '.mp4':
+            # Índice no começo do arquivo, para tocar antes de baixar tudo.
+            call.extend(['-movflags', '+faststart'])
+        for key, value in (metadata or {}).iteritems():
+            call.extend(['-metadata', u'%s=%s' % (key, value)])
+        call.append(output)
+    if stillpath:
+        call.extend(['-map', '[stillout]', '-aspect', aspect, '-vframes', '1',
+                     '-f', 'image2', stillpath])
+    call = [isinstance(arg, unicode) and arg.encode('utf-8') or arg
+            for arg in call]
+
+    start = time.time()
+    returncode = subprocess.call(call)
+    elapsed = time.time() - start
+    if returncode:
+        raise IOError('ffmpeg terminou com erro %d para %s' % (returncode,
+                                                              source))
+
+    # Só conta arquivos escritos por esta execução.
+    timings = {}
+    for output in outputs + [stillpath]:
+        if output and os.path.isfile(output) and os.path.getsize(output):
+            finished = os.path.getmtime(output) - start
+            if finished >= -1:
+                timings[output] = max(finished, 0)
+                logger.info('%s pronto em %.1fs', output, timings[output])
+            else:
+                logger.warning('%s não foi criado.', output)
+        elif output:
+            logger.warning('%s não foi criado.', output)
+    logger.info('%s convertido em %.1fs (%d arquivos).', source, elapsed,
+            len(timings))
+    return timings
+
 
-    # Define caminho para pasta local.
-    localpath = os.path.join(destination, filename)
+# Degraus das versões HLS: altura, bitrate do vídeo e do áudio (kbit/s).
+HLS_LADDER = ((288, 400, 64), (480, 1000, 96), (720, 2500, 128))
+# Duração dos segmentos, em segundos.
+HLS_SEGMENT = 6
 
-    # Define comando a ser executado.
-    magick_call = [
-            'convert', '-define', 'jpeg:size=200x150', filepath, '-thumbnail',
-            '120x90^', '-gravity', 'center', '-extent', '120x90', localpath
-            ]
 
-    # Executando o ImageMagick
+def hls_ladder(height, ladder=HLS_LADDER):
+    '''Degraus que não ampliam o vídeo; o menor sempre entra.'''
+    steps = [step for step in ladder if step[0] <= height]
+    return steps or list(ladder[:1])
+
+
+def transcode_hls(source, directory, widescreen=False, audio=True,
+                  watermark='marca.png', ladder=HLS_LADDER):
+    '''Cria versões HLS segmentadas em vários bitrates e a playlist mestre.
+
+    Um único ffmpeg decodifica a fonte e gera, para cada degrau da escada
+    (sem passar da altura original), <altura>p.m3u8 com segmentos
+    <altura>p_NNN.ts em H.264/AAC, com a marca d'água e quadros-chave
+    alinhados aos segmentos. master.m3u8 lista todos com banda e resolução.
+
+    Tudo é escrito numa pasta temporária que só substitui directory no fim.
+    Retorna o caminho da playlist mestre ou None se a conversão falhar.
+    '''
     try:
-        subprocess.call(magick_call)
-        logger.debug('Thumb criado em %s', localpath)
-        return localpath
-    except IOError:
-        logger.warning('Erro ao criar thumb %s', localpath)
+        height = probe(source)['height']
+    except ProbeError as e:
+        logger.warning('Não conseguiu ler %s: %s', source, e)
         return None
+    ratio, aspect = widescreen and (16 / 9.0, '16:9') or (4 / 3.0, '4:3')
+    # Largura par, exigida pelo H.264.
+    steps = [(int(round(h * ratio / 2)) * 2, h, video_rate, audio_rate)
+             for h, video_rate, audio_rate in hls_ladder(height or 0, ladder)]
 
+    # Grafo: fonte e marca divididas, cada degrau redimensionado e marcado.
+    n = len(steps)
+    graph = ['[0:v]split=%d%s' % (n, ''.join(['[s%d]' % i for i in range(n)])),
+             '[1:v]split=%d%s' % (n, ''.join(['[m%d]' % i for i in range(n)]))]
+    for i, (width, h, video_rate, audio_rate) in enumerate(steps):
+        graph.append('[s%d]scale=%d:%d[r%d]' % (i, width, h, i))
+        graph.append('[r%d][m%d]overlay=0:main_h-overlay_h-0[v%d]' % (i, i, i))
 
-def build_call(filepath):
-    '''Constrói o subprocesso para converter o vídeo com o FFmpeg.
-    #webm HD
-    ffmpeg -y -i hd.m2ts -i marca.png -metadata title="A WEBM HD" -metadata author="AN AUTHOR"
-    -b:v 600k -threads 0 -acodec libvorbis -b:a 128k -ac 2 -ar 44100 -vcodec libvpx
-    -filter_complex "scale=512x288,overlay=0:main_h-overlay_h-0" hd.webm
-
-    #webm DV
-    ffmpeg -y -i dv.avi -i marca.png -metadata title="A WEBM DV" -metadata author="AN AUTHOR"
-    -b:v 600k -threads 0 -acodec libvorbis -b:a 128k -ac 2 -ar 44100 -vcodec libvpx
-    -filter_complex "scale=512x384,overlay=0:main_h-overlay_h-0" dv.webm
-
-    #ogg HD
-    ffmpeg -y -i hd.m2ts -i marca.png -metadata title="AN OGG HD" -metadata author="AN AUTHOR"
-    -b:v 600k -threads 0 -acodec libvorbis -b:a 128k -ac 2 -ar 44100 -vcodec libtheora
-    -filter_complex "scale=512x288,overlay=0:main_h-overlay_h-0" hd.ogv
-
-    #ogg DV
-    ffmpeg -y -i dv.avi -i marca.png -metadata title="AN OGG DV" -metadata author="AN AUTHOR"
-    -b:v 600k -threads 0 -acodec libvorbis -b:a 128k -ac 2 -ar 44100 -vcodec libtheora
-    -filter_complex "scale=512x384,overlay=0:main_h-overlay_h-0" dv.ogv
-
-    #mp4 HD
-    ffmpeg -y -i hd.m2ts -i marca.png -metadata title="A MP4 HD" -metadata author="AN AUTHOR"
-    -b:v 600k -threads 0 -acodec libfaac -b:a 128k -ac 2 -ar 44100 -vcodec libx264
-    -filter_complex "scale=512x288,overlay=0:main_h-overlay_h-0" hd.mp4
-
-    #mp4 DV
-    ffmpeg -y -i dv.avi -i marca.png -metadata title="A MP4 DV" -metadata author="AN AUTHOR"
-    -b:v 600k -threads 0 -acodec libfaac -b:a 128k -ac 2 -ar 44100 -vcodec libx264
-    -filter_complex "scale=512x384,overlay=0:main_h-overlay_h-0" dv.mp4
-    '''
-    # Get info on file first.
-    infos = get_info(filepath)
-    dimensions = infos['dimensions']
-    width, height = dimensions.split('x')
-    ratio = float(width) / float(height)
-
-    # FFMPEG command.
-    call = [
-            'ffmpeg', '-y', '-i', filepath, '-i', 'marca.png',
-            '-b:v', '600k', '-threads', '0',
-            ]
-    # If ratio is larger, HD dimensions.
-    if ratio > 1.4:
-        call.extend([
-            '-filter_complex', 'overlay=0:main_h-overlay_h-0',
-            '-s', '512x288', '-aspect', '16:9',
-            ])
-    else:
-        call.extend([
-            '-filter_complex', 'overlay=0:main_h-overlay_h-0',
-            '-s', '512x384', '-aspect', '4:3',
-            ])
-
-    # Audio codec
-    if filepath.endswith('mp4'):
-        call.extend(['-acodec', 'libfaac', '-b:a', '128k',
-            '-ac', '2', '-ar', '44100'])
-    else:
-        call.extend(['-acodec', 'libvorbis', '-b:a', '128k',
-            '-ac', '2', '-ar', '44100'])
-
-    # Video codec
-    if filepath.endswith('webm'):
-        call.extend(['-vcodec', 'libvpx'])
-    elif filepath.endswith('mp4'):
-        call.extend(['-vcodec', 'libx264'])
-    if filepath.endswith('ogv'):
-        call.extend(['-vcodec', 'libtheora'])
-
-    return call
-
-def grab_still(filepath):
-    '''Grab video's first frame.'''
-    # Path to still image.
-    stillpath = os.path.splitext(filepath)[0] + '.jpg'
-
-    # Command to be called.
-    if filepath.endswith('m2ts'):
-        ffmpeg_call = [ 'ffmpeg', '-y', '-i', filepath, '-vframes', '1',
-            '-filter_complex', 'scale=512:288', '-aspect', '16:9', '-ss',
-            '1', '-f', 'image2', stillpath ]
+    parent, name = os.path.split(directory.rstrip(os.sep))
+    dir_ready(parent)
+    temp = tempfile.mkdtemp(dir=parent, prefix='.%s.' % name)
+    call = ['ffmpeg', '-y', '-i', source, '-i', watermark,
+            '-filter_complex', ';'.join(graph)]
+    for i, (width, h, video_rate, audio_rate) in enumerate(steps):
+        label = '%dp' % h
+        call.extend(['-map', '[v%d]' % i, '-aspect', aspect,
+                     '-vcodec', 'libx264', '-profile:v', 'main',
+                     '-b:v', '%dk' % video_rate,
+                     '-maxrate', '%dk' % (video_rate * 1.07),
+                     '-bufsize', '%dk' % (video_rate * 2),
+                     '-force_key_frames', 'expr:gte(t,n_forced*%d)' %
+                     HLS_SEGMENT, '-sc_threshold', '0', '-threads', '0'])
+        if audio:
+            call.extend(['-map', '0:a?'])
+            call.extend(AUDIO_CODECS['.mp4'])
+            call.extend(['-b:a', '%dk' % audio_rate, '-ac', '2',
+                         '-ar', '44100'])
+        else:
+            call.append('-an')
+        call.extend(['-f', 'hls', '-hls_time', str(HLS_SEGMENT),
+                     '-hls_playlist_type', 'vod', '-hls_segment_filename',
+                     os.path.join(temp, label + '_%03d.ts'),
+                     os.path.join(temp, label + '.m3u8')])
+    call = [isinstance(arg, unicode) and arg.encode('utf-8') or arg
+            for arg in call]
+
+    start = time.time()
+    returncode = subprocess.call(call)
+    playlists = [os.path.join(temp, '%dp.m3u8' % step[1]) for step in steps]
+    if returncode or not all([os.path.isfile(p) for p in playlists]):
+        logger.warning('HLS de %s falhou (ffmpeg terminou com %d).', source,
+                returncode)
+        rmtree(temp, ignore_errors=True)
+        return None
+
+    master = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for width, h, video_rate, audio_rate in steps:
+        bandwidth = (video_rate + (audio and audio_rate or 0)) * 1100
+        master.append('#EXT-X-STREAM-INF:BANDWIDTH=%d,RESOLUTION=%dx%d' % (
+            bandwidth, width, h))
+        master.append('%dp.m3u8' % h)
+    master_file = open(os.path.join(temp, 'master.m3u8'), 'wb')
+    master_file.write('\n'.join(master) + '\n')
+    master_file.close()
+    os.chmod(temp, 0755)
+
+    # Troca a pasta antiga pela nova.
+    if os.path.isdir(directory):
+        old = tempfile.mkdtemp(dir=parent, prefix='.%s.old.' % name)
+        os.rename(directory, os.path.join(old, name))
+        os.rename(temp, directory)
+        rmtree(old, ignore_errors=True)
     else:
-        ffmpeg_call = ['ffmpeg', '-y', '-i', filepath, '-vframes', '1',
-            '-filter_complex', 'scale=512:384', '-ss', '1', '-f', 'image2',
-            stillpath]
+        os.rename(temp, directory)
+    logger.info('HLS de %s pronto em %.1fs (%d versões).', source,
+            time.time() - start, len(steps))
+    return os.path.join(directory, 'master.m3u8')
+
+
+# Pastas dos vídeos convertidos e seus thumbnails.
+VIDEO_SITE_DIR = u'site_media/videos'
+VIDEO_HLS_DIR = u'site_media/videos/hls'
+VIDEO_SITE_THUMB_DIR = u'site_media/videos/thumbs'
+VIDEO_LOCAL_DIR = u'local_media/videos'
+VIDEO_LOCAL_THUMB_DIR = u'local_media/videos/thumbs'
+
+
+def video_paths(filename):
+    '''Retorna caminhos no site das versões web, thumb e still do vídeo.
+
+    As chaves são os campos correspondentes do modelo Video.
+    '''
+    stem = filename.split('.')[0]
+    return {
+            'webm_filepath': os.path.join(VIDEO_SITE_DIR, stem + '.webm'),
+            'mp4_filepath': os.path.join(VIDEO_SITE_DIR, stem + '.mp4'),
+            'ogg_filepath': os.path.join(VIDEO_SITE_DIR, stem + '.ogv'),
+            'thumb_filepath': os.path.join(VIDEO_SITE_THUMB_DIR, stem + '.jpg'),
+            'large_thumb': os.path.join(VIDEO_SITE_THUMB_DIR,
+                                        stem + '_still.jpg'),
+            'manifest_filepath': os.path.join(VIDEO_HLS_DIR, stem,
+                                              'master.m3u8'),
+            }
+
+
+def site_relative(path):
+    '''Remove a pasta site_media do caminho, como guardado no banco.'''
+    return os.path.relpath(path, 'site_media')
+
+
+def process_video(source_filepath, title=u'', author=u''):
+    '''Redimensiona o vídeo, inclui marca d'água e comprime.
+
+    Todas as versões e o still saem de uma única execução do ffmpeg (ver
+    transcode); as versões HLS saem de uma segunda (ver transcode_hls).
+    Retorna os caminhos no site das versões web criadas (incluindo
+    manifest_filepath, a playlist HLS), do thumb e do still (None, None,
+    None se nada foi criado).
+    '''
+    #FIXME O que fazer quando vídeos forem menores que isso?
+    logger.info('Processando o vídeo %s', source_filepath)
+    dir_ready(VIDEO_SITE_DIR, VIDEO_SITE_THUMB_DIR, VIDEO_LOCAL_DIR,
+              VIDEO_LOCAL_THUMB_DIR)
+    site_paths = video_paths(os.path.basename(source_filepath))
+    local_paths = {}
+    for field in ('webm_filepath', 'mp4_filepath', 'ogg_filepath'):
+        local_paths[field] = os.path.join(
+            VIDEO_LOCAL_DIR, os.path.basename(site_paths[field]))
+    still_localpath = os.path.join(
+        VIDEO_LOCAL_THUMB_DIR, os.path.basename(site_paths['large_thumb']))
+
+    # Nada a fazer se as versões já saíram deste conteúdo e parâmetros.
+    key = video_render_key(source_filepath)
+    outputs = site_paths.values()
+    if is_rendered(key, outputs):
+        logger.info('Versões de %s em dia, pulando conversão.',
+                source_filepath)
+        web_paths = dict((field, site_paths[field]) for field in local_paths)
+        web_paths['manifest_filepath'] = site_paths['manifest_filepath']
+        return (web_paths, site_paths['thumb_filepath'],
+                site_paths['large_thumb'])
 
-    # Executing ffmpeg.
+    #TODO Achar um jeito mais confiável de saber se é HD...
+    # Exemplo para habilitar som no vídeo: filepath_comsom_.avi
+    # Arquivos são escritos uma vez só, direto no site; local_media ganha
+    # hardlinks.
+    fields = local_paths.keys()
     try:
-        subprocess.call(ffmpeg_call)
-        logger.debug('Still criado em %s', stillpath)
-        return stillpath
-    except IOError:
-        logger.warning('Erro ao criar still %s', stillpath)
-        return None, None
-
-
-def create_still(filepath, destination):
-    '''Cria still para o vídeo e thumbnail em seguida.'''
-    # Confere argumentos.
-    if not os.path.isfile(filepath):
-        logger.critical('%s não é um arquivo válido.', filepath)
-    if not os.path.isdir(destination):
-        logger.critical('%s não é um destino válido.', destination)
-
-    # Define nome do thumbnail.
-    filename = os.path.basename(filepath)
-
-    # Checa se nome do arquivo tem pontos.
-    if filename.count('.') > 1:
-        logger.critical('Mais de um "." em %s', filename)
+        with atomic_outputs([site_paths[field] for field in fields] +
+                            [site_paths['large_thumb'],
+                             site_paths['thumb_filepath']]) as temps:
+            timings = transcode(source_filepath,
+                                [temps[site_paths[field]] for field in fields],
+                                temps[site_paths['large_thumb']],
+                                widescreen=source_filepath.endswith('m2ts'),
+                                audio='comsom' in source_filepath.split('_'),
+                                metadata={'title': title, 'author': author})
+            finished = [path for path, temp in temps.iteritems()
+                        if temp in timings]
+            still_temp = temps[site_paths['large_thumb']]
+            if still_temp in timings:
+                # Thumbnail é feito a partir do still.
+                save_thumb(still_temp, temps[site_paths['thumb_filepath']])
+                finished.append(site_paths['thumb_filepath'])
+            temps.finish(finished)
+    except (OSError, IOError):
+        logger.warning('Erro na conversão de %s.', source_filepath)
+        return None, None, None
+
+    web_paths = {}
+    for field in fields:
+        site_path = site_paths[field]
+        if temps[site_path] not in timings:
+            logger.warning('Processamento de %s não funcionou!', site_path)
+            continue
+        link_or_copy(site_path, local_paths[field])
+        web_paths[field] = site_path
+    if not web_paths:
+        return None, None, None
+    logger.info('%s convertido com sucesso!', source_filepath)
+    complete = len(web_paths) == len(fields)
+
+    # Escada de bitrates para streaming adaptativo; as versões acima ficam
+    # como alternativa para navegadores sem HLS.
+    manifest = transcode_hls(source_filepath,
+            os.path.dirname(site_paths['manifest_filepath']),
+            widescreen=source_filepath.endswith('m2ts'),
+            audio='comsom' in source_filepath.split('_'))
+    if manifest:
+        web_paths['manifest_filepath'] = manifest
     else:
-        thumbname = filename.split('.')[0] + '.jpg'
-        stillname = filename.split('.')[0] + '_still.jpg'
-
-    # Define caminho para pasta local.
-    thumbpath = os.path.join(destination, thumbname)
-    stillpath = os.path.join(destination, stillname)
-
-    # Define comando a ser executado.
-    if filepath.endswith('m2ts'):
-        ffmpeg_call = [
-                'ffmpeg', '-y', '-i', filepath, '-vframes', '1', '-filter_complex',
-                'scale=512:288', '-aspect', '16:9', '-ss', '1', '-f', 'image2',
-                stillpath
-                ]
+        complete = False
+
+    if os.path.isfile(site_paths['large_thumb']):
+        link_or_copy(site_paths['large_thumb'], still_localpath)
+        if complete:
+            mark_rendered(key, outputs)
     else:
-        ffmpeg_call = [
-                'ffmpeg', '-y', '-i', filepath, '-vframes', '1', '-filter_complex',
-                'scale=512:384', '-ss', '1', '-f', 'image2', stillpath
-                ]
+        logger.warning('Não conseguiu criar thumb ou still em %s',
+                VIDEO_SITE_THUMB_DIR)
 
-    # Executando o ffmpeg
-    try:
-        subprocess.call(ffmpeg_call)
-        logger.debug('Still criado em %s', stillpath)
-        # Copia still para servir de template para thumb.
-        copy2(stillpath, thumbpath)
-        # Cria thumbnail normal.
-        thumbpath = create_thumb(thumbpath, destination)
-        return thumbpath, stillpath
-    except IOError:
-        logger.warning('Erro ao criar still %s', stillpath)
-        return None, None
-
-def convert_to_web(filepath, finalpath):
-    '''Redimensiona e otimiza fotos para a rede.'''
-    convert_call = ['convert', filepath, '-density', '72', '-format', 'jpg',
-            '-quality', '70', '-resize', '800x800>', finalpath]
-    try:
-        subprocess.call(convert_call)
-        logger.debug('%s processado com sucesso.', finalpath)
-        return finalpath
-    except:
-        logger.critical('Erro ao converter %s', filepath)
-        return None
+    return web_paths, site_paths['thumb_filepath'], site_paths['large_thumb']
+
+
+# Marcas d'água já abertas neste processo, por caminho.
+_watermarks = {}
+
+
+def load_watermark(path=u'marca.png'):
+    '''Abre a marca d'água uma vez só por processo.'''
+    if path not in _watermarks:
+        mark = PILImage.open(path)
+        _watermarks[path] = mark.convert('RGBA')
+    return _watermarks[path]
+
+
+def process_image(filepath, web_path, thumb_path=None, derivatives=(),
+                  size=PHOTO_RENDER['size'],
+                  thumb_size=PHOTO_RENDER['thumb_size'],
+                  quality=PHOTO_RENDER['quality'], watermark=u'marca.png'):
+    '''Cria versão web com marca d'água e thumbnail lendo a foto uma vez.
+
+    Não usa o ImageMagick: a foto é decodificada em modo draft (o JPEG já sai
+    reduzido por 1/2, 1/4 ou 1/8, sem ficar menor que o necessário) e todas as
+    versões saem da mesma imagem em memória, incluindo as versões responsivas
+    de derivatives (ver photo_derivatives). Levanta IOError se a foto não
+    puder ser lida.
+    '''
+    largest = max([size] + [d['width'] for d in derivatives])
+    image = PILImage.open(filepath)
+    image.draft('RGB', (largest, largest))
+    image = image.convert('RGB')
+
+    # Versão web: reduz para caber em size x size e põe a marca embaixo à
+    # esquerda.
+    web = image.copy()
+    web.thumbnail((size, size), PILImage.ANTIALIAS)
+    mark = load_watermark(watermark)
+    web.paste(mark, (0, web.size[1] - mark.size[1]), mark)
+    web.save(web_path, 'JPEG', quality=quality, dpi=(72, 72))
+    logger.debug('%s processado com sucesso.', web_path)
+
+    # Versões responsivas, com a marca na mesma proporção da versão web.
+    for derivative in derivatives:
+        resized = image.resize((derivative['width'], derivative['height']),
+                               PILImage.ANTIALIAS)
+        scale = float(derivative['width']) / web.size[0]
+        scaled_mark = mark.resize((max(int(mark.size[0] * scale), 1),
+                                   max(int(mark.size[1] * scale), 1)),
+                                  PILImage.ANTIALIAS)
+        resized.paste(scaled_mark, (0, resized.size[1] - scaled_mark.size[1]),
+                      scaled_mark)
+        resized.save(derivative['path'], derivative['format'].upper(),
+                     quality=quality)
+        logger.debug('Versão %s criada.', derivative['path'])
+
+    if thumb_path:
+        save_thumb(image, thumb_path, thumb_size)
+    return web_path, thumb_path
 
-def watermarker(filepath):
-    '''Insere marca d'água em foto.'''
-    # Arquivo com marca d'água.
-    watermark = u'marca.png'
-    # Constrói chamada para canto esquerdo embaixo.
-    mark_call = ['composite', '-gravity', 'southwest', watermark, filepath,
-            filepath]
+
+def photo_derivatives(filename, source_size,
+                      widths=PHOTO_RENDER['widths'],
+                      formats=PHOTO_RENDER['formats']):
+    '''Lista as versões responsivas de uma foto com as dimensões source_size.
+
+    Cada versão é um dicionário com width, height, format e path (no site).
+    Larguras maiores que a original não são criadas (se todas forem, fica só
+    a original) e formatos que o Pillow não sabe salvar são ignorados.
+    '''
+    source_width, source_height = source_size
+    steps = [width for width in widths if width <= source_width]
+    if not steps:
+        steps = [source_width]
+    stem = os.path.splitext(filename)[0]
+    derivatives = []
+    for image_format in saveable_formats(formats):
+        for width in steps:
+            height = max(int(round(source_height * width /
+                                   float(source_width))), 1)
+            derivatives.append({
+                'width': width,
+                'height': height,
+                'format': image_format,
+                'path': os.path.join(PHOTO_SIZES_DIR, '%s_%d%s' % (
+                    stem, width, IMAGE_EXTENSIONS[image_format])),
+                })
+    return derivatives
+
+
+def saveable_formats(formats):
+    '''Formatos de formats que esta instalação do Pillow consegue salvar.'''
+    PILImage.init()
+    saveable = []
+    for image_format in formats:
+        if image_format.upper() in PILImage.SAVE:
+            saveable.append(image_format)
+        elif image_format not in _unsaveable:
+            _unsaveable.add(image_format)
+            logger.warning('Pillow não salva %s, versões puladas.',
+                           image_format)
+    return saveable
+
+
+def save_thumb(image, thumb_path, thumb_size=PHOTO_RENDER['thumb_size']):
+    '''Salva thumbnail da imagem (PIL ou caminho) no tamanho exato.
+
+    Preenche thumb_size e corta o excesso pelo centro.
+    '''
+    if not hasattr(image, 'size'):
+        image = PILImage.open(image)
+        image.draft('RGB', (thumb_size[0] * 2, thumb_size[1] * 2))
+        image = image.convert('RGB')
+    thumb = ImageOps.fit(image, thumb_size, PILImage.ANTIALIAS)
+    thumb.save(thumb_path, 'JPEG', quality=90)
+    logger.debug('Thumb criado em %s', thumb_path)
+    return thumb_path
+
+
+def read_photo_meta(filepath, charset='utf-8'):
+    '''Lê IPTC, data e GPS da foto abrindo o arquivo uma vez só.
+
+    Retorna (iptc, data, gps), onde iptc é o dicionário IPTCInfo.data e data
+    e gps saem como em get_date e get_gps. Arquivos que não são JPEG usam
+    iptcinfo.py e pyexiv2, como antes.
+    '''
     try:
-        subprocess.call(mark_call)
-        logger.debug('Marca adicionada em %s', filepath)
-        return True
-    except:
-        logger.warning('Erro ao adicionar marca em %s', filepath)
-        return False
+        meta = read_jpeg(filepath, charset)
+        iptc, exif = meta.data, meta.exif
+    except ValueError:
+        iptc = IPTCInfo(filepath, True, charset).data
+        exif = get_exif(filepath)
+    return iptc, get_date(exif), get_gps(exif)
 
 def get_exif(filepath):
     '''Extrai o exif da foto usando o pyexiv2 0.3.0.'''
@@ -278,19 +732,24 @@ def get_exif(filepath):
     exif.read()
     return exif
 
+def exif_value(exif, key):
+    '''Valor de uma tag do EXIF do pyexiv2 ou do jpeg_metadata.'''
+    tag = exif[key]
+    return getattr(tag, 'value', tag)
+
 def get_exif_date(exif):
     '''Extrai a data em que foi criada a foto do EXIF.'''
     try:
-        date = exif['Exif.Photo.DateTimeOriginal']
+        date = exif_value(exif, 'Exif.Photo.DateTimeOriginal')
     except:
         try:
-            date = exif['Exif.Photo.DateTimeDigitized']
+            date = exif_value(exif, 'Exif.Photo.DateTimeDigitized')
         except:
             try:
-                date = exif['Exif.Image.DateTime']
+                date = exif_value(exif, 'Exif.Image.DateTime')
             except:
                 return False
-    return date.value
+    return date
 
 def get_date(exif):
     '''Retorna a data da foto já pronta para metadados.'''
@@ -314,18 +773,18 @@ def get_gps(exif):
 
     try:
         # Latitude.
-        gps['latref'] = exif['Exif.GPSInfo.GPSLatitudeRef'].value
-        gps['latdeg'] = exif['Exif.GPSInfo.GPSLatitude'].value[0]
-        gps['latmin'] = exif['Exif.GPSInfo.GPSLatitude'].value[1]
-        gps['latsec'] = exif['Exif.GPSInfo.GPSLatitude'].value[2]
+        gps['latref'] = exif_value(exif, 'Exif.GPSInfo.GPSLatitudeRef')
+        gps['latdeg'] = exif_value(exif, 'Exif.GPSInfo.GPSLatitude')[0]
+        gps['latmin'] = exif_value(exif, 'Exif.GPSInfo.GPSLatitude')[1]
+        gps['latsec'] = exif_value(exif, 'Exif.GPSInfo.GPSLatitude')[2]
         latitude = get_decimal(gps['latref'], gps['latdeg'], gps['latmin'],
                 gps['latsec'])
 
         # Longitude.
-        gps['longref'] = exif['Exif.GPSInfo.GPSLongitudeRef'].value
-        gps['longdeg'] = exif['Exif.GPSInfo.GPSLongitude'].value[0]
-        gps['longmin'] = exif['Exif.GPSInfo.GPSLongitude'].value[1]
-        gps['longsec'] = exif['Exif.GPSInfo.GPSLongitude'].value[2]
+        gps['longref'] = exif_value(exif, 'Exif.GPSInfo.GPSLongitudeRef')
+        gps['longdeg'] = exif_value(exif, 'Exif.GPSInfo.GPSLongitude')[0]
+        gps['longmin'] = exif_value(exif, 'Exif.GPSInfo.GPSLongitude')[1]
+        gps['longsec'] = exif_value(exif, 'Exif.GPSInfo.GPSLongitude')[2]
         longitude = get_decimal(gps['longref'], gps['longdeg'], gps['longmin'],
                 gps['longsec'])
 
@@ -353,39 +812,139 @@ def get_decimal(ref, deg, min, sec):
     return decimal
 
 
+PROBE_CACHE_DIR = u'cache/probes'
+_probe_cache = None
+
+
+class ProbeError(Exception):
+    '''O ffprobe não conseguiu ler o arquivo.'''
+    pass
+
+
+def get_probe_cache():
+    '''Retorna o cache das inspeções do ffprobe, criando na primeira vez.'''
+    global _probe_cache
+    if _probe_cache is None:
+        _probe_cache = FileCache(PROBE_CACHE_DIR)
+    return _probe_cache
+
+
+def probe(filepath):
+    '''Inspeciona o arquivo com ffprobe e retorna dicionário com os campos.
+
+    Chaves: duration (segundos, float), bitrate (bits/s), format, size e os
+    dados do primeiro stream de vídeo (codec, width, height, fps), além de
+    streams, a lista de todos os streams com index, type, codec, bitrate e
+    os campos de vídeo (width, height, fps) ou áudio (channels,
+    sample_rate). Campos desconhecidos ficam None.
+
+    O resultado é memorizado por caminho, tamanho e data de modificação, num
+    cache em disco compartilhado por todos os scripts. Levanta ProbeError se
+    o arquivo não puder ser lido.
+    '''
+    try:
+        stat = os.stat(filepath)
+    except OSError as e:
+        raise ProbeError(u'%s: %s' % (filepath, e))
+    key = ('probe', os.path.abspath(filepath), stat.st_size, stat.st_mtime)
+    cache = get_probe_cache()
+    info = cache.get(key)
+    if info is not None:
+        return info
+
+    call = ['ffprobe', '-v', 'error', '-print_format', 'json',
+            '-show_format', '-show_streams', filepath]
+    call = [isinstance(arg, unicode) and arg.encode('utf-8') or arg
+            for arg in call]
+    try:
+        process = subprocess.Popen(call, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+    except OSError as e:
+        raise ProbeError(u'ffprobe: %s' % e)
+    if process.returncode:
+        raise ProbeError(u'%s: %s' % (filepath, errors.strip()))
+    try:
+        data = json.loads(output)
+    except ValueError:
+        raise ProbeError(u'%s: saída inválida do ffprobe' % filepath)
+
+    media_format = data.get('format', {})
+    streams = [parse_stream(stream) for stream in data.get('streams', [])]
+    video = [stream for stream in streams if stream['type'] == 'video']
+    video = video and video[0] or {}
+    info = {
+            'duration': to_number(media_format.get('duration'), float),
+            'bitrate': to_number(media_format.get('bit_rate')),
+            'format': media_format.get('format_name'),
+            'size': stat.st_size,
+            'codec': video.get('codec'),
+            'width': video.get('width'),
+            'height': video.get('height'),
+            'fps': video.get('fps'),
+            'streams': streams,
+            }
+    cache.set(key, info)
+    return info
+
+
+def parse_stream(stream):
+    '''Campos de um stream da saída JSON do ffprobe.'''
+    parsed = {
+            'index': stream.get('index'),
+            'type': stream.get('codec_type'),
+            'codec': stream.get('codec_name'),
+            'bitrate': to_number(stream.get('bit_rate')),
+            }
+    if parsed['type'] == 'video':
+        parsed['width'] = stream.get('width')
+        parsed['height'] = stream.get('height')
+        parsed['fps'] = (frame_rate(stream.get('avg_frame_rate')) or
+                         frame_rate(stream.get('r_frame_rate')))
+    elif parsed['type'] == 'audio':
+        parsed['channels'] = stream.get('channels')
+        parsed['sample_rate'] = to_number(stream.get('sample_rate'))
+    return parsed
+
+
+def to_number(value, kind=int):
+    '''Converte os números que o ffprobe manda como texto (None se não der).'''
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def frame_rate(rate):
+    '''Converte taxa do ffprobe ("30000/1001") em quadros por segundo.'''
+    try:
+        num, den = rate.split('/')
+        return float(num) / float(den) or None
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+
+
 def get_info(video):
-    '''Pega informações do vídeo na marra e retorna dicionário.
+    '''Retorna duração, dimensões e codec do vídeo (ou None se falhar).
 
-    Os valores são extraídos do stderr do ffmpeg usando expressões
-    regulares.
+    Mantém o formato antigo, de quando a saída do ffmpeg era lida com
+    expressões regulares: duração 'HH:MM:SS', dimensões 'LxA'. Ver probe.
     '''
     try:
-        call = subprocess.Popen(['ffmpeg', '-i', video],
-                stderr=subprocess.PIPE)
-    except:
-        logger.warning('Não conseguiu abrir o arquivo %s', video)
+        info = probe(video)
+    except ProbeError as e:
+        logger.warning('Não conseguiu ler o arquivo %s: %s', video, e)
         return None
-    # Necessário converter pra string pra ser objeto permanente.
-    info = str(call.stderr.read())
-    # Encontra a duração do arquivo.
-    length_re = re.search('(?<=Duration: )\d+:\d+:\d+', info)
-    # Encontra o codec e dimensões.
-    precodec_re = re.search('(?<=Video: ).+, .+, \d+x\d+', info)
-    # Processando os outputs brutos.
-    #XXX Melhorar isso e definir o formato oficial dos valores.
-    # Exemplo (guardar em segundos e converter depois):
-    #   >>> import datetime
-    #   >>> str(datetime.timedelta(seconds=666))
-    #   '0:11:06'
-    duration = length_re.group(0)
-    codecs = precodec_re.group(0).split(', ')
-    codec = codecs[0].split(' ')[0]
-    dimensions = codecs[-1]
-    # Salvando valores limpos em um dicionário.
+    if not info['width'] or not info['height']:
+        logger.warning('%s não tem stream de vídeo.', video)
+        return None
+    seconds = int(info['duration'] or 0)
     details = {
-            'duration': duration,
-            'dimensions': dimensions,
-            'codec': codec,
+            'duration': '%02d:%02d:%02d' % (seconds // 3600,
+                                            seconds % 3600 // 60,
+                                            seconds % 60),
+            'dimensions': '%dx%d' % (info['width'], info['height']),
+            'codec': info['codec'],
             }
     return details
 
@@ -402,14 +961,14 @@ def check_file(filepath):
     return media_file
 
 def rename_file(filename, authors):
-    '''Renomeia arquivo com iniciais e identificador.'''
+    '''Renomeia arquivo com iniciais e identificador único.'''
     logger.debug('Renomeando %s', filename)
     if authors:
         initials = get_initials(authors)
     else:
         initials = 'cbm'
-    id = create_id()
-    new_filename = initials + '_' + id + os.path.splitext(filename)[1].lower()
+    name = get_id_allocator().reserve(initials)
+    new_filename = name + os.path.splitext(filename)[1].lower()
     return new_filename
 
 def get_initials(authors):
@@ -425,11 +984,95 @@ def get_initials(authors):
     return initials
 
 def create_id():
-    '''Cria identificador único para nome do arquivo.'''
+    '''Cria identificador aleatório para nome do arquivo.'''
     chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
     id = ''.join([random.choice(chars) for x in xrange(6)])
     return id
 
+
+class IdAllocator:
+    '''Reserva nomes com identificadores que nunca se repetem.
+
+    Os nomes usados vêm do unique_names.pkl (ver dump_filenames_from_db) e do
+    journal com as reservas de todos os processos; ficam em conjuntos, então
+    as consultas não percorrem listas. reserve() lê e grava o journal com
+    trava exclusiva, logo vários processos podem reservar ao mesmo tempo sem
+    repetir identificador. Só na primeira vez, sem journal, os nomes da
+    site_media são registrados nele.
+    '''
+    def __init__(self, pickle_path=u'unique_names.pkl',
+                 journal_path=ID_JOURNAL, site_dir=u'site_media'):
+        # Nomes sem extensão e seus identificadores.
+        self.names = set()
+        self.ids = set()
+        try:
+            names_file = open(pickle_path, 'rb')
+            try:
+                for filename in pickle.load(names_file):
+                    self.add(filename)
+            finally:
+                names_file.close()
+        except IOError:
+            logger.warning('%s não encontrado, use dump_filenames_from_db.',
+                           pickle_path)
+        self.journal = Journal(journal_path)
+        if not os.path.exists(journal_path):
+            self.seed(site_dir)
+        self.refresh()
+
+    def add(self, filename):
+        '''Marca o nome (e seu identificador) como usado.'''
+        name = os.path.splitext(os.path.basename(filename))[0]
+        self.names.add(name)
+        self.ids.add(name.rsplit('_', 1)[-1])
+
+    def refresh(self):
+        '''Lê as reservas feitas por outros processos.'''
+        for record in self.journal.read():
+            self.add(record['name'])
+
+    def seed(self, site_dir):
+        '''Registra no journal os nomes que já estão na site_media.'''
+        with self.journal.locked():
+            if os.path.exists(self.journal.path):
+                # Outro processo chegou antes.
+                return
+            names = set()
+            for root, dirs, files in os.walk(site_dir):
+                for filename in files:
+                    names.add(os.path.splitext(filename)[0])
+            # Tudo ou nada: um journal incompleto não seria semeado de novo.
+            self.journal.create([{'name': name} for name in sorted(names)])
+            logger.info('%d nomes da %s registrados em %s.', len(names),
+                        site_dir, self.journal.path)
+
+    def taken(self, filename):
+        '''Verifica se o nome (sem considerar a extensão) já foi usado.'''
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if name not in self.names:
+            self.refresh()
+        return name in self.names
+
+    def reserve(self, prefix):
+        '''Reserva e retorna um nome prefix_ID com identificador inédito.'''
+        with self.journal.locked():
+            self.refresh()
+            id = create_id()
+            while id in self.ids:
+                id = create_id()
+            name = prefix + '_' + id
+            self.journal.append({'name': name})
+            self.add(name)
+        return name
+
+
+def get_id_allocator():
+    '''Retorna o alocador de identificadores, criando na primeira vez.'''
+    global _id_allocator
+    if _id_allocator is None:
+        _id_allocator = IdAllocator()
+    return _id_allocator
+
 def fix_filename(root, filename):
     '''Checa validade do nome do arquivo.'''
     # Verifica a existência de pontos extras.
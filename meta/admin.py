@@ -55,6 +55,7 @@ admin.site.register(Rights)
 admin.site.register(Sublocation)
 admin.site.register(Reference)
 admin.site.register(TourPosition)
+admin.site.register(TranscodeJob)
 
 # Translation models.
 admin.site.unregister(FlatPage)
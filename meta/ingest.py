@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+'''Helpers shared by the ingest scripts.
+
+Used by both cifonauta.py and the cifonauta management command to talk to the
+database in bulk instead of once per file.
+'''
+
+import logging
+import os
+import pickle
+import time
+
+from itertools import islice
+
+from django.db import transaction
+from filestore import Journal
+from meta.models import (Author, City, Country, Image, Reference, Rights,
+                         Size, Source, State, Sublocation, Tag, Taxon, Video)
+from meta.signals import mark_dirty
+
+logger = logging.getLogger('cifonauta.ingest')
+
+# Metadata models resolved by name, keyed by the field used in get_instance.
+LOOKUP_MODELS = {
+        'author': Author,
+        'source': Source,
+        'tag': Tag,
+        'taxon': Taxon,
+        'size': Size,
+        'sublocation': Sublocation,
+        'city': City,
+        'state': State,
+        'country': Country,
+        'rights': Rights,
+        'reference': Reference,
+        }
+
+
+class MediaIndex:
+    '''In-memory index of the media already in the database.
+
+    Loads the timestamp of every image and video with a single query per
+    model, so that walked files can be classified without touching the
+    database again. Records are keyed by the filename field (default) or, for
+    the older source_media layout, by the name of their web files.
+    '''
+    def __init__(self, by='filename'):
+        self.by = by
+        self.images = {}
+        self.videos = {}
+
+        if by == 'filename':
+            for filename, timestamp in Image.objects.values_list(
+                    'filename', 'timestamp'):
+                self.images[filename] = timestamp
+            for filename, timestamp in Video.objects.values_list(
+                    'filename', 'timestamp'):
+                self.videos[filename] = timestamp
+        elif by == 'web_filepath':
+            for web_filepath, timestamp in Image.objects.values_list(
+                    'web_filepath', 'timestamp'):
+                self.images[os.path.basename(web_filepath)] = timestamp
+            for row in Video.objects.values_list('webm_filepath',
+                                                 'mp4_filepath',
+                                                 'ogg_filepath', 'timestamp'):
+                for web_filepath in row[:3]:
+                    if web_filepath:
+                        stem = os.path.basename(web_filepath).split('.')[0]
+                        self.videos[stem] = row[3]
+        else:
+            raise ValueError('Unknown index key: %s' % by)
+
+        logger.info('Index loaded: %d photos, %d videos.', len(self.images),
+                    len(self.videos))
+
+    def key(self, media):
+        '''Return the key used to find the media in the index.'''
+        if self.by == 'web_filepath' and media.type == 'video':
+            return media.filename.split('.')[0]
+        return media.filename
+
+    def lookup(self, media):
+        '''Compare file and record timestamps.
+
+        Returns False when there is no record, 1 when the file has changed and
+        2 when it has not (same values as Database.search_db).
+        '''
+        if media.type == 'photo':
+            records = self.images
+        else:
+            records = self.videos
+        timestamp = records.get(self.key(media))
+        if timestamp is None:
+            return False
+        # XXX Dirty hack to make naive timestamp.
+        if timestamp.replace(tzinfo=None) != media.timestamp:
+            return 1
+        return 2
+
+    def classify(self, medias):
+        '''Split media in new, changed and unchanged lists.'''
+        new = []
+        changed = []
+        unchanged = []
+        for media in medias:
+            query = self.lookup(media)
+            if not query:
+                new.append(media)
+            elif query == 1:
+                changed.append(media)
+            else:
+                unchanged.append(media)
+        logger.info('%d new, %d changed, %d unchanged.', len(new),
+                    len(changed), len(unchanged))
+        return new, changed, unchanged
+
+
+class LookupCache:
+    '''Per-run cache of metadata instances keyed by type and name.
+
+    Prewarmed with one query per table in LOOKUP_MODELS, so only values that
+    are really new need to reach the database.
+    '''
+    def __init__(self):
+        self.instances = {}
+        # Keys added since the last commit(), dropped by rollback().
+        self.pending = []
+        for table, model in LOOKUP_MODELS.iteritems():
+            self.instances[table] = dict((instance.name, instance) for
+                                         instance in model.objects.all())
+        logger.info('Lookup cache ready: %s', ', '.join(
+            ['%d %s' % (len(v), k) for k, v in self.instances.iteritems()]))
+
+    def get(self, table, value):
+        '''Return cached instance or None.'''
+        return self.instances[table].get(value)
+
+    def add(self, table, instance, value=None):
+        '''Store instance under its name and, optionally, under an alias.'''
+        for key in (instance.name, value):
+            if key is not None and key not in self.instances[table]:
+                self.instances[table][key] = instance
+                self.pending.append((table, key))
+
+    def commit(self):
+        '''Keep the instances added so far.'''
+        self.pending = []
+
+    def rollback(self):
+        '''Forget instances added since the last commit.
+
+        Used when the transaction that created them was rolled back.
+        '''
+        for table, key in self.pending:
+            self.instances[table].pop(key, None)
+        self.pending = []
+
+
+class BadData:
+    '''Corrections for badly written metadata values.
+
+    Loaded once per run from bad_data.pkl plus the journal of corrections
+    appended since, so lookups are plain dictionary accesses. New corrections
+    are appended to the journal instead of rewriting the pickle, which keeps
+    concurrent runs from overwriting each other.
+    '''
+    def __init__(self, pickle_path='bad_data.pkl',
+                 journal_path='bad_data.journal'):
+        self.fixes = {}
+        try:
+            bad_data_file = open(pickle_path, 'rb')
+            bad_data = pickle.load(bad_data_file)
+            bad_data_file.close()
+        except IOError:
+            logger.warning('%s not found, starting with no corrections.',
+                           pickle_path)
+            bad_data = {}
+        for value, fixed in bad_data.iteritems():
+            self.fixes[to_unicode(value)] = to_unicode(fixed)
+        self.journal = Journal(journal_path)
+        self.refresh()
+
+    def refresh(self):
+        '''Load corrections appended by other processes.'''
+        for record in self.journal.read():
+            self.fixes[record['value']] = record['fixed']
+
+    def get(self, value):
+        '''Return the corrected value or None.'''
+        value = to_unicode(value)
+        if value not in self.fixes:
+            self.refresh()
+        return self.fixes.get(value)
+
+    def add(self, value, fixed):
+        '''Record a new correction.'''
+        value = to_unicode(value)
+        fixed = to_unicode(fixed)
+        self.fixes[value] = fixed
+        self.journal.append({'value': value, 'fixed': fixed})
+
+
+def write_batches(items, write, batch_size=1, cache=None):
+    '''Call write(item) for every item, batch_size items per transaction.
+
+    Each item gets its own savepoint, so an error rolls back that item alone;
+    it is logged and the batch goes on. Items are pulled from the iterable
+    before the transaction opens, so slow parsing does not hold it. Instances
+    added to cache by a failed item are forgotten. Returns the lists of
+    written and failed items.
+    '''
+    written = []
+    failed = []
+    items = iter(items)
+    t0 = time.time()
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+        start = time.time()
+        with transaction.atomic():
+            for item in batch:
+                try:
+                    with transaction.atomic():
+                        write(item)
+                except Exception:
+                    logger.exception('Rolled back %r.', item)
+                    failed.append(item)
+                    if cache:
+                        cache.rollback()
+                else:
+                    written.append(item)
+                    if cache:
+                        cache.commit()
+        elapsed = time.time() - start
+        logger.info('Batch of %d written in %.2fs (%.1f files/s).', len(batch),
+                    elapsed, len(batch) / max(elapsed, 0.001))
+
+    elapsed = time.time() - t0
+    logger.info('%d written, %d failed in %.2fs (%.1f files/s, batch size %d).',
+                len(written), len(failed), elapsed,
+                len(written) / max(elapsed, 0.001), batch_size)
+    return written, failed
+
+
+def apply_m2m(entry, field, instances):
+    '''Make the many to many relations of entry match instances.
+
+    Compares against the rows of the through table and issues at most one
+    bulk insert and one delete, nothing at all when the relations are the
+    same. The through table is written directly, without m2m_changed, so the
+    counters of the affected rows are marked here. Returns the primary keys
+    added and removed.
+    '''
+    media = entry._meta.model_name
+    model = LOOKUP_MODELS[field]
+    through = getattr(model, media + 's').through
+    current = set(through.objects.filter(**{media: entry.pk}).values_list(
+        field, flat=True))
+    wanted = set([instance.pk for instance in instances if instance])
+
+    added = wanted - current
+    removed = current - wanted
+    if removed:
+        through.objects.filter(**{media: entry.pk,
+                                  field + '__in': removed}).delete()
+    if added:
+        through.objects.bulk_create([
+            through(**{media + '_id': entry.pk, field + '_id': pk})
+            for pk in added])
+    if added or removed:
+        mark_dirty(model.__name__, added | removed)
+    return added, removed
+
+
+def to_unicode(value):
+    '''Decode UTF-8 byte strings, leave anything else untouched.'''
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
@@ -1,12 +1,17 @@
 from django.core.management.base import BaseCommand, CommandError
-from meta.models import Image, Video
+from meta.models import Image, Taxon, Video
 from optparse import make_option
 from datetime import datetime
-from iptcinfo import IPTCInfo
-from media_utils import check_file, dir_ready, get_exif, get_date, get_gps, get_info
-from meta.models import *
+from media_utils import (ProbeError, check_file, dir_ready, get_info,
+                         read_photo_meta)
+from meta.ingest import (LOOKUP_MODELS, BadData, LookupCache, MediaIndex,
+                         apply_m2m, write_batches)
+from meta.signals import defer_counts, flush_counts
+from multiprocessing import Pool
+from django.db import connection, transaction
+from itis import resolve_taxa, update_taxa
+from sidecar import SIDECAR_FIELDS, read_sidecar, sidecar_path
 import os
-import pickle
 import time
 
 
@@ -24,6 +29,12 @@ class Command(BaseCommand):
             make_option('-m', '--only-movies', action='store_true',
                         dest='videos', default=False,
                         help='Only scan videos.'),
+            make_option('-w', '--workers', action='store', type='int',
+                        dest='workers', default=1,
+                        help='Number of processes parsing file metadata.'),
+            make_option('-b', '--batch-size', action='store', type='int',
+                        dest='batch_size', default=1,
+                        help='Number of files written per transaction.'),
             )
 
     SITE_MEDIA = 'site_media'
@@ -37,11 +48,15 @@ class Command(BaseCommand):
         n = 0
         n_new = 0
         n_updated = 0
+        n_skipped = 0
+        n_failed = 0
 
         # Some variables.
         n_max = options['number']
         only_photos = options['photos']
         only_videos = options['videos']
+        workers = options['workers']
+        batch_size = options['batch_size']
 
         # Initiate database instance.
         cbm = Database()
@@ -63,71 +78,121 @@ class Command(BaseCommand):
             video_folder = Folder(self.SITE_MEDIA_VIDEOS, n_max)
             video_filepaths = video_folder.get_files()
 
-        # Process photos.
-        for path in photo_filepaths:
-            photo = Photo(path)
-            # Search photo in database.
-            query = cbm.search_db(photo)
-            if not query:
-                print(u'NEW FILE: %s.' % photo.filename)
-                photo.create_meta()
-                cbm.update_db(photo)
-                n_new += 1
-            else:
-                if query == 2:
-                    # Entry exists and timestamp has not changed.
-                    print(u'ENTRY UP-TO-DATE! NEXT...')
-                    continue
-                else:
-                    # Timestamps differ.
-                    print(u'UPDATING ENTRY...')
-                    photo.create_meta()
-                    cbm.update_db(photo, update=True)
-                    n_updated += 1
-        n += len(photo_filepaths)
-
-        # Process videos.
-        for path in video_filepaths:
-            video = Movie(path)
-            # Search photo in database.
-            query = cbm.search_db(video)
-            if not query:
-                print(u'NEW FILE: %s.' % video.filename)
-                video.create_meta()
-                cbm.update_db(video)
-                n_new += 1
-            else:
-                if query == 2:
-                    # Entry exists and timestamp has not changed.
-                    print(u'ENTRY UP-TO-DATE! NEXT...')
-                    continue
-                else:
-                    # Timestamps differ.
-                    print(u'UPDATING ENTRY...')
-                    video.create_meta()
-                    cbm.update_db(video, update=True)
-                    n_updated += 1
-        n += len(video_filepaths)
+        medias = [Photo(path) for path in photo_filepaths]
+        medias.extend([Movie(path) for path in video_filepaths])
+        n = len(medias)
+
+        # Compare all files against the database timestamps at once.
+        index = MediaIndex()
+        new, changed, unchanged = index.classify(medias)
+        print(u'%d new, %d changed, %d up-to-date.' % (len(new), len(changed),
+                                                      len(unchanged)))
+        n_skipped = len(unchanged)
+
+        # Select which files need to be parsed.
+        queue = [(media, False) for media in new]
+        queue.extend([(media, True) for media in changed])
+
+        written, failed = ingest(cbm, queue, workers, batch_size)
+        n_new = len([update for media, update in written if not update])
+        n_updated = len(written) - n_new
+        n_failed = len(failed)
 
-        self.stdout.write('%d unique names. -p:%s, -m:%s' % (options['number'],
-                                                             options['photos'],
-                                                             options['videos']))
+        self.stdout.write('%d unique names. -p:%s, -m:%s, -w:%d, -b:%d' % (
+            options['number'], options['photos'], options['videos'],
+            options['workers'], options['batch_size']))
 
         # Statistics.
         print(u'\n%d ANALYZED FILES' % n)
         print(u'%d new' % n_new)
         print(u'%d updated' % n_updated)
+        print(u'%d skipped' % n_skipped)
+        if n_failed:
+            print(u'%d failed' % n_failed)
         t = int(time.time() - t0)
         if t > 60:
             print(u'\nRunning time: ' + str(t / 60) + ' min ' + str(t % 60) + ' s')
         else:
             print(u'\nRunning time: ' + str(t) + ' s')
-        print(u'\n%d analyzed, %d new, %d updated' % (n, n_new, n_updated))
+        print(u'%.1f files/s (batch size %d)' % (len(written) / float(max(t, 1)),
+                                                batch_size))
+        print(u'\n%d analyzed, %d new, %d updated, %d skipped' % (n, n_new,
+                                                                n_updated,
+                                                                n_skipped))
+
+
+def ingest(cbm, queue, workers=1, batch_size=1):
+    '''Parse the queued (media, update) pairs and write them to cbm.
+
+    Metadata is parsed (in parallel, if asked) and written to the database
+    from this process only, batch_size files per transaction. Counters are
+    recomputed once at the end. Returns the lists of written and failed
+    items.
+    '''
+    def write(item):
+        media, update = item
+        if not media.metadata:
+            raise ValueError(u'No metadata for %s' % media.filepath)
+        cbm.update_db(media, update=update)
+
+    defer_counts()
+    try:
+        written, failed = write_batches(parse_queue(queue, workers), write,
+                                        batch_size, cbm.cache)
+        # Taxa created above get their hierarchy before the recount.
+        cbm.resolve_new_taxa()
+    finally:
+        flush_counts()
+    return written, failed
+
+
+def parse_media(item):
+    '''Parse metadata of a queued media file.
+
+    Runs inside the worker processes, so it must not touch the database.
+    '''
+    media, update = item
+    try:
+        media.create_meta()
+    except Exception as e:
+        print(u'Could not parse %s: %s' % (media.filepath, e))
+        media.metadata = None
+    return media, update
+
+
+def parse_queue(queue, workers=1):
+    '''Yield parsed media from the queue, using a process pool if needed.'''
+    if workers < 2 or len(queue) < 2:
+        for item in queue:
+            yield parse_media(item)
+        return
+
+    # Forked workers must not share the database connection.
+    connection.close()
+    pool = Pool(workers)
+    try:
+        for item in pool.imap_unordered(parse_media, queue, chunksize=8):
+            yield item
+    finally:
+        pool.close()
+        pool.join()
+
 
 class Database:
-    '''Database object.'''
-    def __init__(self):
-        pass
+    '''Database object.
+
+    When not interactive, new metadata values without a known correction
+    are not confirmed at the prompt: the file fails and is left for a run
+    by hand.
+    '''
+    def __init__(self, interactive=True):
+        self.interactive = interactive
+        # Metadata instances already in the database.
+        self.cache = LookupCache()
+        # Known corrections for bad metadata values.
+        self.bad_data = BadData()
+        # Names of taxa created in this run, waiting for ITIS.
+        self.new_taxa = set()
 
     def search_db(self, media):
         '''Query database for filename.
@@ -214,8 +279,6 @@ class Database:
                 entry = Image(**media_meta)
             elif media.type == 'video':
                 entry = Video(**media_meta)
-            # Saving is needed to create an ID, necessary for saving remaining metadata.
-            entry.save()
         else:
             if media.type == 'photo':
                 entry = Image.objects.get(filename=media.filename)
@@ -224,6 +287,9 @@ class Database:
             for k, v in media_meta.iteritems():
                 setattr(entry, k, v)
 
+        # Save once, before the relations (they need an ID for new entries).
+        entry.save()
+
         # Update authors.
         entry = self.update_sets(entry, 'author', authors)
 
@@ -239,9 +305,6 @@ class Database:
         # Update references.
         entry = self.update_sets(entry, 'reference', refs)
 
-        # Saving modifications.
-        entry.save()
-
         print(u'Database entry updated!')
 
     def get_instance(self, table, value):
@@ -251,49 +314,34 @@ class Database:
         # Needs a default in case objects exists.
         new = False
 
-        # Try to get object. If it doesn't exist, confirm to avoid bad metadata.
-        try:
-            model = eval('%s.objects.get(name="%s")' % (table.capitalize(), value))
-        except:
-            # Load bad data dictionary.
-            bad_data_file = open('bad_data.pkl', 'rb')
-            bad_data = pickle.load(bad_data_file)
-            bad_data_file.close()
-            try:
-                fixed_value = bad_data[value.decode('utf-8')]
-                print(u'"%s" automatically fixed to "%s"' % (value, bad_data[value]))
-            except:
-                fixed_value = raw_input('\nNew metadata. Type to confirm: ')
+        # Try cached object. If it doesn't exist, confirm to avoid bad metadata.
+        model = self.cache.get(table, value)
+        if model is None:
+            fixed_value = self.bad_data.get(value)
+            if fixed_value:
+                print(u'"%s" automatically fixed to "%s"' % (value, fixed_value))
+            elif not self.interactive:
+                raise ValueError(u'New %s "%s" needs confirmation.' % (table,
+                                                                      value))
+            else:
+                fixed_value = raw_input('\nNew metadata. Type to confirm: ').decode('utf-8')
             try:
-                model, new = eval('%s.objects.get_or_create(name="%s")' % (table.capitalize(), fixed_value))
+                model, new = LOOKUP_MODELS[table].objects.get_or_create(name=fixed_value)
                 if new:
-                    print(u'New metadata %s created!' % fixed_value.decode('utf-8'))
+                    print(u'New metadata %s created!' % fixed_value)
                 else:
-                    print(u'Metadata %s already existed!' % fixed_value.decode('utf-8'))
+                    print(u'Metadata %s already existed!' % fixed_value)
                     # Add to bad data dictionary.
-                    bad_data[value] = fixed_value
-                    bad_data_file = open('bad_data.pkl', 'wb')
-                    pickle.dump(bad_data, bad_data_file)
-                    bad_data_file.close()
+                    self.bad_data.add(value, fixed_value)
+                # Remember the instance for the rest of the run.
+                self.cache.add(table, model, value)
                 # TODO Fix metadata field on original image!!!
             except:
-                print(u'Object %s not found! Aborting...' % fixed_value.decode('utf-8'))
+                print(u'Object %s not found! Aborting...' % fixed_value)
 
-        # Check ITIS for taxonomic info.
+        # New taxa are looked up in ITIS at once by resolve_new_taxa.
         if table == 'taxon' and new:
-            taxon = self.get_itis(value)
-            # Retry if connection fails.
-            if not taxon:
-                taxon = self.get_itis(value)
-                if not taxon:
-                    print(u'New try in 5s...')
-                    time.sleep(5)
-                    taxon = self.get_itis(value)
-            try:
-                # Update model.
-                model = taxon.update_model(model)
-            except:
-                print(u'Could not get taxonomic hierarchy...')
+            self.new_taxa.add(model.name)
         return model
 
     def update_sets(self, entry, field, meta):
@@ -302,27 +350,27 @@ class Database:
         Verifies if value is blank.
         '''
         meta_instances = [self.get_instance(field, value) for value in meta if value.strip()]
-        eval('entry.%s_set.clear()' % field)
-        [eval('entry.%s_set.add(value)' % field) for value in meta_instances if meta_instances]
+        apply_m2m(entry, field, meta_instances)
         return entry
 
-    def get_itis(self, name):
-        '''Access ITIS database.
+    def resolve_new_taxa(self):
+        '''Fetch the hierarchy of the taxa created during the run.
 
-        Extract parent taxon and ranking.
-
-        taxon.name
-        taxon.rank
-        taxon.tsn
-        taxon.parents
-        taxon.parent['name']
-        taxon.parent['tsn']
+        All names are searched in ITIS concurrently, then saved from the top
+        of the hierarchy down.
         '''
-        try:
-            taxon = Itis(name)
-        except:
-            return None
-        return taxon
+        # Taxa created by rolled back files were never saved.
+        names = set(Taxon.objects.filter(name__in=self.new_taxa).values_list(
+            'name', flat=True))
+        self.new_taxa = set()
+        if not names:
+            return []
+        print(u'\nSearching %d new taxa in ITIS...' % len(names))
+        resolved = resolve_taxa(names)
+        with transaction.atomic():
+            updated = update_taxa(resolved)
+        print(u'%d of %d taxa updated from ITIS.' % (len(updated), len(names)))
+        return updated
 
 
 class Folder:
@@ -407,26 +455,26 @@ class Meta:
         self.references = u''
         self.notes = u''
 
-        # Create metadata object.
-        info = IPTCInfo(media.filepath, True, 'utf-8')
+        # Read IPTC and EXIF at once; date and GPS are used by create_meta.
+        data, self.date, self.gps = read_photo_meta(media.filepath, 'utf-8')
         # Check if file has IPTC data.
-        if len(info.data) < 4:
+        if len(data) < 4:
             print(u'%s has no IPTC data!' % media.filename)
 
         # Fill values with IPTC data.
-        self.title = info.data['object name']                      #5
-        self.tags = info.data['keywords']                          #25
-        self.author = info.data['by-line']                         #80
-        self.city = info.data['city']                              #90
-        self.sublocation = info.data['sub-location']               #92
-        self.state = info.data['province/state']                   #95
-        self.country = info.data['country/primary location name']  #101
-        self.taxon = info.data['headline']                         #105
-        self.rights = info.data['copyright notice']                #116
-        self.caption = info.data['caption/abstract']               #120
-        self.size = info.data['special instructions']              #40
-        self.source = info.data['source']                          #115
-        self.references = info.data['credit']                      #110
+        self.title = data['object name']                       #5
+        self.tags = data['keywords']                           #25
+        self.author = data['by-line']                          #80
+        self.city = data['city']                               #90
+        self.sublocation = data['sub-location']                #92
+        self.state = data['province/state']                    #95
+        self.country = data['country/primary location name']   #101
+        self.taxon = data['headline']                          #105
+        self.rights = data['copyright notice']                 #116
+        self.caption = data['caption/abstract']                #120
+        self.size = data['special instructions']               #40
+        self.source = data['source']                           #115
+        self.references = data['credit']                       #110
         self.notes = u''
 
     def video_init(self, media):
@@ -458,35 +506,19 @@ class Meta:
         self.notes = u''
 
         # Check and get metadata from accessory txt file.
-        txt_path = os.path.splitext(media.filepath)[0] + '.txt'
+        txt_path = sidecar_path(media.filepath)
         try:
-            os.lstat(txt_path)
-            txt_file = open(txt_path, 'rb')
-        except:
-            txt_file = ''
+            txt_dic = read_sidecar(txt_path, SIDECAR_FIELDS)
+        except IOError:
+            txt_dic = {}
+        except ValueError as e:
+            print(u'Bad sidecar %s: %s' % (txt_path, e))
+            txt_dic = {}
 
         # Fill out metadata from accessory txt file.
-        if txt_file:
-            txt_dic = pickle.load(txt_file)
-
-            # Define metadata.
-            self.title = txt_dic['title']
-            self.tags = txt_dic['tags']
-            self.author = txt_dic['author']
-            self.city = txt_dic['city']
-            self.sublocation = txt_dic['sublocation']
-            self.state = txt_dic['state']
-            self.country = txt_dic['country']
-            self.taxon = txt_dic['taxon']
-            self.rights = txt_dic['rights']
-            self.caption = txt_dic['caption']
-            self.size = txt_dic['size']
-            self.source = txt_dic['source']
-            self.references = txt_dic['references']
-            self.notes = u''
-
-            # Close file.
-            txt_file.close()
+        for field in SIDECAR_FIELDS:
+            if field in txt_dic:
+                setattr(self, field, txt_dic[field])
 
     def none_to_empty(self, metadata):
         '''Convert None to empty string.'''
@@ -566,17 +598,12 @@ class Photo:
     def create_meta(self):
         '''Parse and instantiate photo metadata.
 
-        Uses iptcinfo.py and pyexiv2 libraries for IPTC and EXIF.
+        IPTC and EXIF are read together by Meta (see read_photo_meta).
         '''
         self.metadata = Meta(self)
 
-        # Extracting EXIF metadata.
-        exif = get_exif(self.filepath)
-        # Extracting data.
-        self.metadata.date = get_date(exif)
+        # Date and geolocation from the EXIF.
         self.metadata.dictionary['date'] = self.metadata.date
-        # Extracting geolocation.
-        self.metadata.gps = get_gps(exif)
         self.metadata.dictionary['geolocation'] = self.metadata.gps['geolocation']
         self.metadata.dictionary['latitude'] = self.metadata.gps['latitude']
         self.metadata.dictionary['longitude'] = self.metadata.gps['longitude']
@@ -627,18 +654,17 @@ class Movie:
         self.metadata = Meta(self)
 
         # Extracting EXIF metadata.
-        exif = get_exif(self.filepath)
-        # Extracting data.
-        self.metadata.date = get_date(exif)
+        iptc, self.metadata.date, self.metadata.gps = read_photo_meta(
+            self.filepath)
         self.metadata.dictionary['date'] = self.metadata.date
-        # Extracting geolocation.
-        self.metadata.gps = get_gps(exif)
         self.metadata.dictionary['geolocation'] = self.metadata.gps['geolocation']
         self.metadata.dictionary['latitude'] = self.metadata.gps['latitude']
         self.metadata.dictionary['longitude'] = self.metadata.gps['longitude']
 
         # Extracts duration, dimensions and video codec.
         infos = get_info(self.filepath)
+        if not infos:
+            raise ProbeError(u'no video information in %s' % self.filepath)
         self.metadata.dictionary['duration'] = infos['duration']
         self.metadata.dictionary['dimensions'] = infos['dimensions']
         self.metadata.dictionary['codec'] = infos['codec']
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from sidecar import is_pickled, read_sidecar, write_sidecar
+import os
+
+
+class Command(BaseCommand):
+    args = '[folder ...]'
+    help = 'Convert pickled video sidecars (.txt) to the JSON lines format.'
+
+    option_list = BaseCommand.option_list + (
+            make_option('-n', '--dry-run', action='store_true',
+                        dest='dry_run', default=False,
+                        help='Only list the files that would be converted.'),
+            )
+
+    def handle(self, *args, **options):
+        '''Walk the folders converting every pickled sidecar found.'''
+        folders = args or (settings.STORAGE_FOLDER, settings.MEDIA_ROOT)
+        converted, failed = 0, 0
+        for folder in folders:
+            for root, dirs, files in os.walk(folder):
+                for filename in files:
+                    if not filename.endswith('.txt'):
+                        continue
+                    path = os.path.join(root, filename)
+                    # Links point to a sidecar converted on its own folder.
+                    if os.path.islink(path) or not is_pickled(path):
+                        continue
+                    if options['dry_run']:
+                        self.stdout.write(path)
+                        converted += 1
+                        continue
+                    try:
+                        convert(path)
+                    except (ValueError, TypeError) as e:
+                        self.stderr.write('Could not convert %s: %s' % (path,
+                                                                        e))
+                        failed += 1
+                    else:
+                        converted += 1
+        self.stdout.write('%d sidecars converted, %d failed.' % (converted,
+                                                                failed))
+
+
+def convert(path):
+    '''Rewrite a pickled sidecar as JSON lines.
+
+    Keeps the modification time: the importer compares it with the video's
+    to decide whether the metadata changed.
+    '''
+    stat = os.stat(path)
+    write_sidecar(path, read_sidecar(path))
+    os.utime(path, (stat.st_atime, stat.st_mtime))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import connection
+from media_utils import process_video, site_relative
+from meta.models import TranscodeJob, Video
+from optparse import make_option
+import threading
+import time
+
+# Versions that must exist before a video is published.
+WEB_FIELDS = ('webm_filepath', 'mp4_filepath', 'ogg_filepath')
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Convert queued videos and publish them when all versions exist.'
+
+    option_list = BaseCommand.option_list + (
+            make_option('-c', '--concurrency', action='store', type='int',
+                        dest='concurrency', default=2,
+                        help='Number of videos converted at the same time.'),
+            make_option('-r', '--retries', action='store', type='int',
+                        dest='retries', default=3,
+                        help='Attempts before a job is marked as failed.'),
+            make_option('-o', '--once', action='store_true', dest='once',
+                        default=False,
+                        help='Exit when the queue is empty.'),
+            make_option('-s', '--sleep', action='store', type='int',
+                        dest='sleep', default=30,
+                        help='Seconds between checks of an empty queue.'),
+            make_option('--requeue', action='store_true', dest='requeue',
+                        default=False,
+                        help='Put jobs left running by a dead worker back in '
+                        'the queue.'),
+            )
+
+    def handle(self, *args, **options):
+        '''Start the workers and wait for them.'''
+        if options['requeue']:
+            n = TranscodeJob.objects.filter(
+                status=TranscodeJob.RUNNING).update(
+                    status=TranscodeJob.PENDING)
+            self.stdout.write('%d jobs back in the queue.' % n)
+
+        workers = []
+        for i in range(options['concurrency']):
+            worker = threading.Thread(target=self.work,
+                                      args=(options['retries'],
+                                            options['once'],
+                                            options['sleep']))
+            # Let Ctrl-C stop the command; interrupted jobs stay running
+            # until --requeue.
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        while any(w.is_alive() for w in workers):
+            time.sleep(1)
+
+        self.stdout.write('Queue: %s' % ', '.join(['%d %s' % (
+            TranscodeJob.objects.filter(status=status).count(), status)
+            for status, label in TranscodeJob.STATUS_CHOICES]))
+
+    def work(self, retries, once, sleep):
+        '''Convert queued videos until the queue is empty (once) or forever.'''
+        try:
+            while True:
+                job = TranscodeJob.claim()
+                if job is None:
+                    if once:
+                        return
+                    time.sleep(sleep)
+                    continue
+                self.run(job, retries)
+        finally:
+            # Each thread has its own database connection.
+            connection.close()
+
+    def run(self, job, retries):
+        '''Convert one video and publish it, or requeue the job.'''
+        video = job.video
+        self.stdout.write('Converting %s (attempt %d)...' % (
+            video.source_filepath, job.attempts))
+        try:
+            web_paths, thumb_filepath, large_thumb = process_video(
+                video.source_filepath, video.title, video.get_authors_list())
+            missing = [field for field in WEB_FIELDS
+                       if field not in (web_paths or {})]
+            if missing:
+                raise IOError('missing %s' % ', '.join(missing))
+            publish(video, web_paths, thumb_filepath, large_thumb)
+        except Exception as e:
+            if job.attempts >= retries:
+                status = TranscodeJob.FAILED
+            else:
+                status = TranscodeJob.PENDING
+            job.finish(status, unicode(e))
+            self.stdout.write('Could not convert %s: %s (%s)' % (
+                video.source_filepath, e, status))
+        else:
+            job.finish(TranscodeJob.DONE)
+            self.stdout.write('%s published!' % video.source_filepath)
+
+
+def publish(video, web_paths, thumb_filepath, large_thumb):
+    '''Point the video to its converted files and make it public.
+
+    Same rule as the ingest: media without title or author stay private.
+    Uses update() so fields edited meanwhile are not overwritten.
+    '''
+    fields = dict((field, site_relative(path)) for field, path in
+                  web_paths.iteritems())
+    fields['thumb_filepath'] = site_relative(thumb_filepath)
+    fields['large_thumb'] = site_relative(large_thumb)
+    fields['is_public'] = bool(video.title and video.author_set.exists())
+    Video.objects.filter(pk=video.pk).update(**fields)
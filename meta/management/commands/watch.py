@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from meta.ingest import MediaIndex
+from meta.management.commands import cifonauta
+from optparse import make_option
+import Queue
+import handle_ids
+import linking
+import os
+import pyinotify
+import sys
+import threading
+import time
+
+# Events that change what is inside a directory. IN_MODIFY tells which
+# files are still being written.
+EVENTS = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+          pyinotify.IN_MODIFY | pyinotify.IN_DELETE |
+          pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+
+
+class Command(BaseCommand):
+    args = '[folder]'
+    help = ('Watch the storage folder and publish new or edited files as '
+            'they arrive.')
+
+    option_list = BaseCommand.option_list + (
+            make_option('-d', '--delay', action='store', type='float',
+                        dest='delay', default=10,
+                        help='Seconds without events before a burst is '
+                        'processed.'),
+            make_option('-m', '--max-wait', action='store', type='float',
+                        dest='max_wait', default=300,
+                        help='Seconds after which a burst is processed even '
+                        'if events keep coming, as soon as no file is being '
+                        'written. Also how long a file written without '
+                        'being closed holds the burst.'),
+            make_option('-r', '--reconcile', action='store', type='int',
+                        dest='reconcile', default=3600,
+                        help='Seconds between full scans that catch missed '
+                        'events (0 disables them).'),
+            make_option('-b', '--batch-size', action='store', type='int',
+                        dest='batch_size', default=20,
+                        help='Number of files written per transaction.'),
+            )
+
+    def handle(self, *args, **options):
+        '''Collect events and process them once the burst is over.'''
+        source = os.path.abspath(args and args[0] or settings.STORAGE_FOLDER)
+        self.batch_size = options['batch_size']
+        # Nobody is there to confirm new metadata values.
+        self.cbm = cifonauta.Database(interactive=False)
+
+        # Videos take long to convert: a thread does it and hands them back
+        # to the loop, which writes them to the database (counters are
+        # deferred globally, so only one thread may write).
+        self.videos = Queue.Queue()
+        self.converted = Queue.Queue()
+        # Link paths of the videos in the queues.
+        self.pending = set()
+        worker = threading.Thread(target=self.convert_videos)
+        worker.daemon = True
+        worker.start()
+
+        collector = Collector(dirty=set())
+        watches = pyinotify.WatchManager()
+        # Wait at most a second for events, to check the timers.
+        notifier = pyinotify.Notifier(watches, collector, timeout=1000)
+        watches.add_watch(source, EVENTS, rec=True, auto_add=True)
+        self.stdout.write('Watching %s.' % source)
+
+        # Catch up with what happened while not watching.
+        self.reconcile(source)
+        last_scan = time.time()
+        first_event = last_event = None
+        try:
+            while True:
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                    last_event = time.time()
+                    if first_event is None:
+                        first_event = last_event
+                self.write_converted()
+                now = time.time()
+                if collector.overflow:
+                    # Events were dropped, only a full scan is safe.
+                    self.stdout.write('Event queue overflow.')
+                    collector.overflow = False
+                    collector.dirty.clear()
+                    first_event = None
+                    self.reconcile(source)
+                    last_scan = time.time()
+                elif collector.dirty and (
+                        now - last_event >= options['delay'] or
+                        now - first_event >= options['max_wait']) and (
+                        not collector.busy(options['max_wait'])):
+                    # Partial files would be converted and published, so
+                    # wait until every file being written is closed.
+                    dirty = set(collector.dirty)
+                    collector.dirty.clear()
+                    first_event = None
+                    self.update(source, dirty)
+                elif (options['reconcile'] and not collector.dirty and
+                      now - last_scan >= options['reconcile']):
+                    self.reconcile(source)
+                    last_scan = time.time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            notifier.stop()
+
+    def update(self, source, dirty):
+        '''Publish the files of the directories touched by a burst.'''
+        self.stdout.write('%d directories changed.' % len(dirty))
+        manager = linking.LinkManager(source, dirty=dirty, interactive=False)
+        manager.update()
+        linkpaths = manager.changed + manager.links_to(manager.modified)
+        self.publish(linkpaths)
+        # New links were renamed to their IDs.
+        manager.save()
+
+    def reconcile(self, source):
+        '''Bring links, site files and database up to date with the folder.'''
+        self.stdout.write('Reconciling %s...' % source)
+        manager = linking.LinkManager(source, interactive=False)
+        manager.update()
+        files = handle_ids.rename(handle_ids.classify(handle_ids.scan()))
+        handle_ids.convert([one_file for one_file in files
+                            if one_file.filetype != 'video'])
+        for one_file in files:
+            if one_file.filetype == 'video':
+                self.queue_video(one_file)
+        manager.save()
+
+        # Compare all site files against the database timestamps at once.
+        medias = [cifonauta.Photo(path) for path in cifonauta.Folder(
+            cifonauta.Command.SITE_MEDIA_PHOTOS, sys.maxint).get_files()]
+        medias.extend([cifonauta.Movie(path) for path in cifonauta.Folder(
+            cifonauta.Command.SITE_MEDIA_VIDEOS, sys.maxint).get_files()])
+        new, changed, unchanged = MediaIndex().classify(medias)
+        queue = [(media, False) for media in new]
+        queue.extend([(media, True) for media in changed])
+        self.write(queue)
+
+    def publish(self, linkpaths):
+        '''Rename and convert the links, then write them to the database.
+
+        Videos are only renamed here and queued for the conversion thread.
+        '''
+        queue = []
+        for linkpath in linkpaths:
+            try:
+                one_file = handle_ids.handle_link(os.path.dirname(linkpath),
+                                                  os.path.basename(linkpath),
+                                                  videos=False)
+                if one_file is None or not (one_file.new or one_file.modified):
+                    continue
+                if one_file.filetype == 'video':
+                    self.queue_video(one_file)
+                    continue
+                self.queue_media(one_file, queue)
+            except Exception as e:
+                self.stderr.write('Could not process %s: %s' % (linkpath, e))
+        self.write(queue)
+
+    def queue_media(self, one_file, queue):
+        '''Add a converted file to queue, unless the database is up to date.'''
+        if one_file.filetype == 'photo':
+            media = cifonauta.Photo(one_file.sitepath)
+        elif one_file.filetype == 'video':
+            media = cifonauta.Movie(one_file.sitepath)
+        else:
+            return
+        query = self.cbm.search_db(media)
+        if query != 2:
+            queue.append((media, query == 1))
+
+    def queue_video(self, one_file):
+        '''Hand a video to the conversion thread, once.'''
+        if one_file.abspath in self.pending:
+            return
+        self.pending.add(one_file.abspath)
+        self.videos.put(one_file)
+
+    def convert_videos(self):
+        '''Convert the queued videos, one at a time (runs in a thread).'''
+        while True:
+            one_file = self.videos.get()
+            try:
+                handle_ids.convert_file(one_file)
+            except Exception as e:
+                self.stderr.write('Could not convert %s: %s' % (
+                    one_file.abspath, e))
+                self.pending.discard(one_file.abspath)
+            else:
+                self.converted.put(one_file)
+
+    def write_converted(self):
+        '''Write the videos converted by the thread to the database.'''
+        queue = []
+        while True:
+            try:
+                one_file = self.converted.get_nowait()
+            except Queue.Empty:
+                break
+            self.pending.discard(one_file.abspath)
+            try:
+                self.queue_media(one_file, queue)
+            except Exception as e:
+                self.stderr.write('Could not process %s: %s' % (
+                    one_file.abspath, e))
+        if queue:
+            self.write(queue)
+
+    def write(self, queue):
+        '''Write the queued media and report.'''
+        if queue:
+            written, failed = cifonauta.ingest(self.cbm, queue,
+                                               batch_size=self.batch_size)
+            self.stdout.write('%d written, %d failed.' % (len(written),
+                                                         len(failed)))
+        # Do not hold a connection the server may drop while idle.
+        connection.close()
+
+
+class Collector(pyinotify.ProcessEvent):
+    '''Gather the directories touched by the events.
+
+    Also keeps the files created or modified and not closed yet, with the
+    time of their last write.
+    '''
+    def my_init(self, dirty):
+        self.dirty = dirty
+        self.writing = {}
+        self.overflow = False
+
+    def busy(self, timeout):
+        '''Tell if a file is still being written.
+
+        Files without writes for timeout seconds are forgotten: the writer
+        died, or it was a link, created without being opened.
+        '''
+        now = time.time()
+        for path, last in self.writing.items():
+            if now - last >= timeout:
+                del self.writing[path]
+        return bool(self.writing)
+
+    def process_IN_Q_OVERFLOW(self, event):
+        self.overflow = True
+
+    def process_IN_CREATE(self, event):
+        if not event.dir and not os.path.islink(event.pathname):
+            self.writing[event.pathname] = time.time()
+        self.process_default(event)
+
+    def process_IN_MODIFY(self, event):
+        self.writing[event.pathname] = time.time()
+        self.process_default(event)
+
+    def process_IN_CLOSE_WRITE(self, event):
+        self.writing.pop(event.pathname, None)
+        self.process_default(event)
+
+    def process_IN_DELETE(self, event):
+        self.writing.pop(event.pathname, None)
+        self.process_default(event)
+
+    def process_IN_MOVED_FROM(self, event):
+        self.writing.pop(event.pathname, None)
+        self.process_default(event)
+
+    def process_default(self, event):
+        self.dirty.add(event.path)
+        if event.dir:
+            # Also scan a new directory, it may arrive with its files.
+            self.dirty.add(event.pathname)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta', '0014_auto_20150125_1857'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscodeJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('status', models.CharField(default=b'pending', choices=[(b'pending', 'queued'), (b'running', 'converting'), (b'done', 'ready'), (b'failed', 'failed')], max_length=10, help_text='Conversion status.', verbose_name='status', db_index=True)),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Number of times the conversion was started.', verbose_name='attempts')),
+                ('error', models.TextField(help_text='Last conversion error.', verbose_name='error', blank=True)),
+                ('created', models.DateTimeField(help_text='Date when it was queued.', verbose_name='created', auto_now_add=True)),
+                ('updated', models.DateTimeField(help_text='Date of the last status change.', verbose_name='updated', auto_now=True)),
+                ('video', models.OneToOneField(related_name=b'transcode_job', verbose_name='video', to='meta.Video', help_text='Video to be converted.')),
+            ],
+            options={
+                'ordering': ['created'],
+                'verbose_name': 'video conversion',
+                'verbose_name_plural': 'video conversions',
+            },
+            bases=(models.Model,),
+        ),
+    ]
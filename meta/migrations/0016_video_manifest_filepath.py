@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta', '0015_transcodejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='manifest_filepath',
+            field=models.FileField(help_text='Path to the HLS playlist with the versions in several bitrates.', upload_to=b'site_media/videos/hls/', verbose_name='hls playlist', blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta', '0016_video_manifest_filepath'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='derivatives',
+            field=models.TextField(help_text='Versions of the photo in several widths and formats (JSON).', verbose_name='responsive versions', editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import json
+
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from mptt.models import MPTTModel
 from meta.signals import *
 from django.db.models import Q
+from django.utils import timezone
 from django.db.models import signals
 
 
@@ -107,10 +110,23 @@ class Image(File):
             upload_to='site_media/images/', help_text=_(u'Caminho para o arquivo web.'))
     datatype = models.CharField(_(u'tipo de mídia'), max_length=10,
             default='photo', help_text=_(u'Tipo de mídia.'))
+    derivatives = models.TextField(_(u'versões responsivas'), blank=True,
+            editable=False, help_text=_(u'Versões da foto em várias larguras e formatos (JSON).'))
 
     def __unicode__(self):
         return self.title
 
+    def get_derivatives(self, image_format=None):
+        '''Retorna as versões responsivas, opcionalmente de um formato só.'''
+        try:
+            derivatives = json.loads(self.derivatives or '[]')
+        except ValueError:
+            return []
+        if image_format:
+            derivatives = [d for d in derivatives
+                           if d['format'] == image_format]
+        return derivatives
+
     @models.permalink
     def get_absolute_url(self):
         return ('image_url', [str(self.id)])
@@ -128,6 +144,8 @@ class Video(File):
             upload_to='site_media/videos/', blank=True, help_text=_(u'Caminho para o arquivo OGG.'))
     mp4_filepath = models.FileField(_(u'arquivo mp4'),
             upload_to='site_media/videos/', blank=True, help_text=_(u'Caminho para o arquivo MP4.'))
+    manifest_filepath = models.FileField(_(u'playlist hls'),
+            upload_to='site_media/videos/hls/', blank=True, help_text=_(u'Caminho para a playlist HLS com as versões em vários bitrates.'))
     datatype = models.CharField(_(u'tipo de mídia'), max_length=10,
             default='video', help_text=_(u'Tipo de mídia.'))
     large_thumb = models.ImageField(_(u'thumbnail grande'),
@@ -618,6 +636,72 @@ class Stats(models.Model):
         verbose_name_plural = _(u'estatísticas')
 
 
+class TranscodeJob(models.Model):
+    '''Conversão de vídeo na fila, executada por manage.py transcode.'''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+            (PENDING, _(u'na fila')),
+            (RUNNING, _(u'convertendo')),
+            (DONE, _(u'pronto')),
+            (FAILED, _(u'falhou')),
+            )
+    video = models.OneToOneField(Video, related_name='transcode_job',
+            verbose_name=_(u'vídeo'), help_text=_(u'Vídeo a ser convertido.'))
+    status = models.CharField(_(u'estado'), max_length=10,
+            choices=STATUS_CHOICES, default=PENDING, db_index=True,
+            help_text=_(u'Estado da conversão.'))
+    attempts = models.PositiveIntegerField(_(u'tentativas'), default=0,
+            help_text=_(u'Número de vezes que a conversão foi iniciada.'))
+    error = models.TextField(_(u'erro'), blank=True,
+            help_text=_(u'Último erro da conversão.'))
+    created = models.DateTimeField(_(u'criado'), auto_now_add=True,
+            help_text=_(u'Data em que entrou na fila.'))
+    updated = models.DateTimeField(_(u'atualizado'), auto_now=True,
+            help_text=_(u'Data da última mudança de estado.'))
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.video.source_filepath, self.status)
+
+    @classmethod
+    def enqueue(cls, video):
+        '''Coloca (ou recoloca) o vídeo na fila de conversão.'''
+        job, new = cls.objects.get_or_create(video=video)
+        if not new:
+            job.status = cls.PENDING
+            job.attempts = 0
+            job.error = u''
+            job.save()
+        return job
+
+    @classmethod
+    def claim(cls):
+        '''Pega o próximo trabalho da fila, ou None se estiver vazia.
+
+        A troca de estado é feita com um UPDATE condicional, então dois
+        workers nunca pegam o mesmo trabalho.
+        '''
+        pending = cls.objects.filter(status=cls.PENDING).order_by('created')
+        for pk in pending.values_list('pk', flat=True)[:10]:
+            if cls.objects.filter(pk=pk, status=cls.PENDING).update(
+                    status=cls.RUNNING, attempts=models.F('attempts') + 1,
+                    updated=timezone.now()):
+                return cls.objects.select_related('video').get(pk=pk)
+        return None
+
+    def finish(self, status, error=u''):
+        '''Grava o resultado, se o trabalho não tiver sido recolocado na fila.'''
+        return type(self).objects.filter(pk=self.pk, status=self.RUNNING).update(
+                status=status, error=error, updated=timezone.now())
+
+    class Meta:
+        verbose_name = _(u'conversão de vídeo')
+        verbose_name_plural = _(u'conversões de vídeo')
+        ordering = ['created']
+
+
 
 # Slugify before saving.
 signals.pre_save.connect(slug_pre_save, sender=Author)
@@ -640,6 +724,10 @@ signals.post_save.connect(update_count, sender=Image)
 signals.post_delete.connect(update_count, sender=Image)
 signals.post_save.connect(update_count, sender=Video)
 signals.post_delete.connect(update_count, sender=Video)
+# Mark counters changed by relations while counts are deferred.
+for model in (Author, Source, Taxon, Tag, Reference, Tour):
+    signals.m2m_changed.connect(m2m_count, sender=model.images.through)
+    signals.m2m_changed.connect(m2m_count, sender=model.videos.through)
 # Add position to tour images.
 signals.post_save.connect(set_position, sender=Tour)
 #signals.post_delete.connect(set_position, sender=Tour)
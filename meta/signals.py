@@ -1,9 +1,20 @@
 # -*- coding: utf-8 -*-
 
+from django.db.models import Count
+from django.db.models.signals import post_delete
 from django.template.defaultfilters import slugify
 
 from external.mendeley import mendeley
 
+# Models with image and video counters, by type of relation with the media.
+COUNTED_M2M = ('Author', 'Source', 'Taxon', 'Tag', 'Reference', 'Tour')
+COUNTED_FK = ('Size', 'Sublocation', 'City', 'State', 'Country')
+
+# Rows waiting to be recounted while counters are deferred. Maps model name
+# to a set of primary keys, or to None when the whole table must be checked.
+# The dictionary itself is None when counters are updated on every save.
+_dirty_counts = None
+
 
 # Não é signal, apenas função acessória.
 #XXX Trocar de lugar, eventualmente.
@@ -119,6 +130,15 @@ def slug_pre_save(signal, instance, sender, **kwargs):
 
 def update_count(signal, instance, sender, **kwargs):
     '''Atualiza o contador de fotos e vídeos.'''
+    if _dirty_counts is not None:
+        # Foreign key tables are small, recount them as a whole.
+        for name in COUNTED_FK:
+            mark_dirty(name)
+        # Deleted media lose their relations without m2m_changed.
+        if signal is post_delete:
+            for name in COUNTED_M2M:
+                mark_dirty(name)
+        return
     #TODO Incluir os outros modelos!
     ## Many 2 Many
     # Authors
@@ -180,6 +200,111 @@ def update_count(signal, instance, sender, **kwargs):
         print 'Country == NULL (id=%d)' % instance.id
 
 
+def m2m_count(signal, sender, instance, action, reverse, model, pk_set,
+              **kwargs):
+    '''Marca contadores afetados por mudanças nas relações many to many.
+
+    Só tem efeito com contadores adiados (ver defer_counts).
+    '''
+    if _dirty_counts is None:
+        return
+    if not reverse:
+        # Changed from the counted side (e.g. author.images.add()).
+        mark_dirty(instance.__class__.__name__, [instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        mark_dirty(model.__name__, pk_set)
+    elif action == 'pre_clear':
+        field = model.__name__.lower()
+        related = sender.objects.filter(**{
+            instance.__class__.__name__.lower(): instance.pk})
+        mark_dirty(model.__name__, related.values_list(field, flat=True))
+
+
+def defer_counts():
+    '''Passa a marcar contadores em vez de atualizá-los a cada save.
+
+    Usado durante a importação de arquivos; flush_counts() recalcula de uma
+    vez só as linhas marcadas.
+    '''
+    global _dirty_counts
+    if _dirty_counts is None:
+        _dirty_counts = {}
+
+
+def mark_dirty(name, pks=None):
+    '''Marca linhas de um modelo para recontagem (None = tabela toda).
+
+    Sem contadores adiados, recalcula as linhas na hora.
+    '''
+    if _dirty_counts is None:
+        recount(name, pks)
+    elif pks is None:
+        _dirty_counts[name] = None
+    elif _dirty_counts.get(name, set()) is not None:
+        _dirty_counts.setdefault(name, set()).update(pks)
+
+
+def flush_counts():
+    '''Recalcula os contadores marcados e volta a atualizá-los a cada save.'''
+    global _dirty_counts
+    dirty = _dirty_counts
+    _dirty_counts = None
+    if not dirty:
+        return
+    for name, pks in dirty.iteritems():
+        changed = recount(name, pks)
+        print 'Contadores de %s: %d atualizados.' % (name, changed)
+
+
+def recount(name, pks=None):
+    '''Recalcula image_count e video_count das linhas (None = tabela toda).
+
+    Custa uma contagem agrupada (GROUP BY) para fotos, outra para vídeos e um
+    UPDATE por combinação de valores que mudou. Retorna o número de linhas
+    alteradas.
+    '''
+    if pks is not None:
+        pks = set(pks)
+        if not pks:
+            return 0
+
+    from meta import models
+    model = getattr(models, name)
+    field = name.lower()
+    if name in COUNTED_FK:
+        images = models.Image.objects.all()
+        videos = models.Video.objects.all()
+    else:
+        images = model.images.through.objects.all()
+        videos = model.videos.through.objects.all()
+    rows = model.objects.all()
+    if pks is not None:
+        images = images.filter(**{field + '__in': pks})
+        videos = videos.filter(**{field + '__in': pks})
+        rows = rows.filter(pk__in=pks)
+    image_counts = group_count(images, field)
+    video_counts = group_count(videos, field)
+
+    # Group rows by their new values to update them together.
+    changes = {}
+    for pk, image_count, video_count in rows.values_list(
+            'pk', 'image_count', 'video_count'):
+        counts = (image_counts.get(pk, 0), video_counts.get(pk, 0))
+        if counts != (image_count, video_count):
+            changes.setdefault(counts, []).append(pk)
+    # update() avoids save signals (e.g. Reference connects to Mendeley).
+    for (image_count, video_count), changed in changes.iteritems():
+        model.objects.filter(pk__in=changed).update(
+            image_count=image_count, video_count=video_count)
+    return sum([len(changed) for changed in changes.itervalues()])
+
+
+def group_count(queryset, field):
+    '''Retorna dicionário com o número de linhas por valor do campo.'''
+    return dict((row[field], row['n']) for row in
+                queryset.values(field).annotate(n=Count('id')))
+
+
 def makestats(signal, instance, sender, **kwargs):
     '''Cria objeto stats se não existir.'''
     if not instance.stats:
@@ -41,6 +41,40 @@ def print_thumb(context, field, obj):
         media = ''
     return {'media': media, 'MEDIA_URL': media_url}
 
+# Tipos MIME dos formatos das versões responsivas além do JPEG (os de
+# PHOTO_RENDER['formats'] em media_utils).
+PICTURE_FORMATS = (('webp', 'image/webp'),)
+
+def build_srcset(media_url, derivatives, image_format):
+    '''Junta as versões de image_format no formato do atributo srcset.'''
+    return u', '.join([u'%s%s %dw' % (media_url, d['path'], d['width'])
+                       for d in derivatives if d['format'] == image_format])
+
+@register.simple_tag(takes_context=True)
+def srcset(context, media, image_format='jpeg'):
+    '''Constrói o atributo srcset com as versões responsivas da foto.
+
+    As versões são criadas na importação (ver photo_derivatives); o
+    navegador escolhe a menor que serve, nada é gerado na hora.
+    '''
+    return build_srcset(context['MEDIA_URL'],
+                        media.get_derivatives(image_format), image_format)
+
+@register.inclusion_tag('picture.html', takes_context=True)
+def picture(context, media, sizes, width=''):
+    '''Elemento picture da foto com srcset de cada formato disponível.'''
+    media_url = context['MEDIA_URL']
+    # Lê o JSON das versões uma vez só para todos os formatos.
+    derivatives = media.get_derivatives()
+    sources = []
+    for image_format, mimetype in PICTURE_FORMATS:
+        candidates = build_srcset(media_url, derivatives, image_format)
+        if candidates:
+            sources.append({'type': mimetype, 'srcset': candidates})
+    return {'media': media, 'sources': sources,
+            'srcset': build_srcset(media_url, derivatives, 'jpeg'),
+            'sizes': sizes, 'width': width, 'MEDIA_URL': media_url}
+
 
 def slicer(query, media_id):
     '''Process queryset results.
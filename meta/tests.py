@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 """
 This file demonstrates two different styles of tests (one doctest and one
 unittest). These will both pass when you run "manage.py test".
@@ -21,3 +22,901 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+from fractions import Fraction
+from multiprocessing import Event, Process, Queue
+from struct import pack
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from django.utils import timezone
+
+import itis
+import linking
+import media_utils
+from filestore import FileCache, Journal
+from iptcinfo import IPTCInfo
+from itis import get_client, resolve_taxa, update_taxa
+from jpeg_metadata import read_jpeg
+from media_utils import IdAllocator, get_date, get_exif, get_gps
+from meta.ingest import apply_m2m
+from meta.management.commands import cifonauta
+from meta.management.commands.convert_sidecars import convert
+from meta.models import Author, Image, Size, Tag, Taxon
+from meta.signals import defer_counts, flush_counts
+from sidecar import is_pickled, read_sidecar, write_sidecar
+
+
+ITIS_NS = 'http://itis_service.itis.usgs.gov'
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+# Operation: (argument, response type).
+ITIS_OPERATIONS = {
+    'searchByScientificName': ('srchKey', 'SvcScientificNameList'),
+    'getAcceptedNamesFromTSN': ('tsn', 'SvcAcceptedNameList'),
+    'getFullHierarchyFromTSN': ('tsn', 'SvcFullHierarchy'),
+    }
+
+# Just the parts of the ITIS WSDL the client uses.
+ITIS_WSDL = '''<?xml version="1.0" encoding="UTF-8"?>
+<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/"
+    xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:xs="http://www.w3.org/2001/XMLSchema"
+    xmlns:ns="%(ns)s" targetNamespace="%(ns)s">
+  <wsdl:types>
+    <xs:schema targetNamespace="%(ns)s" elementFormDefault="qualified">
+      <xs:complexType name="SvcScientificName">
+        <xs:sequence>
+          <xs:element name="combinedName" type="xs:string" minOccurs="0"/>
+          <xs:element name="tsn" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="SvcScientificNameList">
+        <xs:sequence>
+          <xs:element name="scientificNames" type="ns:SvcScientificName"
+              minOccurs="0" maxOccurs="unbounded" nillable="true"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="SvcAcceptedName">
+        <xs:sequence>
+          <xs:element name="acceptedName" type="xs:string" minOccurs="0"/>
+          <xs:element name="acceptedTsn" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="SvcAcceptedNameList">
+        <xs:sequence>
+          <xs:element name="acceptedNames" type="ns:SvcAcceptedName"
+              minOccurs="0" maxOccurs="unbounded" nillable="true"/>
+          <xs:element name="tsn" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="SvcHierarchyRecord">
+        <xs:sequence>
+          <xs:element name="parentName" type="xs:string" minOccurs="0"/>
+          <xs:element name="parentTsn" type="xs:string" minOccurs="0"/>
+          <xs:element name="rankName" type="xs:string" minOccurs="0"/>
+          <xs:element name="taxonName" type="xs:string" minOccurs="0"/>
+          <xs:element name="tsn" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="SvcFullHierarchy">
+        <xs:sequence>
+          <xs:element name="hierarchyList" type="ns:SvcHierarchyRecord"
+              minOccurs="0" maxOccurs="unbounded" nillable="true"/>
+          <xs:element name="tsn" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>%(elements)s
+    </xs:schema>
+  </wsdl:types>%(messages)s
+  <wsdl:portType name="ITISServicePortType">%(operations)s
+  </wsdl:portType>
+  <wsdl:binding name="ITISServiceSoapBinding" type="ns:ITISServicePortType">
+    <soap:binding style="document"
+        transport="http://schemas.xmlsoap.org/soap/http"/>%(bindings)s
+  </wsdl:binding>
+  <wsdl:service name="ITISService">
+    <wsdl:port name="ITISServiceHttpSoap11Endpoint"
+        binding="ns:ITISServiceSoapBinding">
+      <soap:address location="%(url)s"/>
+    </wsdl:port>
+  </wsdl:service>
+</wsdl:definitions>
+'''
+
+ITIS_ELEMENTS = '''
+      <xs:element name="%(name)s"><xs:complexType><xs:sequence>
+        <xs:element name="%(arg)s" type="xs:string" minOccurs="0"/>
+      </xs:sequence></xs:complexType></xs:element>
+      <xs:element name="%(name)sResponse"><xs:complexType><xs:sequence>
+        <xs:element name="return" type="ns:%(result)s" minOccurs="0"/>
+      </xs:sequence></xs:complexType></xs:element>'''
+
+ITIS_MESSAGES = '''
+  <wsdl:message name="%(name)sRequest">
+    <wsdl:part name="parameters" element="ns:%(name)s"/>
+  </wsdl:message>
+  <wsdl:message name="%(name)sResponse">
+    <wsdl:part name="parameters" element="ns:%(name)sResponse"/>
+  </wsdl:message>'''
+
+ITIS_OPERATION = '''
+    <wsdl:operation name="%(name)s">
+      <wsdl:input message="ns:%(name)sRequest"/>
+      <wsdl:output message="ns:%(name)sResponse"/>
+    </wsdl:operation>'''
+
+ITIS_BINDING = '''
+    <wsdl:operation name="%(name)s">
+      <soap:operation soapAction="urn:%(name)s" style="document"/>
+      <wsdl:input><soap:body use="literal"/></wsdl:input>
+      <wsdl:output><soap:body use="literal"/></wsdl:output>
+    </wsdl:operation>'''
+
+ITIS_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="%(soap)s"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <soapenv:Body>
+    <ns:%(method)sResponse xmlns:ns="%(ns)s">
+      <ns:return>%(content)s</ns:return>
+    </ns:%(method)sResponse>
+  </soapenv:Body>
+</soapenv:Envelope>'''
+
+
+def itis_wsdl(url):
+    '''Return the stand-in WSDL, with its service at url.'''
+    parts = dict(elements='', messages='', operations='', bindings='')
+    for name, (arg, result) in sorted(ITIS_OPERATIONS.iteritems()):
+        values = dict(name=name, arg=arg, result=result)
+        parts['elements'] += ITIS_ELEMENTS % values
+        parts['messages'] += ITIS_MESSAGES % values
+        parts['operations'] += ITIS_OPERATION % values
+        parts['bindings'] += ITIS_BINDING % values
+    return ITIS_WSDL % dict(parts, ns=ITIS_NS, url=url)
+
+
+def itis_record(tag, **fields):
+    '''Return an ITIS record as XML.'''
+    return u'<ns:%s>%s</ns:%s>' % (tag, u''.join(
+        u'<ns:%s>%s</ns:%s>' % (name, escape(value), name)
+        for name, value in sorted(fields.iteritems())), tag)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''Serve the WSDL on GET and answer the SOAP calls on POST.'''
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.wsdl_requests += 1
+        self.reply(200, itis_wsdl(self.server.url))
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        envelope = ElementTree.fromstring(self.rfile.read(length))
+        call = envelope.find('{%s}Body' % SOAP_NS)[0]
+        method = call.tag.split('}')[1]
+        arg = call[0].text
+        self.server.calls.append((method, arg))
+        if self.server.fail.get(arg):
+            self.server.fail[arg] -= 1
+            return self.reply(503, 'Service Unavailable')
+        content = getattr(self.server, method)(arg)
+        self.reply(200, ITIS_RESPONSE % dict(
+            soap=SOAP_NS, ns=ITIS_NS, method=method,
+            content=content.encode('utf-8')))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(HTTPServer):
+    '''Stand-in for the ITIS SOAP service on 127.0.0.1, in a thread.
+
+    Calls for a name in fail get an HTTP error that many times before
+    answering, to exercise the retries.
+    '''
+    # name: (tsn, rank, parent name)
+    taxa = {
+        u'Animalia': (u'202423', u'Kingdom', u''),
+        u'Arthropoda': (u'82696', u'Phylum', u'Animalia'),
+        u'Crustacea': (u'83677', u'Subphylum', u'Arthropoda'),
+        u'Echinodermata': (u'156857', u'Phylum', u'Animalia'),
+        }
+
+    def __init__(self, fail=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.url = 'http://127.0.0.1:%d/ITISService' % self.server_port
+        self.fail = dict(fail or {})
+        self.calls = []
+        self.wsdl_requests = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def searchByScientificName(self, query):
+        if query not in self.taxa:
+            return u'<ns:scientificNames xsi:nil="true"/>'
+        return itis_record(u'scientificNames', combinedName=query,
+                           tsn=self.taxa[query][0])
+
+    def getAcceptedNamesFromTSN(self, tsn):
+        return u'<ns:acceptedNames xsi:nil="true"/><ns:tsn>%s</ns:tsn>' % tsn
+
+    def getFullHierarchyFromTSN(self, tsn):
+        names = [name for name, data in self.taxa.iteritems()
+                 if data[0] == tsn]
+        lineage = []
+        while names[-1]:
+            tsn, rank, parent = self.taxa[names[-1]]
+            parent_tsn = parent and self.taxa[parent][0] or u''
+            lineage.insert(0, itis_record(
+                u'hierarchyList', taxonName=names[-1], tsn=tsn,
+                rankName=rank, parentName=parent, parentTsn=parent_tsn))
+            names.append(parent)
+        return u''.join(lineage)
+
+
+class TaxonResolutionTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = FileCache(self.cache_dir)
+        self.server = StandInServer()
+        # Make get_client read the WSDL from the stand-in.
+        self.wsdl_url = itis.WSDL_URL
+        itis.WSDL_URL = self.server.url
+        itis._client = None
+        itis._local = threading.local()
+
+    def tearDown(self):
+        itis.WSDL_URL = self.wsdl_url
+        itis._cache = None
+        itis._client = None
+        itis._local = threading.local()
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def resolve(self, names, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        return resolve_taxa(names, cache=self.cache, **kwargs)
+
+    def searches(self, name):
+        return self.server.calls.count(('searchByScientificName', name))
+
+    def test_resolves_names_concurrently(self):
+        resolved = self.resolve([u'Crustacea', u'Echinodermata', u'Nada'])
+        self.assertEqual(resolved[u'Crustacea'].rank, u'Subfilo')
+        self.assertEqual(resolved[u'Crustacea'].parent['name'], u'Arthropoda')
+        self.assertEqual(resolved[u'Echinodermata'].rank, u'Filo')
+        self.assertFalse(resolved[u'Nada'].tsn)
+        # The threads share the WSDL read by the first one.
+        self.assertEqual(self.server.wsdl_requests, 1)
+
+    def test_each_thread_gets_its_own_client(self):
+        clients = []
+        def run():
+            clients.append((get_client(), get_client()))
+        threads = [threading.Thread(target=run) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        (first, again), (second, other) = clients
+        self.assertTrue(first is again)
+        self.assertFalse(first is second)
+        self.assertFalse(first is itis._client)
+        self.assertEqual(self.server.wsdl_requests, 1)
+
+    def test_retries_failed_connections(self):
+        self.server.fail = {u'Crustacea': 2}
+        resolved = self.resolve([u'Crustacea'])
+        self.assertEqual(resolved[u'Crustacea'].tsn, u'83677')
+        self.assertEqual(self.searches(u'Crustacea'), 3)
+
+    def test_backs_off_between_attempts(self):
+        self.server.fail = {u'Crustacea': 2}
+        start = time.time()
+        resolved = self.resolve([u'Crustacea'], backoff=0.1)
+        # Waits 0.1 and then 0.2 seconds before the call that works.
+        self.assertTrue(time.time() - start >= 0.3)
+        self.assertEqual(resolved[u'Crustacea'].rank, u'Subfilo')
+
+    def test_gives_up_after_attempts(self):
+        self.server.fail = {u'Crustacea': 5}
+        resolved = self.resolve([u'Crustacea'], attempts=2)
+        self.assertEqual(resolved[u'Crustacea'], None)
+        self.assertEqual(self.searches(u'Crustacea'), 2)
+
+    def test_cached_answers_skip_the_service(self):
+        self.resolve([u'Crustacea'])
+        self.server.calls = []
+        self.resolve([u'Crustacea'])
+        self.assertEqual(self.server.calls, [])
+
+    def test_expired_answers_are_purged(self):
+        self.cache.ttl = 60
+        self.cache.set('stale', u'Nada')
+        stale = self.cache.filename('stale')
+        past = time.time() - 120
+        os.utime(stale, (past, past))
+        self.resolve([u'Crustacea'])
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.listdir(self.cache_dir))
+
+    def test_update_taxa_saves_hierarchy_top_down(self):
+        Taxon.objects.create(name=u'Crustacea')
+        Taxon.objects.create(name=u'Arthropoda')
+        resolved = self.resolve([u'Crustacea', u'Arthropoda'])
+        update_taxa(resolved)
+        crustacea = Taxon.objects.get(name=u'Crustacea')
+        self.assertEqual(crustacea.parent.name, u'Arthropoda')
+        self.assertEqual(crustacea.parent.parent.name, u'Animalia')
+        self.assertEqual(crustacea.tsn, 83677)
+
+    def test_rolled_back_taxa_are_not_looked_up(self):
+        itis._cache = self.cache
+        cbm = cifonauta.Database(interactive=False)
+        # Echinodermata was created by a file whose savepoint rolled back.
+        Taxon.objects.create(name=u'Crustacea')
+        cbm.new_taxa = set([u'Crustacea', u'Echinodermata'])
+        updated = cbm.resolve_new_taxa()
+        self.assertEqual([taxon.name for taxon in updated], [u'Crustacea'])
+        self.assertEqual(self.searches(u'Crustacea'), 1)
+        self.assertEqual(self.searches(u'Echinodermata'), 0)
+        self.assertEqual(cbm.new_taxa, set())
+
+
+class SidecarTest(TestCase):
+    meta = {'title': u'Larva de ouriço', 'author': u'Alvaro E. Migotto',
+            'tags': [u'larva', u'plâncton']}
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'video.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        write_sidecar(self.path, self.meta)
+        self.assertFalse(is_pickled(self.path))
+        self.assertEqual(read_sidecar(self.path), self.meta)
+
+    def test_reads_only_requested_fields(self):
+        write_sidecar(self.path, self.meta)
+        self.assertEqual(read_sidecar(self.path, ['author']),
+                         {'author': u'Alvaro E. Migotto'})
+
+    def test_converts_pickles_keeping_mtime(self):
+        pickle.dump(self.meta, open(self.path, 'wb'))
+        os.utime(self.path, (1000000000, 1000000000))
+        self.assertEqual(read_sidecar(self.path, ['title']),
+                         {'title': u'Larva de ouriço'})
+        convert(self.path)
+        self.assertFalse(is_pickled(self.path))
+        self.assertEqual(read_sidecar(self.path), self.meta)
+        self.assertEqual(os.path.getmtime(self.path), 1000000000)
+
+
+class ManifestTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # Old enough for the listings to be trusted, see RACY_SECONDS.
+        self.old = time.time() - 3600
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def write(self, data, *names):
+        path = self.path(*names)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as original:
+            original.write(data)
+        return path
+
+    def settle(self, *dirpaths):
+        for dirpath in dirpaths:
+            os.utime(dirpath, (self.old, self.old))
+
+    def test_prunes_directories_with_the_same_mtime(self):
+        self.write('one', 'a', 'one.jpg')
+        self.settle(self.path('a'), self.root)
+        manifest = linking.scan(self.root)
+        # Not seen: nothing tells the scan that the directory changed.
+        self.write('two', 'a', 'two.jpg')
+        self.settle(self.path('a'))
+        again = linking.scan(self.root, manifest)
+        self.assertEqual(again, manifest)
+        self.assertEqual(sorted(again[self.path('a')][1]), ['one.jpg'])
+
+    def test_finds_subdirectory_under_unchanged_parent(self):
+        self.write('one', 'a', 'b', 'one.jpg')
+        self.settle(self.path('a', 'b'), self.path('a'), self.root)
+        manifest = linking.scan(self.root)
+        self.write('two', 'a', 'b', 'c', 'two.jpg')
+        os.utime(self.path('a', 'b'), (self.old + 1, self.old + 1))
+        self.settle(self.path('a', 'b', 'c'))
+        again = linking.scan(self.root, manifest)
+        self.assertEqual(again[self.path('a')], manifest[self.path('a')])
+        self.assertEqual(again[self.path('a', 'b')][2], ['c'])
+        self.assertEqual(again[self.path('a', 'b', 'c')][1].keys(),
+                         ['two.jpg'])
+
+    def test_lists_racy_directories_again(self):
+        self.write('one', 'a', 'one.jpg')
+        self.settle(self.root)
+        mtime = os.stat(self.path('a')).st_mtime
+        manifest = linking.scan(self.root)
+        # Changed too recently to be trusted.
+        self.assertEqual(manifest[self.path('a')][0], None)
+        self.write('two', 'a', 'two.jpg')
+        os.utime(self.path('a'), (mtime, mtime))
+        again = linking.scan(self.root, manifest)
+        self.assertEqual(sorted(again[self.path('a')][1]),
+                         ['one.jpg', 'two.jpg'])
+
+    def test_lists_dirty_directories_again(self):
+        one = self.write('one', 'a', 'one.jpg')
+        self.settle(self.path('a'), self.root)
+        manifest = linking.scan(self.root)
+        # Edited in place, the directory keeps its mtime.
+        self.write('edited', 'a', 'one.jpg')
+        again = linking.scan(self.root, manifest, dirty=set([self.path('a')]))
+        self.assertEqual(again[self.path('a')][1]['one.jpg'][1], 6)
+        self.assertEqual(again[self.path('a')][1]['one.jpg'][3],
+                         linking.digest(one, 6))
+
+    def test_reuses_digests_of_unchanged_files(self):
+        self.write('one', 'a', 'one.jpg')
+        self.settle(self.root)
+        manifest = linking.scan(self.root)
+        files = dict(manifest[self.path('a')][1])
+        files['one.jpg'] = files['one.jpg'][:3] + ('kept',)
+        again = linking.list_dir(self.path('a'), previous=files)
+        self.assertEqual(again[0]['one.jpg'][3], 'kept')
+
+
+class LinkManagerTest(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        # The manifests and links are kept relative to the working directory.
+        os.chdir(self.root)
+        self.source = os.path.join(self.root, 'source_media', 'oficial')
+        self.linked = os.path.join(self.root, 'linked_media', 'oficial')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def write(self, data, *names):
+        path = os.path.join(self.source, *names)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as original:
+            original.write(data)
+        return path
+
+    def update(self, **kwargs):
+        manager = linking.LinkManager(self.source, interactive=False,
+                                      **kwargs)
+        manager.update()
+        manager.save()
+        return manager
+
+    def target(self, *names):
+        return os.readlink(os.path.join(self.linked, *names))
+
+    def test_full_scan_ignores_the_manifests(self):
+        self.write('one', 'a', 'one.jpg')
+        old = time.time() - 3600
+        for dirpath in (os.path.join(self.source, 'a'), self.source):
+            os.utime(dirpath, (old, old))
+        self.update()
+        two = self.write('two', 'a', 'two.jpg')
+        os.utime(os.path.join(self.source, 'a'), (old, old))
+        self.assertFalse(two in self.update().sources)
+        manager = self.update(full=True)
+        self.assertTrue(two in manager.sources)
+        self.assertEqual(self.target('a', 'two.jpg'), two)
+
+    def test_moved_originals_are_found_by_inode(self):
+        one = self.write('one', 'a', 'one.jpg')
+        self.update()
+        os.makedirs(os.path.join(self.source, 'b'))
+        moved = os.path.join(self.source, 'b', 'one.jpg')
+        os.rename(one, moved)
+        manager = self.update()
+        self.assertEqual(manager.moved, {one: moved})
+        self.assertEqual(self.target('b', 'one.jpg'), moved)
+        self.assertFalse(os.path.lexists(
+            os.path.join(self.linked, 'a', 'one.jpg')))
+
+    def test_copies_are_not_moves(self):
+        one = self.write('one', 'a', 'one.jpg')
+        self.update()
+        copy = self.write('one', 'b', 'one.jpg')
+        os.remove(one)
+        self.assertEqual(self.update().moved, {})
+        self.assertEqual(self.target('b', 'one.jpg'), copy)
+
+    def test_same_names_are_told_apart_by_content(self):
+        first = self.write('first', 'a', 'one.jpg')
+        second = self.write('second', 'b', 'one.jpg')
+        self.update()
+        # Copied and removed: a new inode, so only the content tells.
+        copy = self.write('first', 'c', 'one.jpg')
+        os.remove(first)
+        manager = self.update()
+        self.assertEqual(manager.get_matches(first), [copy])
+        self.assertEqual(self.target('c', 'one.jpg'), copy)
+        self.assertEqual(self.target('b', 'one.jpg'), second)
+
+    def test_unique_names_are_fixed(self):
+        one = self.write('one', 'a', 'one.jpg')
+        self.update()
+        copy = self.write('edited', 'b', 'one.jpg')
+        os.remove(one)
+        self.assertEqual(self.update().tofix, {copy: os.path.join(
+            self.linked, 'a', 'one.jpg')})
+        self.assertEqual(self.target('b', 'one.jpg'), copy)
+
+
+def reserve_names(journal_path, site_dir, count, start, queue):
+    '''Reserve count names in a process of its own, put them in queue.'''
+    allocator = IdAllocator(os.path.join(site_dir, 'missing.pkl'),
+                            journal_path, site_dir)
+    start.wait()
+    queue.put([allocator.reserve(u'test') for i in range(count)])
+
+
+def slow_id():
+    '''Pick among few identifiers, slowly.
+
+    Processes reserving without the lock would then collide.
+    '''
+    time.sleep(0.002)
+    return 'id%02d' % random.randrange(60)
+
+
+class IdAllocatorTest(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal = os.path.join(self.folder, 'ids.journal')
+        self.site = os.path.join(self.folder, 'site_media')
+        os.makedirs(os.path.join(self.site, 'photos'))
+        open(os.path.join(self.site, 'photos', 'test_AAAAAA.jpg'), 'wb').close()
+        self.create_id = media_utils.create_id
+        media_utils.create_id = slow_id
+
+    def tearDown(self):
+        media_utils.create_id = self.create_id
+        shutil.rmtree(self.folder)
+
+    def allocator(self):
+        return IdAllocator(os.path.join(self.site, 'missing.pkl'),
+                           self.journal, self.site)
+
+    def reserve(self, processes, count):
+        start = Event()
+        queue = Queue()
+        workers = [Process(target=reserve_names,
+                           args=(self.journal, self.site, count, start, queue))
+                   for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        names = []
+        for worker in workers:
+            names.extend(queue.get())
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+        return names
+
+    def test_seeds_journal_with_site_names(self):
+        self.assertTrue(self.allocator().taken(u'test_AAAAAA.jpg'))
+        self.assertEqual(Journal(self.journal).read(),
+                         [{'name': u'test_AAAAAA'}])
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ['ids.journal', 'ids.journal.lock', 'site_media'])
+
+    def test_interrupted_seed_leaves_no_journal(self):
+        def records():
+            yield {'name': u'test_AAAAAA'}
+            raise IOError('No space left on device')
+        self.assertRaises(IOError, Journal(self.journal).create, records())
+        self.assertEqual(os.listdir(self.folder), ['site_media'])
+        # So the next start seeds it again.
+        self.assertTrue(self.allocator().taken(u'test_AAAAAA.jpg'))
+
+    def test_concurrent_reservations_never_collide(self):
+        names = self.reserve(4, 10)
+        self.assertEqual(len(set(names)), 40)
+        journal = [record['name'] for record in Journal(self.journal).read()]
+        self.assertEqual(sorted(journal), sorted(names + [u'test_AAAAAA']))
+
+    def test_taken_sees_reservations_of_other_processes(self):
+        allocator = self.allocator()
+        name, = self.reserve(1, 1)
+        self.assertFalse(name in allocator.names)
+        self.assertTrue(allocator.taken(name + u'.jpg'))
+        self.assertTrue(allocator.reserve(u'test') != name)
+
+
+def jpeg_segment(marker, payload):
+    '''Return a JPEG segment with its marker and length.'''
+    return '\xff' + chr(marker) + pack('>H', len(payload) + 2) + payload
+
+
+def tiff_ifd(order, entries, offset):
+    '''Return an IFD at offset, followed by the values not fitting in it.
+
+    entries are (tag, type, count, raw bytes).
+    '''
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    head, tail = [pack(order + 'H', len(entries))], ''
+    for tag, kind, count, raw in entries:
+        if len(raw) > 4:
+            head.append(pack(order + 'HHII', tag, kind, count,
+                             data_offset + len(tail)))
+            tail += raw
+        else:
+            head.append(pack(order + 'HHI', tag, kind, count) +
+                        raw.ljust(4, '\x00'))
+    head.append(pack(order + 'I', 0))
+    return ''.join(head) + tail
+
+
+def rationals(order, *values):
+    '''Return TIFF rationals for (numerator, denominator) pairs.'''
+    return ''.join([pack(order + 'II', num, den) for num, den in values])
+
+
+def exif_block(order, date, latitude, longitude):
+    '''Return an EXIF segment payload with dates and GPS position.
+
+    latitude and longitude are (reference, ((num, den), ...)).
+    '''
+    photo = [(0x9003, 2, 20, date + '\x00')]
+    gps = [(1, 2, 2, latitude[0] + '\x00'),
+           (2, 5, 3, rationals(order, *latitude[1])),
+           (3, 2, 2, longitude[0] + '\x00'),
+           (4, 5, 3, rationals(order, *longitude[1]))]
+
+    def image(photo_offset, gps_offset):
+        return [(0x0132, 2, 20, date + '\x00'),
+                (0x8769, 4, 1, pack(order + 'I', photo_offset)),
+                (0x8825, 4, 1, pack(order + 'I', gps_offset))]
+
+    # The offsets do not change the size of the first IFD.
+    photo_offset = 8 + len(tiff_ifd(order, image(0, 0), 8))
+    gps_offset = photo_offset + len(tiff_ifd(order, photo, photo_offset))
+    mark = order == '<' and 'II' or 'MM'
+    return ('Exif\x00\x00' + mark + pack(order + 'HI', 42, 8) +
+            tiff_ifd(order, image(photo_offset, gps_offset), 8) +
+            tiff_ifd(order, photo, photo_offset) +
+            tiff_ifd(order, gps, gps_offset))
+
+
+def iptc_block(datasets, extended=()):
+    '''Return an APP13 payload with IIM datasets (record, dataset, value).
+
+    Datasets in extended use the extended length form.
+    '''
+    iim = ''
+    for record, dataset, value in datasets:
+        if dataset in extended:
+            iim += pack('>BBBHI', 0x1c, record, dataset, 0x8004, len(value))
+        else:
+            iim += pack('>BBBH', 0x1c, record, dataset, len(value))
+        iim += value
+    return ('Photoshop 3.0\x00' + '8BIM' + pack('>HHI', 0x0404, 0, len(iim)) +
+            iim + '\x00' * (len(iim) % 2))
+
+
+class JpegMetadataTest(TestCase):
+    date = '2011:05:14 10:30:00'
+    latitude = ('S', ((23, 1), (49, 1), (3075, 100)))
+    longitude = ('W', ((45, 1), (25, 1), (1234, 100)))
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'photo.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def jpeg(self, *payloads):
+        '''Write a JPEG with the segments in payloads and return its path.'''
+        data = '\xff\xd8' + jpeg_segment(0xe0, 'JFIF\x00\x01\x01\x00\x00'
+                                          '\x01\x00\x01\x00\x00')
+        data += ''.join(payloads)
+        data += jpeg_segment(0xda, '\x01\x01\x00\x00\x3f\x00') + '\xd2\xcf'
+        data += '\xff\xd9'
+        with open(self.path, 'wb') as jpeg:
+            jpeg.write(data)
+        return self.path
+
+    def exif(self, order):
+        return jpeg_segment(0xe1, exif_block(order, self.date, self.latitude,
+                                             self.longitude))
+
+    def iptc(self, datasets, extended=()):
+        return jpeg_segment(0xed, iptc_block(datasets, extended))
+
+    def check_exif(self, meta):
+        date = datetime(2011, 5, 14, 10, 30)
+        self.assertEqual(meta.exif['Exif.Image.DateTime'], date)
+        self.assertEqual(get_date(meta.exif), date)
+        self.assertEqual(meta.exif['Exif.GPSInfo.GPSLatitude'],
+                         [Fraction(23), Fraction(49), Fraction(3075, 100)])
+        self.assertEqual(get_gps(meta.exif), {
+            'geolocation': 'S 23°49\'30" W 45°25\'12"',
+            'latitude': '-23.825208', 'longitude': '-45.420094'})
+
+    def test_little_endian_exif(self):
+        self.check_exif(read_jpeg(self.jpeg(self.exif('<'))))
+
+    def test_big_endian_exif(self):
+        self.check_exif(read_jpeg(self.jpeg(self.exif('>'))))
+
+    def test_exif_matches_pyexiv2(self):
+        path = self.jpeg(self.exif('>'))
+        meta, exif = read_jpeg(path), get_exif(path)
+        self.assertEqual(get_date(meta.exif), get_date(exif))
+        self.assertEqual(get_gps(meta.exif), get_gps(exif))
+
+    def test_iptc_matches_iptcinfo(self):
+        path = self.jpeg(self.iptc([
+            (2, 0, '\x00\x04'), (2, 5, 'Larva'),
+            (2, 25, 'larva'), (2, 25, 'pl\xc3\xa2ncton'),
+            (2, 80, 'Alvaro E. Migotto'), (2, 120, 'Larva de ouri\xc3\xa7o')]))
+        meta = read_jpeg(path)
+        self.assertEqual(meta.data['keywords'], [u'larva', u'plâncton'])
+        self.assertEqual(meta.data['caption/abstract'], u'Larva de ouriço')
+        self.assertEqual(dict(meta.data),
+                         dict(IPTCInfo(path, True, 'utf-8').data))
+
+    def test_extended_iim_length(self):
+        caption = 'Larva ' * 6000
+        meta = read_jpeg(self.jpeg(self.iptc(
+            [(2, 120, caption), (2, 80, 'Alvaro E. Migotto')],
+            extended=(120,))))
+        self.assertEqual(meta.data['caption/abstract'], unicode(caption))
+        self.assertEqual(meta.data['by-line'], u'Alvaro E. Migotto')
+
+    def test_charset_dataset(self):
+        # 100 is ISO 8859-1, see IPTCInfo.c_charset.
+        meta = read_jpeg(self.jpeg(self.iptc([
+            (1, 90, pack('>H', 100)), (2, 120, 'Larva de ouri\xe7o')])))
+        self.assertEqual(meta.data['caption/abstract'], u'Larva de ouriço')
+
+    def test_truncated_segments(self):
+        data = open(self.jpeg(self.exif('<'), self.iptc([
+            (2, 120, 'Larva')]))).read()
+        for size in range(2, len(data)):
+            with open(self.path, 'wb') as jpeg:
+                jpeg.write(data[:size])
+            meta = read_jpeg(self.path)
+            self.assertTrue(meta.data['caption/abstract'] in
+                            (None, u'Larva'))
+            self.assertTrue(get_date(meta.exif) in
+                            (datetime(2011, 5, 14, 10, 30),
+                             '1900-01-01 01:01:01'))
+
+    def test_garbage_segments(self):
+        garbage = ''.join([chr(i * 37 % 256) for i in range(600)])
+        for payload in (jpeg_segment(0xe1, 'Exif\x00\x00MM' + garbage),
+                        jpeg_segment(0xe1, 'Exif\x00\x00II' + garbage),
+                        jpeg_segment(0xed, 'Photoshop 3.0\x00' + garbage),
+                        jpeg_segment(0xe1, 'Exif\x00\x00XX' + garbage),
+                        garbage):
+            meta = read_jpeg(self.jpeg(payload))
+            self.assertEqual(meta.data['keywords'], [])
+
+    def test_not_a_jpeg(self):
+        with open(self.path, 'wb') as jpeg:
+            jpeg.write('GIF89a')
+        self.assertRaises(ValueError, read_jpeg, self.path)
+        open(self.path, 'wb').close()
+        self.assertRaises(ValueError, read_jpeg, self.path)
+
+
+class CounterTest(TestCase):
+    def image(self, name, size=None):
+        now = timezone.now()
+        return Image.objects.create(filename=name, timestamp=now, date=now,
+                                    size=size)
+
+    def counts(self, *models):
+        '''Return the stored counters of the rows, by name.'''
+        return dict((row.name, (row.image_count, row.video_count))
+                    for model in models for row in model.objects.all())
+
+    def recounted(self):
+        '''Return the counters of the authors, counted from scratch.'''
+        return dict((author.name, (author.images.count(),
+                                   author.videos.count()))
+                    for author in Author.objects.all())
+
+    def authors(self, entry):
+        return set(entry.author_set.values_list('name', flat=True))
+
+    def test_apply_m2m_matches_clear_and_add(self):
+        cleared, diffed = self.image(u'cleared'), self.image(u'diffed')
+        x, y, z = [Author.objects.create(name=name) for name in u'xyz']
+        for authors in ([x, y], [y, z], [], [z]):
+            # As ingest did before apply_m2m.
+            defer_counts()
+            try:
+                cleared.author_set.clear()
+                for author in authors:
+                    cleared.author_set.add(author)
+            finally:
+                flush_counts()
+            self.assertEqual(self.counts(Author), self.recounted())
+
+            defer_counts()
+            try:
+                apply_m2m(diffed, 'author', authors)
+            finally:
+                flush_counts()
+            self.assertEqual(self.authors(diffed), self.authors(cleared))
+            self.assertEqual(self.counts(Author), self.recounted())
+
+    def test_apply_m2m_writes_nothing_without_changes(self):
+        image = self.image(u'same')
+        authors = [Author.objects.create(name=name) for name in u'xy']
+        apply_m2m(image, 'author', authors)
+        # Counters are recounted right away when not deferred.
+        self.assertEqual(self.counts(Author), {u'x': (1, 0), u'y': (1, 0)})
+        with self.assertNumQueries(1):
+            self.assertEqual(apply_m2m(image, 'author', authors),
+                             (set(), set()))
+
+    def test_deferred_counts_are_flushed(self):
+        size = Size.objects.create(name=u'<0,1 mm')
+        author = Author.objects.create(name=u'Alvaro E. Migotto')
+        tag = Tag.objects.create(name=u'larva')
+        zero = {u'<0,1 mm': (0, 0), u'Alvaro E. Migotto': (0, 0),
+                u'larva': (0, 0)}
+        defer_counts()
+        try:
+            image = self.image(u'deferred', size)
+            apply_m2m(image, 'author', [author])
+            image.tag_set.add(tag)
+            self.assertEqual(self.counts(Size, Author, Tag), zero)
+        finally:
+            flush_counts()
+        self.assertEqual(self.counts(Size, Author, Tag), {
+            u'<0,1 mm': (1, 0), u'Alvaro E. Migotto': (1, 0),
+            u'larva': (1, 0)})
+
+        defer_counts()
+        try:
+            image.delete()
+        finally:
+            flush_counts()
+        self.assertEqual(self.counts(Size, Author, Tag), zero)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''Metadata sidecar files of the videos.
+
+Videos carry their metadata in a .txt file next to them. These used to be
+pickled dictionaries; now they are JSON lines: a header with the format
+version followed by one field per line,
+
+    {"cifonauta_sidecar": 1}
+    {"title": "Larva de ouriço"}
+    {"author": "Alvaro E. Migotto"}
+    ...
+
+so a reader asking for a few fields skips the other lines without decoding
+them. Old pickled files are still read (see convert_sidecars to migrate
+them).
+'''
+
+import cPickle as pickle
+import json
+import logging
+import os
+import tempfile
+
+from datetime import date
+
+# Instancia logger.
+logger = logging.getLogger('cifonauta.sidecar')
+
+SIDECAR_VERSION = 1
+HEADER = 'cifonauta_sidecar'
+
+# Fields filled in by the video metadata editor.
+SIDECAR_FIELDS = ('title', 'tags', 'author', 'city', 'sublocation', 'state',
+                  'country', 'taxon', 'rights', 'caption', 'size', 'source',
+                  'references')
+
+
+def sidecar_path(filepath):
+    '''Return the sidecar path of a media file.'''
+    return os.path.splitext(filepath)[0] + '.txt'
+
+
+def is_pickled(path):
+    '''True if the sidecar is still in the old pickle format.'''
+    sidecar = open(path, 'rb')
+    try:
+        return sidecar.read(1) != '{'
+    finally:
+        sidecar.close()
+
+
+def read_sidecar(path, fields=None):
+    '''Return the metadata in the sidecar as a dictionary.
+
+    With fields, only these keys are decoded. Raises IOError if the file
+    cannot be read and ValueError if it is corrupt or from a newer version.
+    '''
+    sidecar = open(path, 'rb')
+    try:
+        header = sidecar.readline()
+        if not header.startswith('{'):
+            sidecar.seek(0)
+            return read_pickle(sidecar, fields)
+        version = json.loads(header).get(HEADER)
+        if not version or version > SIDECAR_VERSION:
+            raise ValueError('unknown sidecar version in %s: %r' % (
+                path, version))
+        if fields is not None:
+            # Lines start with the JSON encoded key.
+            prefixes = tuple(['{%s: ' % json.dumps(field)
+                              for field in fields])
+        meta = {}
+        for line in sidecar:
+            if fields is None or line.startswith(prefixes):
+                meta.update(json.loads(line))
+        return meta
+    finally:
+        sidecar.close()
+
+
+def read_pickle(sidecar, fields=None):
+    '''Read an old pickled sidecar.'''
+    try:
+        meta = pickle.load(sidecar)
+    except Exception as e:
+        raise ValueError('corrupt pickle %s: %s' % (sidecar.name, e))
+    if not isinstance(meta, dict):
+        raise ValueError('%s is not a metadata dictionary' % sidecar.name)
+    logger.debug('Pickled sidecar %s, run convert_sidecars.', sidecar.name)
+    if fields is not None:
+        meta = dict((k, v) for k, v in meta.iteritems() if k in fields)
+    return meta
+
+
+def write_sidecar(path, meta):
+    '''Write metadata to the sidecar, replacing it atomically.
+
+    Dates are stored as ISO 8601 strings and byte strings are decoded as
+    UTF-8.
+    '''
+    lines = [json.dumps({HEADER: SIDECAR_VERSION})]
+    for key in sorted(meta):
+        lines.append(json.dumps({key: meta[key]}, default=encode_value))
+    directory = os.path.dirname(path) or '.'
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.sidecar.')
+    try:
+        sidecar = os.fdopen(fd, 'wb')
+        try:
+            sidecar.write('\n'.join(lines) + '\n')
+        finally:
+            sidecar.close()
+        if os.path.exists(path):
+            # mkstemp creates private files, keep the old permissions.
+            os.chmod(temp, os.stat(path).st_mode & 0777)
+        else:
+            os.chmod(temp, 0644)
+        os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def encode_value(value):
+    '''JSON encoding of the values json does not know.'''
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)